@@ -1,7 +1,9 @@
 import datetime
+import gc
 import json
 import socket
 import os
+import numpy as np
 from typing import TypedDict, Dict, Optional, List, Any, Literal, Union, Tuple, Callable
 from omegaconf import DictConfig, OmegaConf
 from loguru import logger
@@ -63,6 +65,139 @@ class Event():
     def to_dict(self):
         return asdict(self)
 
+EPOCH: datetime.datetime = datetime.datetime(1970, 1, 1)
+
+def convert_datetimes_to_datetime64(times: List[Optional[datetime.datetime]]) -> np.ndarray:
+    """Convert naive datetimes => datetime64[us] array (None => NaT). ~6x faster than `np.array(times, dtype='datetime64[us]')`"""
+    nat: int = np.iinfo(np.int64).min # NaT's underlying int64 value
+    try:
+        return np.array([ 
+            nat if x is None else ((td := x - EPOCH).days * 86_400_000_000 + td.seconds * 1_000_000 + td.microseconds)
+            for x in times 
+        ], dtype=np.int64).reshape(len(times)).view('datetime64[us]')
+    except TypeError:
+        # e.g. timezone-aware datetimes or np.datetime64's, so let NumPy handle them
+        return np.array(times, dtype='datetime64[us]').reshape(len(times))
+
+class Timeline():
+    """
+        Struct-of-arrays version of a List[Event] (i.e. one patient's timeline), which avoids allocating one Python object per event.
+        Strings (codes, textual values, units, OMOP tables) are stored once per timeline in `self.strings`, and events refer to them by idx.
+        
+        Columns ([idx] = event idx):
+            - code_ids: int32 -- idx of `code` in `self.strings`
+            - values: float64 -- numerical `value` (NaN if `value` isn't numerical)
+            - is_numeric: bool -- TRUE if `value` is numerical (needed to distinguish a NaN value from no value)
+            - text_value_ids: int32 -- idx of textual `value` in `self.strings` (-1 if `value` isn't textual)
+            - unit_ids: int32 -- idx of `unit` in `self.strings` (-1 if None)
+            - starts, ends: datetime64[us] -- i.e. int64 epochs in microseconds (NaT if None)
+            - omop_table_ids: int32 -- idx of `omop_table` in `self.strings` (-1 if None)
+
+        Supports `len()`, iteration and integer indexing (which return `Event`s), and slicing / boolean masks (which return `Timeline`s),
+        so it can be used anywhere a List[Event] is expected. Code tokenizers read its columns directly (see `CompiledCodeLookup.lookup_timeline()`).
+        NOTE: Values that are neither `int`, `float`, nor `str` are dropped (i.e. become None), since no tokenizer maps them to a token.
+    """
+    def __init__(self,
+                 strings: List[str],
+                 code_ids: np.ndarray,
+                 values: np.ndarray,
+                 is_numeric: np.ndarray,
+                 text_value_ids: np.ndarray,
+                 unit_ids: np.ndarray,
+                 starts: np.ndarray,
+                 ends: np.ndarray,
+                 omop_table_ids: np.ndarray):
+        self.strings: List[str] = strings
+        self.code_ids: np.ndarray = code_ids
+        self.values: np.ndarray = values
+        self.is_numeric: np.ndarray = is_numeric
+        self.text_value_ids: np.ndarray = text_value_ids
+        self.unit_ids: np.ndarray = unit_ids
+        self.starts: np.ndarray = starts
+        self.ends: np.ndarray = ends
+        self.omop_table_ids: np.ndarray = omop_table_ids
+
+    @classmethod
+    def from_columns(cls,
+                     codes: List[str],
+                     values: List[Optional[Any]],
+                     units: List[Optional[str]],
+                     starts: List[Optional[datetime.datetime]],
+                     ends: List[Optional[datetime.datetime]],
+                     omop_tables: List[Optional[str]]) -> 'Timeline':
+        """Create a Timeline from one list per Event attribute"""
+        n_events: int = len(codes)
+        string_2_idx: Dict[str, int] = {}
+        to_ids = lambda strings: np.fromiter(( -1 if x is None else string_2_idx.setdefault(x, len(string_2_idx)) for x in strings ), dtype=np.int32, count=n_events)
+        # NOTE: Same check as `CompiledCodeLookup.lookup()` for whether a value is numerical (i.e. excludes NumPy scalars other than np.float64)
+        is_numeric: np.ndarray = np.fromiter(( isinstance(x, (float, int)) for x in values ), dtype=bool, count=n_events)
+        code_ids: np.ndarray = to_ids(codes)
+        text_value_ids: np.ndarray = to_ids(( x if isinstance(x, str) else None for x in values ))
+        unit_ids: np.ndarray = to_ids(units)
+        omop_table_ids: np.ndarray = to_ids(omop_tables)
+        return cls(
+            strings=list(string_2_idx.keys()),
+            code_ids=code_ids,
+            values=np.fromiter(( x if is_num else np.nan for x, is_num in zip(values, is_numeric.tolist()) ), dtype=np.float64, count=n_events),
+            is_numeric=is_numeric,
+            text_value_ids=text_value_ids,
+            unit_ids=unit_ids,
+            starts=convert_datetimes_to_datetime64(starts),
+            ends=convert_datetimes_to_datetime64(ends),
+            omop_table_ids=omop_table_ids,
+        )
+
+    @classmethod
+    def from_events(cls, events: List[Any]) -> 'Timeline':
+        """Create a Timeline from a list of `Event`s (or any objects with the same attributes, i.e. FEMR events)"""
+        events = list(events)
+        return cls.from_columns(
+            [ e.code for e in events ],
+            [ e.value for e in events ],
+            [ e.unit for e in events ],
+            [ e.start for e in events ],
+            [ e.end for e in events ],
+            [ e.omop_table for e in events ],
+        )
+
+    def to_events(self) -> List[Event]:
+        return [ self[idx] for idx in range(len(self)) ]
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory footprint of this Timeline (in bytes)"""
+        return sum(x.nbytes for x in [ self.code_ids, self.values, self.is_numeric, self.text_value_ids, self.unit_ids, self.starts, self.ends, self.omop_table_ids ]) + sum(len(x) + 49 for x in self.strings)
+
+    def __len__(self) -> int:
+        return self.code_ids.shape[0]
+    
+    def __iter__(self):
+        return ( self[idx] for idx in range(len(self)) )
+
+    def __getitem__(self, idx: Union[int, slice, np.ndarray]) -> Union[Event, 'Timeline']:
+        """If `idx` is an int, then return the Event at `idx`; otherwise (i.e. a slice or mask), return a Timeline of those events"""
+        if isinstance(idx, (int, np.integer)):
+            get_string = lambda string_idx: self.strings[string_idx] if string_idx >= 0 else None
+            return Event(
+                code=self.strings[self.code_ids[idx]],
+                value=float(self.values[idx]) if self.is_numeric[idx] else get_string(self.text_value_ids[idx]),
+                unit=get_string(self.unit_ids[idx]),
+                start=self.starts[idx].item(),
+                end=self.ends[idx].item(),
+                omop_table=get_string(self.omop_table_ids[idx]),
+            )
+        return Timeline(
+            strings=self.strings,
+            code_ids=self.code_ids[idx],
+            values=self.values[idx],
+            is_numeric=self.is_numeric[idx],
+            text_value_ids=self.text_value_ids[idx],
+            unit_ids=self.unit_ids[idx],
+            starts=self.starts[idx],
+            ends=self.ends[idx],
+            omop_table_ids=self.omop_table_ids[idx],
+        )
+
 #############################################
 #
 # Token Stats
@@ -138,6 +273,25 @@ class TokenizerConfigEntry():
                 return s
         return None
 
+class LazyTCEField():
+    """
+        Non-data descriptor for TokenizerConfigEntry fields that are loaded lazily from a binary tokenizer config (see `TokenizerConfigColumns`).
+        Entries that have the field set (i.e. every entry created via __init__()) never hit this, since instance attributes take precedence.
+    """
+    def __init__(self, name: str):
+        self.name: str = name
+
+    def __get__(self, obj: Optional[TokenizerConfigEntry], objtype: Optional[type] = None) -> Any:
+        if obj is None:
+            return None
+        columns, idx = obj.__dict__['_lazy_source']
+        value = columns.get_lazy_field(self.name, idx)
+        obj.__dict__[self.name] = value
+        return value
+
+TokenizerConfigEntry.description = LazyTCEField('description') # type: ignore
+TokenizerConfigEntry.stats = LazyTCEField('stats') # type: ignore
+
 @dataclass()
 class CodeTCE(TokenizerConfigEntry):
     """A vanilla code token. 
@@ -195,18 +349,266 @@ class CategoricalTCE(TokenizerConfigEntry):
 # Tokenizer config helpers
 #
 #############################################
+TCE_TYPE_2_CLS: Dict[str, type] = { 'code' : CodeTCE, 'numerical_range' : NumericalRangeTCE, 'categorical' : CategoricalTCE }
+TCE_TYPES: List[str] = list(TCE_TYPE_2_CLS.keys())
+TCE_STAT_TYPE_2_CLS: Dict[str, type] = { 'count_occurrences' : CountOccurrencesTCEStat, 'count_patients' : CountPatientsTCEStat, 'ppl' : PPLTCEStat }
+
+def parse_tce_stats(raw_stats: List[Dict[str, Any]]) -> List[TCEStat]:
+    """Parse stat Dicts => TCEStat objects"""
+    stats: List[TCEStat] = []
+    for stat in raw_stats:
+        if stat['type'] not in TCE_STAT_TYPE_2_CLS:
+            raise ValueError(f"Unknown stat type: {stat}")
+        stats.append(TCE_STAT_TYPE_2_CLS[stat['type']](**stat))
+    return stats
+
+def encode_strings(strings: List[Optional[str]]) -> Dict[str, np.ndarray]:
+    """Encode a list of (nullable) strings as one UTF-8 blob + char offsets + null mask, so that it can be stored without pickling."""
+    is_null: np.ndarray = np.array([ x is None for x in strings ], dtype=bool)
+    strings = [ '' if x is None else x for x in strings ]
+    offsets: np.ndarray = np.zeros(len(strings) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([ len(x) for x in strings ])
+    return {
+        'blob' : np.frombuffer(''.join(strings).encode('utf-8'), dtype=np.uint8),
+        'offsets' : offsets,
+        'is_null' : is_null,
+    }
+
+def decode_strings(blob: np.ndarray, offsets: np.ndarray, is_null: np.ndarray) -> List[Optional[str]]:
+    """Inverse of `encode_strings()`"""
+    text: str = blob.tobytes().decode('utf-8')
+    starts: List[int] = offsets[:-1].tolist()
+    ends: List[int] = offsets[1:].tolist()
+    return [ None if null else text[start:end] for start, end, null in zip(starts, ends, is_null.tolist()) ]
+
+class TokenizerConfigColumns():
+    """
+        Columnar (NumPy-backed) version of a List[TokenizerConfigEntry], which is what gets stored in a binary `tokenizer_config.npz` file.
+        
+        Columns needed for tokenization (code, type, tokenization) are loaded eagerly. 
+        Columns in `lazy_fields` (description, stats) are only read + decoded the first time any entry accesses them (see `LazyTCEField`).
+        
+        NOTE: Lossless -- if an entry's `tokenization` doesn't fit the standard layout for its type 
+        (i.e. extra keys, or non-float ranges), then its `tokenization` is stored as JSON instead.
+    """
+    lazy_fields: Tuple[str, ...] = ('description', 'stats')
+    format_version: int = 1
+
+    def __init__(self, path_to_binary: str, excluded_fields: Optional[List[str]] = None):
+        self.path_to_binary: str = path_to_binary
+        self.excluded_fields: List[str] = list(excluded_fields) if excluded_fields else []
+        self.lazy_columns: Dict[str, List[Any]] = {} # [key] = field name, [value] = decoded column
+        with np.load(path_to_binary, allow_pickle=False) as npz:
+            self.header: Dict[str, Any] = json.loads(npz['header'].tobytes().decode('utf-8'))
+            assert self.header['format_version'] == self.format_version, f"ERROR - Unsupported `format_version` in `{path_to_binary}`: {self.header['format_version']}"
+            self.codes: List[str] = decode_strings(npz['codes__blob'], npz['codes__offsets'], npz['codes__is_null'])
+            self.units: List[Optional[str]] = decode_strings(npz['units__blob'], npz['units__offsets'], npz['units__is_null'])
+            self.categories: List[Optional[str]] = decode_strings(npz['categories__blob'], npz['categories__offsets'], npz['categories__is_null'])
+            self.tokenizations_json: List[Optional[str]] = decode_strings(npz['tokenizations_json__blob'], npz['tokenizations_json__offsets'], npz['tokenizations_json__is_null'])
+            self.code_idxs: List[int] = npz['code_idxs'].tolist() # [idx] = idx into `self.codes`
+            self.type_idxs: List[int] = npz['type_idxs'].tolist() # [idx] = idx into `TCE_TYPES`
+            self.unit_idxs: List[int] = npz['unit_idxs'].tolist() # [idx] = idx into `self.units`
+            self.range_starts: List[float] = npz['range_starts'].tolist()
+            self.range_ends: List[float] = npz['range_ends'].tolist()
+            self.category_offsets: List[int] = npz['category_offsets'].tolist() # entry `idx` has categories `self.categories[category_offsets[idx]:category_offsets[idx+1]]`
+
+    def __len__(self) -> int:
+        return len(self.code_idxs)
+
+    def get_metadata(self) -> Dict[str, Any]:
+        return self.header['metadata']
+
+    def get_lazy_field(self, name: str, idx: int) -> Any:
+        """Return the value of field `name` for entry `idx`, decoding its column on first access"""
+        if name in self.excluded_fields:
+            return None if name == 'description' else []
+        if name not in self.lazy_columns:
+            with np.load(self.path_to_binary, allow_pickle=False) as npz:
+                self.lazy_columns[name] = decode_strings(npz[f'{name}__blob'], npz[f'{name}__offsets'], npz[f'{name}__is_null'])
+        if name == 'stats':
+            return parse_tce_stats(json.loads(self.lazy_columns[name][idx]))
+        return self.lazy_columns[name][idx]
+
+    def to_entries(self) -> List[TokenizerConfigEntry]:
+        """Create a TokenizerConfigEntry per token. Fields in `lazy_fields` are NOT set, so they'll be fetched on first access via `LazyTCEField`."""
+        # NOTE: This is the hot loop when loading a tokenizer (1.5M+ tokens), so it skips dataclass __init__()
+        classes: List[type] = [ TCE_TYPE_2_CLS[x] for x in TCE_TYPES ]
+        codes, units, categories = self.codes, self.units, self.categories
+        entries: List[TokenizerConfigEntry] = []
+        # Pause garbage collection while allocating millions of objects -- otherwise, the GC's repeated scans take ~2/3 of the runtime
+        is_gc_enabled: bool = gc.isenabled()
+        gc.disable()
+        try:
+            for idx, (code_idx, type_idx, unit_idx, range_start, range_end, category_start, category_end, tokenization_json) in enumerate(zip(
+                self.code_idxs, self.type_idxs, self.unit_idxs, self.range_starts, self.range_ends, 
+                self.category_offsets[:-1], self.category_offsets[1:], self.tokenizations_json,
+            )):
+                if tokenization_json is not None:
+                    tokenization: Dict[str, Any] = json.loads(tokenization_json)
+                elif type_idx == 1: # TCE_TYPES[1] = 'numerical_range'
+                    tokenization = { 'unit' : units[unit_idx], 'range_start' : range_start, 'range_end' : range_end }
+                elif type_idx == 2: # TCE_TYPES[2] = 'categorical'
+                    tokenization = { 'categories' : categories[category_start:category_end] }
+                else:
+                    tokenization = {}
+                cls = classes[type_idx]
+                entry = cls.__new__(cls) # skip dataclass __init__() so that lazy fields stay unset
+                entry.__dict__ = { 'code' : codes[code_idx], 'type' : TCE_TYPES[type_idx], 'tokenization' : tokenization, '_lazy_source' : (self, idx) }
+                entries.append(entry)
+        finally:
+            if is_gc_enabled:
+                gc.enable()
+        return entries
+
+    @staticmethod
+    def save(path_to_binary: str, tokenizer_config: List[TokenizerConfigEntry], metadata: Optional[Dict] = None, source_stat: Optional[os.stat_result] = None) -> None:
+        """Write `tokenizer_config` to `path_to_binary` in the columnar format read by `TokenizerConfigColumns()`.
+            If `source_stat` is set, then record it so that we can detect if the source JSON file changes."""
+        codes: List[str] = sorted({ x.code for x in tokenizer_config })
+        code_2_idx: Dict[str, int] = { x: idx for idx, x in enumerate(codes) }
+        units: List[Optional[str]] = []
+        unit_2_idx: Dict[Optional[str], int] = {}
+        n: int = len(tokenizer_config)
+        unit_idxs: np.ndarray = np.full(n, -1, dtype=np.int32)
+        range_starts: np.ndarray = np.zeros(n, dtype=np.float64)
+        range_ends: np.ndarray = np.zeros(n, dtype=np.float64)
+        category_offsets: np.ndarray = np.zeros(n + 1, dtype=np.int64)
+        categories: List[str] = []
+        tokenizations_json: List[Optional[str]] = [ None ] * n
+        for idx, entry in enumerate(tokenizer_config):
+            t = entry.tokenization
+            if entry.type == 'code' and t == {}:
+                pass
+            elif (
+                entry.type == 'numerical_range' and list(t.keys()) == [ 'unit', 'range_start', 'range_end' ]
+                and (t['unit'] is None or isinstance(t['unit'], str))
+                and type(t['range_start']) is float and type(t['range_end']) is float
+            ):
+                if t['unit'] not in unit_2_idx:
+                    unit_2_idx[t['unit']] = len(units)
+                    units.append(t['unit'])
+                unit_idxs[idx] = unit_2_idx[t['unit']]
+                range_starts[idx] = t['range_start']
+                range_ends[idx] = t['range_end']
+            elif (
+                entry.type == 'categorical' and list(t.keys()) == [ 'categories' ] 
+                and isinstance(t['categories'], list) and all(isinstance(x, str) for x in t['categories'])
+            ):
+                categories.extend(t['categories'])
+            else:
+                # Non-standard `tokenization`, so fallback to JSON to stay lossless
+                tokenizations_json[idx] = json.dumps(t)
+            category_offsets[idx + 1] = len(categories)
+        
+        header: Dict[str, Any] = {
+            'format_version' : TokenizerConfigColumns.format_version,
+            'timestamp' : str(datetime.datetime.now().isoformat()),
+            'metadata' : metadata if metadata else {},
+            'source_mtime_ns' : source_stat.st_mtime_ns if source_stat is not None else None,
+            'source_size' : source_stat.st_size if source_stat is not None else None,
+        }
+        columns: Dict[str, np.ndarray] = {
+            'header' : np.frombuffer(json.dumps(header).encode('utf-8'), dtype=np.uint8),
+            'code_idxs' : np.array([ code_2_idx[x.code] for x in tokenizer_config ], dtype=np.int32),
+            'type_idxs' : np.array([ TCE_TYPES.index(x.type) for x in tokenizer_config ], dtype=np.int8),
+            'unit_idxs' : unit_idxs,
+            'range_starts' : range_starts,
+            'range_ends' : range_ends,
+            'category_offsets' : category_offsets,
+        }
+        for name, strings in [
+            ('codes', codes),
+            ('units', units),
+            ('categories', categories),
+            ('tokenizations_json', tokenizations_json),
+            ('description', [ x.description for x in tokenizer_config ]),
+            ('stats', [ json.dumps([ stat.to_dict() for stat in x.stats ]) for x in tokenizer_config ]),
+        ]:
+            for key, val in encode_strings(strings).items():
+                columns[f'{name}__{key}'] = val
+        # Write to a temp file unique to this process, then rename, so that concurrent readers never see a partial file
+        # and concurrent writers (e.g. every DDP rank converting on its first run) never write into each other's file
+        path_to_tmp: str = f"{path_to_binary}.tmp-{os.getpid()}"
+        try:
+            with open(path_to_tmp, 'wb') as fd:
+                np.savez(fd, **columns)
+            os.replace(path_to_tmp, path_to_binary)
+        finally:
+            if os.path.exists(path_to_tmp):
+                os.remove(path_to_tmp)
+
+def get_path_to_binary_tokenizer_config(path_to_tokenizer_config: str) -> str:
+    """Path to binary version of `tokenizer_config.json`, i.e. `tokenizer_config.npz`"""
+    return os.path.splitext(path_to_tokenizer_config)[0] + '.npz'
+
+def is_binary_tokenizer_config_fresh(path_to_tokenizer_config: str) -> bool:
+    """Return TRUE if `tokenizer_config.npz` exists and was created from the current version of `tokenizer_config.json`"""
+    path_to_binary: str = get_path_to_binary_tokenizer_config(path_to_tokenizer_config)
+    if not os.path.exists(path_to_binary):
+        return False
+    with np.load(path_to_binary, allow_pickle=False) as npz:
+        header: Dict[str, Any] = json.loads(npz['header'].tobytes().decode('utf-8'))
+    source_stat: os.stat_result = os.stat(path_to_tokenizer_config)
+    return (
+        header.get('format_version') == TokenizerConfigColumns.format_version
+        and header.get('source_mtime_ns') == source_stat.st_mtime_ns 
+        and header.get('source_size') == source_stat.st_size
+    )
+
+def convert_tokenizer_config_json_to_binary(path_to_tokenizer_config: str) -> str:
+    """Convert `tokenizer_config.json` => `tokenizer_config.npz` (losslessly). Returns path to `tokenizer_config.npz`."""
+    source_stat: os.stat_result = os.stat(path_to_tokenizer_config)
+    tokenizer_config, metadata = load_tokenizer_config_from_json(path_to_tokenizer_config)
+    path_to_binary: str = get_path_to_binary_tokenizer_config(path_to_tokenizer_config)
+    TokenizerConfigColumns.save(path_to_binary, tokenizer_config, metadata, source_stat=source_stat)
+    return path_to_binary
+
 def save_tokenizer_config_to_path(path_to_tokenizer_config: str, tokenizer_config: List[TokenizerConfigEntry], metadata: Optional[Dict] = None) -> None:
-    """Given a path to a `tokenizer_config.json` file, saves the JSON config to disk."""
+    """Given a path to a `tokenizer_config.json` file, saves the JSON config to disk. If the path ends in `.npz`, then saves the binary config instead."""
+    if path_to_tokenizer_config.endswith('.npz'):
+        TokenizerConfigColumns.save(path_to_tokenizer_config, tokenizer_config, metadata)
+        return
     json.dump({
         'timestamp' : str(datetime.datetime.now().isoformat()),
         'metadata' : metadata if metadata else {},
         'tokens' : [ x.to_dict() for x in tokenizer_config ], # NOTE: Takes ~30 seconds for 1.5M tokens
     }, open(path_to_tokenizer_config, 'w'), indent=2) # NOTE: Saving takes a few minutes
 
-def load_tokenizer_config_and_metadata_from_path(path_to_tokenizer_config: str) -> Tuple[List[TokenizerConfigEntry], Dict[str, Any]]:
-    return load_tokenizer_config_from_path(path_to_tokenizer_config, is_return_metadata=True) # type: ignore
+def load_tokenizer_config_and_metadata_from_path(path_to_tokenizer_config: str, excluded_fields: Optional[List[str]] = None) -> Tuple[List[TokenizerConfigEntry], Dict[str, Any]]:
+    return load_tokenizer_config_from_path(path_to_tokenizer_config, is_return_metadata=True, excluded_fields=excluded_fields) # type: ignore
+
+def load_tokenizer_config_from_path(path_to_tokenizer_config: str, 
+                                    is_return_metadata: bool = False, 
+                                    excluded_fields: Optional[List[str]] = None) -> Union[List[TokenizerConfigEntry], Tuple[List[TokenizerConfigEntry], Dict[str, Any]]]:
+    """
+        Given a path to a `tokenizer_config.json` file, loads the config and parses into Python objects.
+        
+        If an up-to-date binary version of the config (`tokenizer_config.npz`) exists next to the JSON file, then load that instead (much faster).
+        Otherwise, load the JSON and try to write `tokenizer_config.npz` for next time.
+            `excluded_fields` -- fields in `TokenizerConfigColumns.lazy_fields` (i.e. 'description', 'stats') to never load; 
+                these will be set to None / [] (only applies to binary configs)
+    """
+    path_to_binary: str = get_path_to_binary_tokenizer_config(path_to_tokenizer_config)
+    is_binary_usable: bool = path_to_tokenizer_config.endswith('.npz') or (
+        os.path.exists(path_to_binary) 
+        and (not os.path.exists(path_to_tokenizer_config) or is_binary_tokenizer_config_fresh(path_to_tokenizer_config))
+    )
+    if not is_binary_usable:
+        try:
+            convert_tokenizer_config_json_to_binary(path_to_tokenizer_config)
+        except OSError as e:
+            # e.g. read-only directory -- fallback to JSON
+            logger.warning(f"Could not write binary tokenizer config to `{path_to_binary}`, so loading from JSON instead: {e}")
+            config, raw_metadata = load_tokenizer_config_from_json(path_to_tokenizer_config)
+            return (config, raw_metadata) if is_return_metadata else config
+    columns: TokenizerConfigColumns = TokenizerConfigColumns(path_to_binary, excluded_fields=excluded_fields)
+    config: List[TokenizerConfigEntry] = columns.to_entries()
+    if is_return_metadata:
+        return config, columns.get_metadata()
+    else:
+        return config
 
-def load_tokenizer_config_from_path(path_to_tokenizer_config: str, is_return_metadata: bool = False) -> Union[List[TokenizerConfigEntry], Tuple[List[TokenizerConfigEntry], Dict[str, Any]]]:
+def load_tokenizer_config_from_json(path_to_tokenizer_config: str) -> Tuple[List[TokenizerConfigEntry], Dict[str, Any]]:
     """Given a path to a `tokenizer_config.json` file, loads the JSON config and parses into Python objects."""
     raw_data = json.load(open(path_to_tokenizer_config, 'r'))
     raw_metadata: Dict[str, Any] = raw_data['metadata']
@@ -215,29 +617,11 @@ def load_tokenizer_config_from_path(path_to_tokenizer_config: str, is_return_met
     # Parse token Dict => TokenizerConfigEntry objects
     config: List[TokenizerConfigEntry] = []
     for entry in raw_tokens:
-        raw_stats = entry.pop('stats')
-        stats: List[TCEStat] = []
-        for stat in raw_stats:
-            if stat['type'] == 'count_occurrences':
-                stats.append(CountOccurrencesTCEStat(**stat))
-            elif stat['type'] == 'count_patients':
-                stats.append(CountPatientsTCEStat(**stat))
-            elif stat['type'] == 'ppl':
-                stats.append(PPLTCEStat(**stat))
-            else:
-                raise ValueError(f"Unknown stat type: {stat}")
-        if entry['type'] == 'code':
-            config.append(CodeTCE(**entry, stats=stats))
-        elif entry['type'] == 'numerical_range':
-            config.append(NumericalRangeTCE(**entry, stats=stats))
-        elif entry['type'] == 'categorical':
-            config.append(CategoricalTCE(**entry, stats=stats))
-        else:
+        stats: List[TCEStat] = parse_tce_stats(entry.pop('stats'))
+        if entry['type'] not in TCE_TYPE_2_CLS:
             raise ValueError(f"Unknown token type: {entry}")
-    if is_return_metadata:
-        return config, raw_metadata
-    else:
-        return config
+        config.append(TCE_TYPE_2_CLS[entry['type']](**entry, stats=stats))
+    return config, raw_metadata
 
 #############################################
 #
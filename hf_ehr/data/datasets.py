@@ -1,15 +1,67 @@
 import os
+import json
+import datetime
 from tqdm import tqdm
 import numpy as np
 import femr.datasets
-from typing import Dict, List, Tuple
-from torch.utils.data import Dataset
-from hf_ehr.config import Event, SPLIT_TRAIN_CUTOFF, SPLIT_VAL_CUTOFF, SPLIT_SEED
-from hf_ehr.data.tokenization import DescTokenizer
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
+from typing import Any, Callable, Deque, Dict, Generator, Iterable, List, Optional, Tuple, Union
+import torch
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+from hf_ehr.config import Timeline, SPLIT_TRAIN_CUTOFF, SPLIT_VAL_CUTOFF, SPLIT_SEED
+from hf_ehr.data.tokenization import DescTokenizer, is_metadata_equal
 
 class BaseDataset(Dataset):
     pass
 
+class TimelinePrefetcher():
+    """
+        Reads examples ahead of time on a thread pool, so that I/O latency (i.e. fetching patients from an extract on shared storage)
+        overlaps with tokenization / collation rather than stalling it.
+        Given the upcoming order of idxs, `prefetcher(idxs)` yields `read_fn(idx)` for each idx (in order), keeping a bounded queue 
+        of up to `max_queue_size` reads that are either in flight or decoded and ready.
+        NOTE: Each DataLoader worker gets its own thread pool (created lazily, since thread pools can't be pickled or forked)
+    """
+    def __init__(self, read_fn: Callable[[int], Any], n_threads: int = 4, max_queue_size: int = 64):
+        assert n_threads > 0, f"ERROR - `n_threads` must be > 0, but got {n_threads}"
+        assert max_queue_size > 0, f"ERROR - `max_queue_size` must be > 0, but got {max_queue_size}"
+        self.read_fn: Callable[[int], Any] = read_fn
+        self.n_threads: int = n_threads
+        self.max_queue_size: int = max_queue_size
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.executor_pid: Optional[int] = None # pid of the process that created `self.executor`
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Don't pickle the thread pool -- each worker creates its own in `get_executor()`
+        state: Dict[str, Any] = self.__dict__.copy()
+        state['executor'] = None
+        state['executor_pid'] = None
+        return state
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        # Threads aren't copied into forked DataLoader workers, so a forked worker needs to create its own thread pool
+        if self.executor is None or self.executor_pid != os.getpid():
+            self.executor = ThreadPoolExecutor(max_workers=self.n_threads, thread_name_prefix='TimelinePrefetcher')
+            self.executor_pid = os.getpid()
+        return self.executor
+
+    def __call__(self, idxs: Iterable[int]) -> Generator[Any, None, None]:
+        executor: ThreadPoolExecutor = self.get_executor()
+        queue: Deque[Future] = deque()
+        try:
+            for idx in idxs:
+                queue.append(executor.submit(self.read_fn, idx))
+                if len(queue) >= self.max_queue_size:
+                    yield queue.popleft().result()
+            while len(queue) > 0:
+                yield queue.popleft().result()
+        finally:
+            # If we stop early (e.g. end of epoch), then don't bother with reads that haven't started yet
+            for future in queue:
+                future.cancel()
+
 class MEDSDataset(BaseDataset):
     """Dataset that returns patients in a MEDS dataset (after it has been converted to a MEDSReader extract).
         dataset[idx] = a specific patient, so you can only retrieve ONE sample per patient.
@@ -18,7 +70,9 @@ class MEDSDataset(BaseDataset):
                  path_to_meds_reader_extract: str,
                  split: str = 'train',
                  is_debug: bool = False,
-                 seed: int = 1):
+                 seed: int = 1,
+                 n_prefetch_threads: int = 0,
+                 prefetch_queue_size: int = 64):
         import polars as pl
         import meds_reader
         assert os.path.exists(path_to_meds_reader_extract), f"{path_to_meds_reader_extract} is not a valid path"
@@ -39,6 +93,10 @@ class MEDSDataset(BaseDataset):
             'seed' : seed,
         }
 
+        # ! Keep out of `metadata` b/c it doesn't affect the contents of the dataset
+        # If set, then `__getitems__()` / `iter_examples()` read patients ahead of time on a pool of `n_prefetch_threads` threads
+        self.prefetcher: Optional[TimelinePrefetcher] = TimelinePrefetcher(self.get_timeline, n_prefetch_threads, prefetch_queue_size) if n_prefetch_threads > 0 else None
+
         # Pre-calculate canonical splits based on patient ids
         splits = pl.read_parquet(os.path.join(path_to_meds_reader_extract, 'metadata', 'subject_splits.parquet'))
         self.train_pids = splits.filter(pl.col('split') == 'train').select('subject_id').to_series().to_numpy()
@@ -74,8 +132,9 @@ class MEDSDataset(BaseDataset):
     def __len__(self) -> int:
         return len(self.get_pids())
     
-    def __getitem__(self, idx: int) -> Tuple[int, List[Event]]:
+    def get_timeline(self, idx: int) -> Tuple[int, Timeline]:
         """Return all event codes for this patient at `idx` in `self.split`.
+            NOTE: Only reads from the extract, so it can be called from `self.prefetcher`'s threads
         """
         pids: np.ndarray = self.get_pids()
         pid: int = pids[idx]
@@ -85,17 +144,99 @@ class MEDSDataset(BaseDataset):
             pid = pid[0]
 
         # Get data for each clinical event in patient timeline
-        events: List[Event] = [
-            Event(code=e.code,
-                  value=getattr(e, "numeric_value", None) or getattr(e, "text_value", None),
-                  unit=e.unit,
-                  start=e.time,
-                  end=getattr(e, 'end', None),
-                  omop_table=getattr(e, 'omop_table', None),
-            )
-            for e in self.meds_db[pid].events
-        ]
-        return (pid, events)
+        events: List[Any] = list(self.meds_db[pid].events)
+        timeline: Timeline = Timeline.from_columns(
+            codes=[ e.code for e in events ],
+            values=[ getattr(e, "numeric_value", None) or getattr(e, "text_value", None) for e in events ],
+            units=[ e.unit for e in events ],
+            starts=[ e.time for e in events ],
+            ends=[ getattr(e, 'end', None) for e in events ],
+            omop_tables=[ getattr(e, 'omop_table', None) for e in events ],
+        )
+        return (pid, timeline)
+
+    def __getitem__(self, idx: int) -> Tuple[int, Timeline]:
+        return self.get_timeline(idx)
+
+    def iter_examples(self, idxs: Iterable[int]) -> Generator[Tuple[int, Timeline], None, None]:
+        """Yield `self[idx]` for each idx in `idxs` (in order). If `self.prefetcher` is set, then reads ahead of time on its thread pool"""
+        if self.prefetcher is None:
+            return ( self[idx] for idx in idxs )
+        return self.prefetcher(idxs)
+
+    def __getitems__(self, idxs: List[int]) -> List[Tuple[int, Timeline]]:
+        """Called by the DataLoader with all idxs in a batch, so we can fetch the whole batch in parallel"""
+        return list(self.iter_examples(idxs))
+
+# Cache of (all_pids, hashed_pids) for each FEMR extract, shared by all FEMRDatasets (i.e. train/val/test) in this process
+_femr_split_hashes_cache: Dict[Tuple[str, int], Tuple[np.ndarray, np.ndarray]] = {}
+
+def get_path_to_femr_split_hashes(path_to_femr_extract: str, split_seed: int = SPLIT_SEED) -> str:
+    """Example path: /share/pi/nigam/data/som-rit-phi-starr-prod.starr_omop_cdm5_deid_2023_02_08_extract_v8/split_hashes_seed=97.npy"""
+    return os.path.join(path_to_femr_extract, f'split_hashes_seed={split_seed}.npy')
+
+def get_femr_split_hashes(femr_db: 'femr.datasets.PatientDatabase', path_to_femr_extract: str, split_seed: int = SPLIT_SEED) -> Tuple[np.ndarray, np.ndarray]:
+    """
+        Return (all_pids, hashed_pids), where `hashed_pids[i] = femr_db.compute_split(split_seed, all_pids[i])` is in [0, 100).
+
+        Calling `compute_split()` on every patient takes ~8s per dataset, so we only do it once per extract + seed, 
+        then save the result as an int64 array of shape (2, n_patients) next to the extract (and in memory for this process).
+        Split cutoffs (i.e. SPLIT_TRAIN_CUTOFF / SPLIT_VAL_CUTOFF) are applied to `hashed_pids` by the caller, so changing them doesn't invalidate the cache.
+    """
+    key: Tuple[str, int] = (os.path.abspath(path_to_femr_extract), split_seed)
+    if key in _femr_split_hashes_cache:
+        return _femr_split_hashes_cache[key]
+    
+    n_patients: int = len(femr_db)
+    path_to_split_hashes: str = get_path_to_femr_split_hashes(path_to_femr_extract, split_seed)
+    split_hashes: Optional[np.ndarray] = None
+    if os.path.exists(path_to_split_hashes):
+        split_hashes = np.load(path_to_split_hashes)
+        if split_hashes.shape != (2, n_patients):
+            # Extract was modified since the cache was created, so recompute
+            split_hashes = None
+    if split_hashes is None:
+        all_pids: np.ndarray = np.fromiter(femr_db, dtype=np.int64, count=n_patients)
+        hashed_pids: np.ndarray = np.fromiter(( femr_db.compute_split(split_seed, pid) for pid in all_pids.tolist() ), dtype=np.int64, count=n_patients)
+        split_hashes = np.stack([ all_pids, hashed_pids ])
+        try:
+            path_to_tmp: str = f"{path_to_split_hashes}.tmp-{os.getpid()}.npy"
+            np.save(path_to_tmp, split_hashes)
+            os.replace(path_to_tmp, path_to_split_hashes)
+        except OSError as e:
+            # e.g. read-only extract
+            print(f"Could not save split hashes to `{path_to_split_hashes}`: {e}")
+    
+    _femr_split_hashes_cache[key] = (split_hashes[0], split_hashes[1])
+    return _femr_split_hashes_cache[key]
+
+def get_path_to_n_events_per_patient(dataset: Union['FEMRDataset', 'MEDSDataset']) -> str:
+    """Example path: /share/pi/nigam/data/som-rit-phi-starr-prod.starr_omop_cdm5_deid_2023_02_08_extract_v8/n_events_per_patient_split=train_n=2500000.npy"""
+    path_to_extract: str = getattr(dataset, 'path_to_femr_extract', None) or dataset.path_to_meds_reader_extract
+    return os.path.join(path_to_extract, f'n_events_per_patient_split={dataset.split}_n={dataset.get_n_patients()}.npy')
+
+def get_n_events_per_patient(dataset: Union['FEMRDataset', 'MEDSDataset']) -> np.ndarray:
+    """
+        Return the # of events in each patient's timeline in `dataset` (in order). 
+        This is a tokenizer-independent proxy for each patient's sequence length, so it can be shared by all tokenizers.
+
+        Requires reading every patient once, so we save the result as an int64 array of shape (2, n_patients) of (pid, n_events) next to the extract.
+    """
+    pids: np.ndarray = np.asarray(dataset.get_pids(), dtype=np.int64)
+    path_to_n_events: str = get_path_to_n_events_per_patient(dataset)
+    if os.path.exists(path_to_n_events):
+        n_events_per_patient: np.ndarray = np.load(path_to_n_events)
+        if n_events_per_patient.shape == (2, len(pids)) and np.array_equal(n_events_per_patient[0], pids):
+            return n_events_per_patient[1]
+    n_events: np.ndarray = np.fromiter(( len(events) for (pid, events) in tqdm(dataset.iter_examples(range(len(pids))), total=len(pids), desc=f'Counting events per patient for split=`{dataset.split}`') ), dtype=np.int64, count=len(pids))
+    try:
+        path_to_tmp: str = f"{path_to_n_events}.tmp-{os.getpid()}.npy"
+        np.save(path_to_tmp, np.stack([ pids, n_events ]))
+        os.replace(path_to_tmp, path_to_n_events)
+    except OSError as e:
+        # e.g. read-only extract
+        print(f"Could not save # of events per patient to `{path_to_n_events}`: {e}")
+    return n_events
 
 class FEMRDataset(BaseDataset):
     """Dataset that returns patients in a FEMR extract.
@@ -106,7 +247,9 @@ class FEMRDataset(BaseDataset):
                  path_to_femr_extract: str, 
                  split: str = 'train',
                  is_debug: bool = False,
-                 seed: int = 1):
+                 seed: int = 1,
+                 n_prefetch_threads: int = 0,
+                 prefetch_queue_size: int = 64):
         assert os.path.exists(path_to_femr_extract), f"{path_to_femr_extract} is not a valid path"
         assert split in ['train', 'val', 'test'], f"{split} not in ['train', 'val', 'test']"
         self.path_to_femr_extract: str = path_to_femr_extract
@@ -125,9 +268,12 @@ class FEMRDataset(BaseDataset):
             'seed' : seed,
         }
 
+        # ! Keep out of `metadata` b/c it doesn't affect the contents of the dataset
+        # If set, then `__getitems__()` / `iter_examples()` read patients ahead of time on a pool of `n_prefetch_threads` threads
+        self.prefetcher: Optional[TimelinePrefetcher] = TimelinePrefetcher(self.get_timeline, n_prefetch_threads, prefetch_queue_size) if n_prefetch_threads > 0 else None
+
         # Pre-calculate canonical splits based on patient ids
-        all_pids: np.ndarray = np.array([ pid for pid in self.femr_db ])
-        hashed_pids: np.ndarray = np.array([ self.femr_db.compute_split(SPLIT_SEED, pid) for pid in all_pids ])
+        all_pids, hashed_pids = get_femr_split_hashes(self.femr_db, path_to_femr_extract)
         self.train_pids: np.ndarray = all_pids[np.where(hashed_pids < SPLIT_TRAIN_CUTOFF)[0]]
         self.val_pids: np.ndarray = all_pids[np.where((SPLIT_TRAIN_CUTOFF <= hashed_pids) & (hashed_pids < SPLIT_VAL_CUTOFF))[0]]
         self.test_pids: np.ndarray = all_pids[np.where(hashed_pids >= SPLIT_VAL_CUTOFF)[0]]
@@ -161,8 +307,9 @@ class FEMRDataset(BaseDataset):
     def __len__(self) -> int:
         return len(self.get_pids())
     
-    def __getitem__(self, idx: int) -> Tuple[int, List[Event]]:
+    def get_timeline(self, idx: int) -> Tuple[int, Timeline]:
         """Return all event codes for this patient at `idx` in `self.split`.
+            NOTE: Only reads from the extract, so it can be called from `self.prefetcher`'s threads
         """
         pids: np.ndarray = self.get_pids()
         pid: int = pids[idx]
@@ -172,23 +319,102 @@ class FEMRDataset(BaseDataset):
             pid = pid[0]
 
         # Get data for each clinical event in patient timeline
-        events: List[Event] = [
-            Event(code=e.code, value=e.value, unit=e.unit, start=e.start, end=e.end, omop_table=e.omop_table)
-            for e in self.femr_db[pid].events
-        ]
+        timeline: Timeline = Timeline.from_events(self.femr_db[pid].events)
         # print("Time to fetch events: ", time.time() - start)
-        return (pid, events)
+        return (pid, timeline)
+
+    def __getitem__(self, idx: int) -> Tuple[int, Timeline]:
+        return self.get_timeline(idx)
+
+    def iter_examples(self, idxs: Iterable[int]) -> Generator[Tuple[int, Timeline], None, None]:
+        """Yield `self[idx]` for each idx in `idxs` (in order). If `self.prefetcher` is set, then reads ahead of time on its thread pool"""
+        if self.prefetcher is None:
+            return ( self[idx] for idx in idxs )
+        return self.prefetcher(idxs)
+
+    def __getitems__(self, idxs: List[int]) -> List[Tuple[int, Timeline]]:
+        """Called by the DataLoader with all idxs in a batch, so we can fetch the whole batch in parallel"""
+        return list(self.iter_examples(idxs))
+
+class LRUCache():
+    """
+        Least-recently-used cache with a memory budget (in bytes). All operations are O(1).
+        `sizeof(value)` returns the (approximate) number of bytes used by `value` -- defaults to `value.nbytes` (i.e. NumPy arrays).
+        Tracks `n_hits` and `n_misses`, so you can check how well your sampling order is reusing cached values.
+        NOTE: Each DataLoader worker gets its own copy of this cache, so total memory usage is `max_bytes * n_workers`
+    """
+    def __init__(self, max_bytes: int, sizeof: Optional[Callable[[Any], int]] = None) -> None:
+        assert max_bytes >= 0, f"ERROR - `max_bytes` must be >= 0, but got {max_bytes}"
+        self.max_bytes: int = max_bytes
+        self.sizeof: Callable[[Any], int] = sizeof if sizeof is not None else (lambda x: x.nbytes)
+        self.n_bytes: int = 0
+        self.n_hits: int = 0
+        self.n_misses: int = 0
+        self.data: OrderedDict = OrderedDict() # [key] = key; [value] = (value, n_bytes); ordered from least => most recently used
+    
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self.data
+    
+    def get(self, key: Any) -> Optional[Any]:
+        """Return value for `key` (and mark it as most recently used), or None if not in cache"""
+        if key not in self.data:
+            self.n_misses += 1
+            return None
+        self.n_hits += 1
+        self.data.move_to_end(key)
+        return self.data[key][0]
+
+    def put(self, key: Any, value: Any) -> None:
+        """Add `value` to cache, then evict least recently used values until we're under `self.max_bytes`"""
+        n_bytes: int = self.sizeof(value)
+        if key in self.data:
+            self.n_bytes -= self.data.pop(key)[1]
+        if n_bytes > self.max_bytes:
+            # Value is bigger than the whole cache, so don't bother caching it
+            return
+        self.data[key] = (value, n_bytes)
+        self.n_bytes += n_bytes
+        while self.n_bytes > self.max_bytes:
+            self.n_bytes -= self.data.popitem(last=False)[1][1]
+    
+    def clear(self) -> None:
+        self.data.clear()
+        self.n_bytes = 0
+    
+    def get_hit_rate(self) -> float:
+        return self.n_hits / max(1, self.n_hits + self.n_misses)
+
+def get_n_bytes_of_cached_timeline(value: Tuple[int, Union[Timeline, np.ndarray]]) -> int:
+    """Approximate memory footprint of a cached (pid, timeline) or (pid, token_ids) tuple -- a List[Event] takes ~250 bytes per Event"""
+    if isinstance(value[1], (np.ndarray, Timeline)):
+        return value[1].nbytes
+    return 256 * len(value[1])
 
 class AllTokensFEMRDataset(FEMRDataset):
     """
         Wrapper around FEMRDataset that returns all tokens in the dataset.
         dataset[idx] = a specific sequence of tokens, so you can retrieve MULTIPLE samples per patient.
         Requires you to know (a) the tokenizer up front and (b) max_length per example, so that it knows how much to chunk each patient by.
+
+        If `is_return_token_ids`, then dataset[idx] = (pid, np.ndarray of token ids) rather than (pid, Timeline).
+            Each patient's timeline is converted to token ids ONCE (then cached), and each example is a direct slice of those token ids,
+            so the collator doesn't need to re-tokenize. This is also the only mode that chunks correctly for tokenizers that insert 
+            extra tokens between events (i.e. CEHRTokenizer's visit / ATT tokens), since it doesn't assume that 1 Event = 1 token.
+
+        If `n_shards > 1`, then this dataset only holds the examples of its shard of patients (i.e. every `n_shards`-th patient, starting at `shard_rank`),
+            so that each GPU's process only stores (and caches) its own examples rather than the full dataset.
     """
     def __init__(self, 
                  tokenizer, 
                  max_length: int,
                  *args, 
+                 cache_max_bytes: int = 512 * 1024**2,
+                 is_return_token_ids: bool = False,
+                 shard_rank: int = 0,
+                 n_shards: int = 1,
                  **kwargs):
         super().__init__(*args, **kwargs)
         if isinstance(tokenizer, DescTokenizer):
@@ -202,63 +428,379 @@ class AllTokensFEMRDataset(FEMRDataset):
         
         # ! Keep out of `metadata` b/c we want to treat all versions of the AllTokensDataset the same regardless of their `max_length`
         self.max_length: int = max_length # data.dataloader.max_length -- max length of a single sequence
+        # ! Keep out of `metadata` b/c it doesn't affect the number of tokens per patient
+        self.is_return_token_ids: bool = is_return_token_ids
+
+        # ! Keep out of `metadata` b/c it only determines which examples this process sees, not the tokens per patient
+        self.shard_rank: int = shard_rank # if `n_shards > 1`, then only keep the examples of every `n_shards`-th patient, starting at `shard_rank`
+        self.n_shards: int = n_shards
+        assert 0 <= shard_rank < n_shards, f"ERROR - `shard_rank` ({shard_rank}) must be in [0, `n_shards` ({n_shards}))"
 
         # Number of tokens per patient timeline
-        self.seq_length_per_patient: List[int] = tokenizer.get_seq_length_per_patient(self, n_procs=5)
+        # NOTE: Index structures are NumPy arrays rather than Python lists of ints / tuples, which take ~5-10x more memory for millions of examples
+        self.seq_length_per_patient: np.ndarray = np.asarray(tokenizer.get_seq_length_per_patient(self, n_procs=5), dtype=np.int64)
         # Number of unique examples that will be extracted per patient by truncating their timeline to `max_length` tokens
-        self.n_examples_per_patient: List[int] = [ int(np.ceil(seq_length / max_length)) for seq_length in self.seq_length_per_patient ]
+        self.n_examples_per_patient: np.ndarray = -(-self.seq_length_per_patient // max_length) # ceil(seq_length / max_length)
+
+        # Patients that belong to this shard
+        p_idxs: np.ndarray = np.arange(self.seq_length_per_patient.shape[0], dtype=np.int64)
+        n_examples: int = int(self.n_examples_per_patient.sum())
+        if n_shards > 1:
+            # Every shard keeps the same # of examples (i.e. the smallest shard's), so that every rank runs the same # of batches
+            # NOTE: Computed from `seq_length_per_patient`, which every rank has, so no need to communicate across ranks
+            n_examples = int(np.bincount(p_idxs % n_shards, weights=self.n_examples_per_patient, minlength=n_shards).min())
+            p_idxs = p_idxs[shard_rank::n_shards]
 
         # Map [idx] => (p_idx, start idx in p_idx's timeline, end idx in p_idx's timeline)
-        self.idx_to_pidx_start_end: List[Tuple[int, int, int]] = [
-            (p_idx, i * max_length, min((i + 1) * max_length, self.seq_length_per_patient[p_idx]))
-            for p_idx, n_examples in enumerate(self.n_examples_per_patient)
-            for i in range(n_examples)
-        ]
-        assert len(self.idx_to_pidx_start_end) == sum(self.n_examples_per_patient), f"{len(self.idx_to_pidx_start_end)} != {sum(self.n_examples_per_patient)}"
+        n_examples_per_p_idx: np.ndarray = self.n_examples_per_patient[p_idxs]
+        example_p_idxs: np.ndarray = np.repeat(p_idxs, n_examples_per_p_idx)
+        example_offsets: np.ndarray = np.arange(example_p_idxs.shape[0], dtype=np.int64) - np.repeat(np.cumsum(n_examples_per_p_idx) - n_examples_per_p_idx, n_examples_per_p_idx)
+        starts: np.ndarray = example_offsets * max_length
+        ends: np.ndarray = np.minimum(starts + max_length, self.seq_length_per_patient[example_p_idxs])
+        self.idx_to_pidx_start_end: np.ndarray = np.stack([ example_p_idxs, starts, ends ], axis=1)[:n_examples] # shape = (n_examples, 3)
+        assert self.idx_to_pidx_start_end.shape[0] == n_examples, f"{self.idx_to_pidx_start_end.shape[0]} != {n_examples}"
         # Number of tokens per example in this dataset
-        self.idx_to_seq_length: List[int] = [ end - start for (p_idx, start, end) in self.idx_to_pidx_start_end ]
+        self.idx_to_seq_length: np.ndarray = (self.idx_to_pidx_start_end[:, 2] - self.idx_to_pidx_start_end[:, 1]).astype(np.int32)
 
-        self.cache: Dict[int, Tuple[int, int, List[Event]]] = {} # Cache for last 1000 patients' timelines; [key] = p_idx, [value] = Tuple[idx, pid, events]
+        # ! Keep out of `metadata` b/c it doesn't affect the contents of the dataset
+        # Cache of most recently used patients' timelines; [key] = p_idx, [value] = Tuple[pid, events] or Tuple[pid, token_ids] (if `is_return_token_ids`)
+        # NOTE: Sorting examples by `p_idx` (i.e. `secondary_sort_key` in `load_dataloaders()`) keeps a patient's subsequences adjacent, which maximizes cache hits
+        self.cache: LRUCache = LRUCache(cache_max_bytes, sizeof=get_n_bytes_of_cached_timeline)
 
     def __len__(self) -> int:
         return len(self.idx_to_pidx_start_end)
     
-    def __getitem__(self, idx: int) -> Tuple[int, List[Event]]:
+    def __getstate__(self) -> Dict[str, Any]:
+        # Don't copy cached timelines into DataLoader workers
+        state: Dict[str, Any] = self.__dict__.copy()
+        state['cache'] = LRUCache(self.cache.max_bytes, sizeof=get_n_bytes_of_cached_timeline)
+        return state
+
+    def __getitem__(self, idx: int) -> Tuple[int, Union[Timeline, np.ndarray]]:
         """
-            Return all event codes for this example at `idx` in `self.split`.
+            Return all event codes (or token ids, if `self.is_return_token_ids`) for this example at `idx` in `self.split`.
             Maps this `idx` to the proper subsequence of events in this patient's timeline.
                 Returns `start_token_idx` and `end_token_idx` to indicate the start and end of 
                 the subsequence within this patient's timeline that corresponds to `idx` in our dataset
             
-            ! NOTE: This relies on the assumption that there is a one-to-one map between Event => Token;
+            ! NOTE: If returning events, this relies on the assumption that there is a one-to-one map between Event => Token;
                 otherwise the indexing will be incorrect
         """
-        (p_idx, start_token_idx, end_token_idx) = self.idx_to_pidx_start_end[idx]
+        (p_idx, start_token_idx, end_token_idx) = self.idx_to_pidx_start_end[idx].tolist()
     
         # Cache hit
-        if p_idx in self.cache:
-            pid: int = self.cache[p_idx][1]
-            tokenizable_events: List[Event] = self.cache[p_idx][2][start_token_idx:end_token_idx]
-            return (pid, tokenizable_events)
-        
-        # Cache miss
-        (pid, events) = super().__getitem__(p_idx) # Fetch all events for this patient
-        # Filter out events that don't have a corresponding token, then return the subsequence
-        tokenizable_events: List[Event] = []
-        idx: int = 0
-        while idx < len(events):
-            if self.tokenizer.convert_event_to_token(events[idx]) is not None:
-                tokenizable_events.append(events[idx])
-            idx += 1
+        cached: Optional[Tuple[int, Union[Timeline, np.ndarray]]] = self.cache.get(p_idx)
+        if cached is None:
+            # Cache miss
+            cached = self.put_timeline(p_idx, *self.get_timeline(p_idx)) # Fetch all events for this patient
+        (pid, timeline) = cached
+        return (pid, timeline[start_token_idx:end_token_idx])
+
+    def put_timeline(self, p_idx: int, pid: int, events: Timeline) -> Tuple[int, Union[Timeline, np.ndarray]]:
+        """Convert this patient's `events` into the timeline that we slice examples from, then add it to the cache"""
+        if self.is_return_token_ids:
+            # Convert to token ids
+            timeline: np.ndarray = np.array(self.tokenizer.convert_events_to_token_ids(events), dtype=np.int32)
+        else:
+            # Filter out events that don't have a corresponding token
+            timeline: Timeline = self.tokenizer.convert_events_to_tokenized_events(events)
         
         # Update cache
-        self.cache[p_idx] = (idx, pid, tokenizable_events)
-        if len(self.cache) > 1_000:
-            # Find minimal `idx` in cache, then delete it
-            min_p_idx: int = min(self.cache, key=lambda x: self.cache[x][0])
-            del self.cache[min_p_idx]
+        self.cache.put(p_idx, (pid, timeline))
+        return (pid, timeline)
+
+    def iter_examples(self, idxs: Iterable[int]) -> Generator[Tuple[int, Union[Timeline, np.ndarray]], None, None]:
+        """Yield `self[idx]` for each idx in `idxs` (in order). If `self.prefetcher` is set, then reads ahead of time on its thread pool"""
+        idxs = iter(idxs)
+        chunk_size: int = self.prefetcher.max_queue_size if self.prefetcher is not None else 1
+        while chunk := list(islice(idxs, chunk_size)):
+            yield from self.__getitems__(chunk)
+
+    def __getitems__(self, idxs: List[int]) -> List[Tuple[int, Union[Timeline, np.ndarray]]]:
+        """Called by the DataLoader with all idxs in a batch, so we can fetch all patients in the batch in parallel"""
+        if self.prefetcher is not None:
+            # Fetch the patients that aren't cached yet in parallel (each patient only once)
+            # NOTE: Use `in` rather than `self.cache.get()` so that this doesn't count towards the cache's hit rate
+            p_idxs: List[int] = [ p_idx for p_idx in dict.fromkeys(self.idx_to_pidx_start_end[idxs, 0].tolist()) if p_idx not in self.cache ]
+            for p_idx, (pid, events) in zip(p_idxs, self.prefetcher(p_idxs)):
+                self.put_timeline(p_idx, pid, events)
+        return [ self[idx] for idx in idxs ]
+
+def materialize_token_store(tokenizer, dataset: BaseDataset, path_to_token_store_dir: str) -> None:
+    """
+        Tokenize every patient in `dataset` ONCE, and write the results to flat files in `path_to_token_store_dir`:
+            - `token_ids.bin`: int32 -- token ids of all patients, concatenated
+            - `token_times.bin`: int64 -- timestamp (seconds since epoch) of each token in `token_ids.bin`
+            - `offsets.npy`: int64 -- [idx] = start of patient `idx` in `token_ids.bin`, so patient `idx` = `token_ids[offsets[idx]:offsets[idx+1]]`
+            - `pids.npy`: int64 -- [idx] = pid of patient `idx`
+        NOTE: Special tokens (i.e. CLS, BOS, EOS) are NOT included -- they are added at collate time.
+        NOTE: `offsets.npy` is written last, so a crash midway will never leave behind a store that looks complete.
+        NOTE: Each file is written to a temp file unique to this process, then atomically renamed, so every DDP rank can run this at once
+            (on the first run) without writing into each other's files, and readers never see a partially written file.
+    """
+    os.makedirs(path_to_token_store_dir, exist_ok=True)
+    get_path_to_tmp = lambda path: f"{path}.tmp-{os.getpid()}"
+    n_patients: int = len(dataset)
+    offsets: np.ndarray = np.zeros(n_patients + 1, dtype=np.int64)
+    pids: np.ndarray = np.zeros(n_patients, dtype=np.int64)
+    path_to_token_ids: str = os.path.join(path_to_token_store_dir, 'token_ids.bin')
+    path_to_token_times: str = os.path.join(path_to_token_store_dir, 'token_times.bin')
+    with open(get_path_to_tmp(path_to_token_ids), 'wb') as f_ids, open(get_path_to_tmp(path_to_token_times), 'wb') as f_times:
+        for idx, (pid, events) in enumerate(tqdm(dataset.iter_examples(range(n_patients)), total=n_patients, desc=f"materialize_token_store() | split={dataset.split}")):
+            token_ids, token_times = tokenizer.convert_events_to_token_ids_and_times(events)
+            f_ids.write(np.asarray(token_ids, dtype=np.int32).tobytes())
+            f_times.write(np.array(token_times, dtype='datetime64[s]').astype(np.int64).tobytes())
+            offsets[idx + 1] = offsets[idx] + len(token_ids)
+            pids[idx] = pid
+    os.replace(get_path_to_tmp(path_to_token_ids), path_to_token_ids)
+    os.replace(get_path_to_tmp(path_to_token_times), path_to_token_times)
+    path_to_pids: str = os.path.join(path_to_token_store_dir, 'pids.npy')
+    with open(get_path_to_tmp(path_to_pids), 'wb') as fd:
+        np.save(fd, pids)
+    os.replace(get_path_to_tmp(path_to_pids), path_to_pids)
+    path_to_metadata: str = os.path.join(path_to_token_store_dir, 'metadata.json')
+    with open(get_path_to_tmp(path_to_metadata), 'w') as fd:
+        json.dump({
+            'timestamp' : datetime.datetime.now().isoformat(),
+            'tokenizer_metadata' : tokenizer.metadata,
+            'dataset_metadata' : dataset.metadata,
+            'n_patients' : n_patients,
+            'n_tokens' : int(offsets[-1]),
+        }, fd, indent=2)
+    os.replace(get_path_to_tmp(path_to_metadata), path_to_metadata)
+    path_to_offsets: str = os.path.join(path_to_token_store_dir, 'offsets.npy')
+    with open(get_path_to_tmp(path_to_offsets), 'wb') as fd:
+        np.save(fd, offsets)
+    os.replace(get_path_to_tmp(path_to_offsets), path_to_offsets)
+
+class PretokenizedDataset(BaseDataset):
+    """
+        Wrapper around FEMRDataset / MEDSDataset that returns the pre-computed token ids of each patient.
+        dataset[idx] = a specific patient (in the same order as `dataset`), so you can only retrieve ONE sample per patient.
+        
+        Token ids are read zero-copy from a memory-mapped token store (see `materialize_token_store()`), 
+        which is created once and cached in the tokenizer's version dir (see `tokenizer.get_path_to_dataset_dir()`).
+        This removes FEMR/MEDS reads and tokenization from the training hot path entirely.
+    """
+    def __init__(self, 
+                 tokenizer, 
+                 dataset: BaseDataset,
+                 is_force_refresh: bool = False):
+        if isinstance(tokenizer, DescTokenizer):
+            raise ValueError("DescTokenizer not supported for PretokenizedDataset")
+        if not isinstance(dataset, (FEMRDataset, MEDSDataset)) or isinstance(dataset, AllTokensFEMRDataset):
+            raise ValueError(f"PretokenizedDataset only supports FEMRDataset or MEDSDataset, not {type(dataset).__name__}")
+        self.split: str = dataset.split
+        # NOTE: Reuse `dataset.metadata` so that this shares the same tokenizer cache dir (i.e. `seq_length_per_patient.npy`) as `dataset`
+        self.metadata = dataset.metadata
+        self.path_to_token_store_dir: str = os.path.join(tokenizer.get_path_to_dataset_dir(dataset), 'pretokenized/')
+
+        # Create token store (if it doesn't exist yet)
+        if is_force_refresh or not self.is_token_store_valid(tokenizer, dataset):
+            print(f"Creating token store at `{self.path_to_token_store_dir}` for split=`{self.split}`")
+            materialize_token_store(tokenizer, dataset, self.path_to_token_store_dir)
+        
+        # Index is small, so load into memory
+        self.offsets: np.ndarray = np.load(os.path.join(self.path_to_token_store_dir, 'offsets.npy'))
+        self.pids: np.ndarray = np.load(os.path.join(self.path_to_token_store_dir, 'pids.npy'))
+        # Number of tokens per patient timeline (excluding special tokens) -- same as `tokenizer.get_seq_length_per_patient(dataset)`
+        self.seq_length_per_patient: np.ndarray = np.diff(self.offsets)
+
+        # NOTE: Opened lazily so that each DataLoader worker memory-maps the files itself (rather than pickling a copy of them)
+        self.token_ids: Optional[np.ndarray] = None
+        self.token_times: Optional[np.ndarray] = None
+
+    def is_token_store_valid(self, tokenizer, dataset: BaseDataset) -> bool:
+        """Return TRUE if a complete token store exists for this (tokenizer, dataset)"""
+        if not os.path.exists(os.path.join(self.path_to_token_store_dir, 'offsets.npy')):
+            return False
+        metadata = json.load(open(os.path.join(self.path_to_token_store_dir, 'metadata.json'), 'r'))
+        return (
+            metadata['n_patients'] == len(dataset)
+            and is_metadata_equal(tokenizer.metadata, metadata['tokenizer_metadata'])
+            and is_metadata_equal(dataset.metadata, metadata['dataset_metadata'])
+        )
+    
+    def load_token_store(self) -> None:
+        """Memory-map the token store"""
+        n_tokens: int = int(self.offsets[-1])
+        if n_tokens == 0:
+            # np.memmap() can't map empty files
+            self.token_ids, self.token_times = np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int64)
+        else:
+            self.token_ids = np.memmap(os.path.join(self.path_to_token_store_dir, 'token_ids.bin'), dtype=np.int32, mode='r', shape=(n_tokens,))
+            self.token_times = np.memmap(os.path.join(self.path_to_token_store_dir, 'token_times.bin'), dtype=np.int64, mode='r', shape=(n_tokens,))
+
+    def __getstate__(self) -> Dict:
+        # Don't pickle memory-mapped arrays -- each worker will re-open them in `load_token_store()`
+        state = self.__dict__.copy()
+        state['token_ids'] = None
+        state['token_times'] = None
+        return state
+
+    def get_n_patients(self) -> int:
+        return len(self.pids)
+
+    def get_pids(self) -> np.ndarray:
+        """Return patient ids for this split"""
+        return self.pids
+
+    def __len__(self) -> int:
+        return len(self.pids)
+    
+    def get_token_times(self, idx: int) -> np.ndarray:
+        """Return the timestamp (as np.datetime64) of each token for this patient at `idx` in `self.split`"""
+        if self.token_times is None:
+            self.load_token_store()
+        idx = idx if idx >= 0 else len(self) + idx
+        return self.token_times[self.offsets[idx]:self.offsets[idx + 1]].astype('datetime64[s]')
+
+    def __getitem__(self, idx: int) -> Tuple[int, np.ndarray]:
+        """Return all token ids for this patient at `idx` in `self.split` (as a read-only view into the token store)"""
+        if self.token_ids is None:
+            self.load_token_store()
+        idx = idx if idx >= 0 else len(self) + idx
+        return (int(self.pids[idx]), self.token_ids[self.offsets[idx]:self.offsets[idx + 1]])
+
+def get_worker_resume_state(n_batches_per_worker: np.ndarray, n_batches_yielded: int) -> Tuple[np.ndarray, int]:
+    """
+        A DataLoader over an IterableDataset yields batches from its workers round-robin (skipping workers that have run out of batches).
+        Given the # of batches that each worker will yield, return (a) how many of the first `n_batches_yielded` batches came from each worker,
+        and (b) the idx of the worker that would have yielded the next batch.
+    """
+    n_batches_per_worker = np.asarray(n_batches_per_worker, dtype=np.int64)
+    n_batches_yielded = min(n_batches_yielded, int(n_batches_per_worker.sum()))
+    # Binary search for the # of complete rounds, where a round = one batch from each worker that has batches left
+    lo, hi = 0, int(n_batches_per_worker.max(initial=0))
+    while lo < hi:
+        mid: int = (lo + hi + 1) // 2
+        if np.minimum(n_batches_per_worker, mid).sum() <= n_batches_yielded:
+            lo = mid
+        else:
+            hi = mid - 1
+    n_batches_yielded_per_worker: np.ndarray = np.minimum(n_batches_per_worker, lo)
+    # The remaining batches come from the first workers (in order) that still had batches left in the next round
+    n_batches_left: int = n_batches_yielded - int(n_batches_yielded_per_worker.sum())
+    active_worker_idxs: np.ndarray = np.where(n_batches_per_worker > lo)[0]
+    n_batches_yielded_per_worker[active_worker_idxs[:n_batches_left]] += 1
+    next_worker_idx: int = int(active_worker_idxs[n_batches_left]) if n_batches_left < len(active_worker_idxs) else 0
+    return n_batches_yielded_per_worker, next_worker_idx
+
+class StreamingDataset(IterableDataset):
+    """
+        Wrapper around a map-style dataset (e.g. FEMRDataset, MEDSDataset, PretokenizedDataset) that streams batches of examples.
+        Yields lists of `batch_size` examples, so pass `batch_size=None` to the DataLoader.
+
+        Every epoch:
+            1. Split the dataset into blocks of `block_size` consecutive examples (starting at a random offset, wrapping around the end of the dataset)
+            2. Shuffle the order of blocks, then assign every `n_replicas`-th block to each GPU (dropping the last `n_blocks % n_replicas` blocks)
+            3. Assign every `n_workers`-th block of each GPU to each DataLoader worker (i.e. a shard)
+            4. Each worker reads its blocks sequentially, and shuffles examples via a bounded shuffle buffer of `shuffle_buffer_size` examples
+        
+        Unlike a map-style dataset + (distributed) sampler, no GPU ever materializes an index over all examples, and reads are
+        mostly sequential through the extract (i.e. within a block). 
+        Since the shuffle buffer operates on idxs (not examples), resuming from `(epoch, start_batch_idx)` skips batches without reading them.
+    """
+    def __init__(self, 
+                 dataset: BaseDataset,
+                 batch_size: int,
+                 block_size: int = 1024,
+                 shuffle_buffer_size: int = 10_000,
+                 is_shuffle: bool = True,
+                 seed: int = 1,
+                 n_replicas: int = 1,
+                 rank: Optional[int] = None):
+        assert block_size % batch_size == 0, f"ERROR - `block_size` ({block_size}) must be a multiple of `batch_size` ({batch_size})"
+        assert len(dataset) >= block_size * n_replicas, f"ERROR - Dataset has {len(dataset)} examples, which is less than `block_size * n_replicas` ({block_size * n_replicas}), so some GPUs would get no data"
+        self.dataset: BaseDataset = dataset
+        self.split: str = getattr(dataset, 'split', None)
+        self.metadata: Dict[str, Any] = getattr(dataset, 'metadata', None)
+        self.batch_size: int = batch_size
+        self.block_size: int = block_size
+        self.shuffle_buffer_size: int = shuffle_buffer_size
+        self.is_shuffle: bool = is_shuffle
+        self.seed: int = seed
+        self.n_replicas: int = n_replicas
+        self.rank: Optional[int] = rank # if None, then determined lazily (i.e. after torch.distributed has been initialized)
+        self.epoch: int = 0
+        self.start_batch_idx: int = 0 # batch idx (for this GPU) to start yielding at; used for resuming from the last batch saved in a checkpoint
+
+    def get_rank(self) -> int:
+        if self.rank is not None:
+            return self.rank
+        return torch.distributed.get_rank() if torch.distributed.is_initialized() else 0
+
+    def get_block_starts(self) -> np.ndarray:
+        """Return the start idx of each block assigned to this GPU for the current epoch"""
+        rng: np.random.Generator = np.random.default_rng((self.seed, self.epoch))
+        n_examples: int = len(self.dataset)
+        n_blocks: int = n_examples // self.block_size
+        # Random offset, so that a different set of examples gets dropped every epoch
+        offset: int = int(rng.integers(n_examples)) if self.is_shuffle else 0
+        block_order: np.ndarray = rng.permutation(n_blocks) if self.is_shuffle else np.arange(n_blocks)
+        n_blocks_per_gpu: int = n_blocks // self.n_replicas
+        block_order = block_order[:n_blocks_per_gpu * self.n_replicas][self.get_rank()::self.n_replicas]
+        return (offset + block_order * self.block_size) % n_examples
+
+    def __len__(self) -> int:
+        """Number of batches per GPU per epoch"""
+        return (len(self.dataset) // self.block_size // self.n_replicas) * (self.block_size // self.batch_size)
+
+    def get_idxs(self, block_starts: np.ndarray, worker_seed: Tuple[int, ...]) -> Generator[int, None, None]:
+        """Yield the idxs of examples (in order) in `block_starts`, shuffled by a bounded shuffle buffer"""
+        n_examples: int = len(self.dataset)
+        idxs: Generator[int, None, None] = ( 
+            (int(start) + i) % n_examples 
+            for start in block_starts 
+            for i in range(self.block_size) 
+        )
+        if not self.is_shuffle:
+            yield from idxs
+            return
+        rng: np.random.Generator = np.random.default_rng(worker_seed)
+        buffer: List[int] = []
+        for idx in idxs:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(idx)
+                continue
+            # Yield a random idx from the buffer, and replace it with the new idx
+            buffer_idx: int = int(rng.integers(self.shuffle_buffer_size))
+            yield buffer[buffer_idx]
+            buffer[buffer_idx] = idx
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self) -> Generator[List[Any], None, None]:
+        worker_info = get_worker_info()
+        worker_id: int = worker_info.id if worker_info is not None else 0
+        n_workers: int = worker_info.num_workers if worker_info is not None else 1
+        rank: int = self.get_rank()
+        block_starts: np.ndarray = self.get_block_starts()
+        
+        # Skip batches that were already yielded before `start_batch_idx` (i.e. resuming from a checkpoint)
+        # NOTE: A new DataLoader always starts polling from worker 0, so rotate which shard each worker reads such that
+        # worker 0 gets the shard that would have yielded the next batch -- then the round-robin order is unchanged
+        n_batches_per_block: int = self.block_size // self.batch_size
+        n_batches_per_shard: np.ndarray = np.array([ len(block_starts[w::n_workers]) * n_batches_per_block for w in range(n_workers) ])
+        n_batches_yielded_per_shard, next_shard_idx = get_worker_resume_state(n_batches_per_shard, self.start_batch_idx)
+        shard_idx: int = (next_shard_idx + worker_id) % n_workers
+        n_batches_to_skip: int = int(n_batches_yielded_per_shard[shard_idx])
+
+        idxs: Iterable[int] = islice(self.get_idxs(block_starts[shard_idx::n_workers], (self.seed, self.epoch, rank, shard_idx)), n_batches_to_skip * self.batch_size, None)
+        # Since we know the upcoming order of idxs, let the dataset read ahead of time (if it supports it, i.e. FEMRDataset / MEDSDataset)
+        examples: Iterable[Any] = self.dataset.iter_examples(idxs) if hasattr(self.dataset, 'iter_examples') else ( self.dataset[idx] for idx in idxs )
+        batch: List[Any] = []
+        for example in examples:
+            batch.append(example)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
 
-        return (pid, tokenizable_events[start_token_idx:end_token_idx])
+    def set_epoch(self, epoch: int):
+        """Ensures different shuffling for each epoch"""
+        # ! Be sure to add a call to this function to PyTorch Lightning hook on epoch_end()
+        self.epoch = epoch
+        self.start_batch_idx = 0 # Reset starting batch idx b/c new epoch
 
 if __name__ == '__main__':
     from hf_ehr.data.tokenization import CLMBRTokenizer, DescTokenizer
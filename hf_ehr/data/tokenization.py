@@ -1,13 +1,15 @@
 import multiprocessing
 import datetime
+import hashlib
 import json
 import multiprocessing.managers
-import random
 from typing import Dict, List, Optional, Set, Tuple, Union, Any, TypedDict
+import numpy as np
 import torch
-from transformers import PreTrainedTokenizer, AutoTokenizer
-from hf_ehr.config import Event, TokenizerConfigEntry, load_tokenizer_config_from_path, save_tokenizer_config_to_path
+from transformers import PreTrainedTokenizer, AutoTokenizer, BatchEncoding, AddedToken
+from hf_ehr.config import Event, Timeline, TokenizerConfigEntry, load_tokenizer_config_from_path, save_tokenizer_config_to_path, encode_strings, decode_strings
 import os
+import shutil
 from tqdm import tqdm
 from omegaconf import OmegaConf, DictConfig
 
@@ -80,6 +82,367 @@ def is_metadata_equal(metadata1: Dict, metadata2: Dict) -> bool:
             return False
     return is_match
 
+def get_random_truncation_start_idxs(lengths: torch.Tensor, max_length: int, seed: int) -> torch.Tensor:
+    """
+        Given the length of each timeline in a batch, return a random start idx for each timeline such that 
+        a window of `max_length` tokens starting at that idx fits within the timeline (or 0 if the timeline is <= `max_length`).
+        Uses a `torch.Generator` seeded with `seed`, so results are deterministic per batch and don't touch global RNG state.
+    """
+    generator: torch.Generator = torch.Generator().manual_seed(seed)
+    n_start_idxs: torch.Tensor = torch.clamp(lengths - max_length, min=0) + 1 # number of valid start idxs per timeline
+    return (torch.rand(lengths.shape[0], generator=generator, dtype=torch.float64) * n_start_idxs).long()
+
+def get_first_fit_decreasing_rows(lengths: List[int], max_length: int) -> List[List[int]]:
+    """
+        Bin pack sequences into rows of at most `max_length` tokens using First-Fit Decreasing (longest seqs placed first, 
+        each into the first row that still has room). Returns the idxs (into `lengths`) of the sequences in each row.
+        NOTE: Assumes every length is <= `max_length` (i.e. sequences have already been truncated)
+    """
+    rows: List[List[int]] = []
+    row_n_tokens_left: List[int] = []
+    for idx in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        for row_idx, n_tokens_left in enumerate(row_n_tokens_left):
+            if lengths[idx] <= n_tokens_left:
+                rows[row_idx].append(idx)
+                row_n_tokens_left[row_idx] -= lengths[idx]
+                break
+        else:
+            rows.append([ idx ])
+            row_n_tokens_left.append(max_length - lengths[idx])
+    return rows
+
+def build_code_2_token(tokenizer_config: List[TokenizerConfigEntry]) -> Tuple[Dict[str, Dict[str, List[Dict[str, Any]]]], List[str]]:
+    """Preprocess tokenizer config for quick access. Returns `code_2_token` and the list of all tokens (in config order).
+        NOTE: Takes ~10 seconds for 1.5M tokens"""
+    code_2_token = {} # [key] = token; [val] = { 'type' : str, 'tokenization' : dict, 'token' : str }
+    non_special_tokens: List[str] = []
+    for entry in tokenizer_config:
+        if entry.code not in code_2_token: code_2_token[entry.code] = {}
+        if entry.type not in code_2_token[entry.code]: code_2_token[entry.code][entry.type] = []
+        code_2_token[entry.code][entry.type].append({
+            'tokenization': entry.tokenization,
+            'token' : entry.to_token(),
+        })
+        non_special_tokens.append(entry.to_token())
+    return code_2_token, non_special_tokens
+
+_seq_length_worker_state: Dict[str, Any] = {} # [key] = 'tokenizer' or 'dataset'; per-process state for `calc_seq_length_chunk()`
+
+def load_patient_dataset_from_metadata(dataset_metadata: Dict[str, Any]) -> 'Dataset':
+    """Re-create the patient-level FEMRDataset / MEDSDataset corresponding to `dataset_metadata`"""
+    from hf_ehr.data.datasets import FEMRDataset, MEDSDataset
+    dataset_cls = MEDSDataset if dataset_metadata.get('cls') == 'MEDSDataset' else FEMRDataset
+    # remove extraneous keys so that we can init FEMRDataset() without errors
+    dataset_metadata = { key: val for key, val in dataset_metadata.items() if key not in [ 'cls', 'tokenizer_metadata', 'max_length' ] }
+    return dataset_cls(**dataset_metadata)
+
+def init_seq_length_worker(tokenizer: 'BaseTokenizer', dataset_metadata: Dict[str, Any], dataset: Optional['Dataset'] = None) -> None:
+    """Open the dataset ONCE per worker process. If `dataset` is given, then reuse it rather than re-opening it."""
+    _seq_length_worker_state['tokenizer'] = tokenizer
+    _seq_length_worker_state['dataset'] = dataset if dataset is not None else load_patient_dataset_from_metadata(dataset_metadata)
+
+def calc_seq_length_chunk(chunk: Tuple[int, int]) -> Tuple[Tuple[int, int], np.ndarray]:
+    """Return the sequence length of each patient in `chunk = (start_idx, end_idx)`. Must be run in a worker initialized by `init_seq_length_worker()`.
+        Also returns `chunk` so that results from `imap_unordered()` can be matched to their chunk."""
+    return (chunk, _seq_length_worker_state['tokenizer'].get_seq_length(_seq_length_worker_state['dataset'], *chunk))
+
+def save_seq_length_chunk(seq_lengths: np.ndarray, path_to_file: str) -> None:
+    """Atomically save `seq_lengths` to `path_to_file`, so that a crash never leaves behind a partially written file.
+        The temp file is unique to this process, so concurrent writers (e.g. every DDP rank on its first run) never write into each other's file."""
+    path_to_tmp: str = f"{path_to_file}.tmp-{os.getpid()}"
+    with open(path_to_tmp, 'wb') as fd:
+        np.save(fd, seq_lengths)
+    os.replace(path_to_tmp, path_to_file)
+
+def get_event_times_and_is_visit(events: Union[List[Event], Timeline]) -> Tuple[List[Optional[datetime.datetime]], List[Optional[datetime.datetime]], List[bool]]:
+    """Return the start time, end time, and whether each event is a visit (i.e. has 'Visit' in its code) -- needed to insert visit / ATT tokens"""
+    if isinstance(events, Timeline):
+        # Check each unique code once
+        is_visit_per_string: np.ndarray = np.array([ "Visit" in x for x in events.strings ], dtype=bool)
+        return events.starts.tolist(), events.ends.tolist(), is_visit_per_string[events.code_ids].tolist()
+    return [ e.start for e in events ], [ e.end for e in events ], [ "Visit" in e.code for e in events ]
+
+class CompiledCodeLookup():
+    """
+        Integer lookup tables compiled once from a tokenizer's `code_2_token` dict.
+        Maps an Event's (code, value, unit) directly to a token id (or -1 if the Event has no token).
+
+        Layout:
+            - Each code gets an integer `code_id`
+            - `code` tokens are stored in a flat int32 array indexed by `code_id`
+            - `categorical` tokens are stored as a hash table of { value : token id } per `code_id`
+            - `numerical_range` tokens are grouped by (code_id, unit) into contiguous segments of sorted NumPy arrays,
+                which we binary search with `np.searchsorted`
+
+        NOTE: Returns exactly the same token as the linear scan over `code_2_token` in `convert_event_to_token()`,
+            i.e. the first matching entry (in tokenizer config order) wins. If a (code, unit)'s ranges are not
+            sorted + non-overlapping (ignoring shared endpoints), we fall back to a linear scan for that (code, unit).
+    """
+    def __init__(self,
+                 code_2_token: Dict[str, Dict[str, List[Dict[str, Any]]]],
+                 token_2_idx: Dict[str, int],
+                 is_match_units: bool = False) -> None:
+        self.is_match_units: bool = is_match_units # if TRUE, then a numerical value's unit must match the token's unit (Cookbook); else, ignore units (CLMBR)
+        self.code_2_code_id: Dict[str, int] = { code: code_id for code_id, code in enumerate(code_2_token.keys()) }
+        n_codes: int = len(self.code_2_code_id)
+
+        # `code` tokens
+        self.code_id_2_token_id: np.ndarray = np.full(n_codes, -1, dtype=np.int32)
+        # `categorical` tokens
+        self.code_id_2_categorical: List[Optional[Dict[str, int]]] = [ None ] * n_codes
+        # `numerical_range` tokens
+        self.code_id_2_is_numerical: np.ndarray = np.zeros(n_codes, dtype=bool)
+        self.range_key_2_range_key_id: Dict[Tuple[int, Optional[str]], int] = {} # [key] = (code_id, unit); [val] = idx into `self.range_offsets`
+        self.range_key_id_2_linear_ranges: Dict[int, List[Tuple[float, float, int]]] = {} # fallback for (code, unit)'s whose ranges can't be binary searched
+        range_offsets: List[int] = [ 0 ]
+        range_starts: List[float] = []
+        range_ends: List[float] = []
+        range_token_ids: List[int] = []
+
+        for code, code_id in self.code_2_code_id.items():
+            types: Dict[str, List[Dict[str, Any]]] = code_2_token[code]
+            if 'code' in types:
+                self.code_id_2_token_id[code_id] = token_2_idx[types['code'][0]['token']]
+            if 'categorical' in types:
+                value_2_token_id: Dict[str, int] = {}
+                for entry in types['categorical']:
+                    token_id: int = token_2_idx[entry['token']]
+                    for category in entry['tokenization']['categories']:
+                        value_2_token_id.setdefault(category, token_id) # first matching entry wins
+                self.code_id_2_categorical[code_id] = value_2_token_id
+            if 'numerical_range' in types:
+                self.code_id_2_is_numerical[code_id] = True
+                # Group ranges by unit (preserving config order within each unit)
+                key_2_ranges: Dict[Tuple[int, Optional[str]], List[Tuple[Any, Any, int]]] = {}
+                for entry in types['numerical_range']:
+                    key = (code_id, entry['tokenization']['unit'] if is_match_units else None)
+                    key_2_ranges.setdefault(key, []).append((entry['tokenization']['range_start'], entry['tokenization']['range_end'], token_2_idx[entry['token']]))
+                for key, ranges in key_2_ranges.items():
+                    range_key_id: int = len(self.range_key_2_range_key_id)
+                    self.range_key_2_range_key_id[key] = range_key_id
+                    if self._is_searchable(ranges):
+                        for (start, end, token_id) in ranges:
+                            range_starts.append(start)
+                            range_ends.append(end)
+                            range_token_ids.append(token_id)
+                    else:
+                        self.range_key_id_2_linear_ranges[range_key_id] = ranges
+                    range_offsets.append(len(range_ends))
+
+        self.range_offsets: np.ndarray = np.array(range_offsets, dtype=np.int64)
+        self.range_starts: np.ndarray = np.array(range_starts, dtype=np.float64)
+        self.range_ends: np.ndarray = np.array(range_ends, dtype=np.float64)
+        self.range_token_ids: np.ndarray = np.array(range_token_ids, dtype=np.int32)
+
+    def save(self, path_to_dir: str) -> None:
+        """Save lookup tables as .npy files in `path_to_dir`, so that `CompiledCodeLookup.load()` can memory-map them"""
+        os.makedirs(path_to_dir, exist_ok=True)
+        # Categoricals => flat arrays (in insertion order, so that "first matching entry wins" is preserved)
+        categorical_code_ids: List[int] = []
+        categorical_values: List[str] = []
+        categorical_token_ids: List[int] = []
+        for code_id, value_2_token_id in enumerate(self.code_id_2_categorical):
+            if value_2_token_id is None:
+                continue
+            if len(value_2_token_id) == 0:
+                # Keep track of codes with an empty (but not None) categorical dict
+                categorical_code_ids.append(code_id)
+                categorical_values.append(None)
+                categorical_token_ids.append(-1)
+            for value, token_id in value_2_token_id.items():
+                categorical_code_ids.append(code_id)
+                categorical_values.append(value)
+                categorical_token_ids.append(token_id)
+        range_keys: List[Tuple[int, Optional[str]]] = sorted(self.range_key_2_range_key_id.keys(), key=lambda x: self.range_key_2_range_key_id[x])
+        arrays: Dict[str, np.ndarray] = {
+            'is_match_units' : np.array([ self.is_match_units ]),
+            'code_id_2_token_id' : self.code_id_2_token_id,
+            'code_id_2_is_numerical' : self.code_id_2_is_numerical,
+            'categorical_code_ids' : np.array(categorical_code_ids, dtype=np.int32),
+            'categorical_token_ids' : np.array(categorical_token_ids, dtype=np.int32),
+            'range_key_code_ids' : np.array([ x[0] for x in range_keys ], dtype=np.int32),
+            'range_offsets' : self.range_offsets,
+            'range_starts' : self.range_starts,
+            'range_ends' : self.range_ends,
+            'range_token_ids' : self.range_token_ids,
+            'linear_ranges' : np.frombuffer(json.dumps({ str(key): val for key, val in self.range_key_id_2_linear_ranges.items() }).encode('utf-8'), dtype=np.uint8), # rare, so store as JSON
+        }
+        for name, strings in [
+            ('codes', list(self.code_2_code_id.keys())),
+            ('categorical_values', categorical_values),
+            ('range_key_units', [ x[1] for x in range_keys ]),
+        ]:
+            for key, val in encode_strings(strings).items():
+                arrays[f'{name}__{key}'] = val
+        for name, val in arrays.items():
+            np.save(os.path.join(path_to_dir, f'{name}.npy'), val)
+
+    @classmethod
+    def load(cls, path_to_dir: str) -> 'CompiledCodeLookup':
+        """Load lookup tables saved by `CompiledCodeLookup.save()`. Numerical arrays are memory-mapped (read-only)."""
+        load = lambda name: np.load(os.path.join(path_to_dir, f'{name}.npy'), mmap_mode='r')
+        load_strings = lambda name: decode_strings(load(f'{name}__blob'), load(f'{name}__offsets'), load(f'{name}__is_null'))
+        lookup = cls.__new__(cls)
+        lookup.is_match_units = bool(load('is_match_units')[0])
+        lookup.code_2_code_id = { code: code_id for code_id, code in enumerate(load_strings('codes')) }
+        lookup.code_id_2_token_id = load('code_id_2_token_id')
+        lookup.code_id_2_is_numerical = load('code_id_2_is_numerical')
+        lookup.code_id_2_categorical = [ None ] * len(lookup.code_2_code_id)
+        for code_id, value, token_id in zip(load('categorical_code_ids').tolist(), load_strings('categorical_values'), load('categorical_token_ids').tolist()):
+            if lookup.code_id_2_categorical[code_id] is None:
+                lookup.code_id_2_categorical[code_id] = {}
+            if value is not None:
+                lookup.code_id_2_categorical[code_id][value] = token_id
+        lookup.range_key_2_range_key_id = { 
+            (code_id, unit) : range_key_id 
+            for range_key_id, (code_id, unit) in enumerate(zip(load('range_key_code_ids').tolist(), load_strings('range_key_units'))) 
+        }
+        lookup.range_key_id_2_linear_ranges = { 
+            int(key): [ tuple(x) for x in val ] 
+            for key, val in json.loads(load('linear_ranges').tobytes().decode('utf-8')).items() 
+        }
+        lookup.range_offsets = load('range_offsets')
+        lookup.range_starts = load('range_starts')
+        lookup.range_ends = load('range_ends')
+        lookup.range_token_ids = load('range_token_ids')
+        return lookup
+
+    @staticmethod
+    def _is_searchable(ranges: List[Tuple[Any, Any, int]]) -> bool:
+        """Return TRUE if `ranges` are sorted and non-overlapping (except for shared endpoints), so that
+            binary searching over `range_end` returns the same token as a linear scan."""
+        for idx, (start, end, __) in enumerate(ranges):
+            if not (isinstance(start, (float, int)) and isinstance(end, (float, int)) and start <= end):
+                return False
+            if idx > 0 and not (ranges[idx - 1][1] <= start):
+                return False
+        return True
+
+    def _lookup_range(self, range_key_id: int, value: float) -> int:
+        if range_key_id in self.range_key_id_2_linear_ranges:
+            for (start, end, token_id) in self.range_key_id_2_linear_ranges[range_key_id]:
+                if start <= value <= end:
+                    return token_id
+            return -1
+        start_idx: int = self.range_offsets[range_key_id]
+        end_idx: int = self.range_offsets[range_key_id + 1]
+        idx: int = start_idx + int(np.searchsorted(self.range_ends[start_idx:end_idx], value, side='left'))
+        if idx < end_idx and self.range_starts[idx] <= value:
+            return int(self.range_token_ids[idx])
+        return -1
+
+    def lookup(self, code: str, value: Optional[Any], unit: Optional[str]) -> int:
+        """Return token id for a single (code, value, unit), or -1 if there is no matching token."""
+        code_id: Optional[int] = self.code_2_code_id.get(code)
+        if code_id is None:
+            return -1
+        # If numerical code...
+        if self.code_id_2_is_numerical[code_id] and value is not None and isinstance(value, (float, int)):
+            range_key_id: Optional[int] = self.range_key_2_range_key_id.get((code_id, unit if self.is_match_units else None))
+            return self._lookup_range(range_key_id, value) if range_key_id is not None else -1
+        # If textual code...
+        categorical: Optional[Dict[str, int]] = self.code_id_2_categorical[code_id]
+        if categorical is not None and value is not None and value != '' and isinstance(value, str):
+            return categorical.get(value, -1)
+        # If just vanilla code...
+        return int(self.code_id_2_token_id[code_id])
+
+    def lookup_events(self, events: Union[List[Event], Timeline]) -> np.ndarray:
+        """Return token id for every Event in `events` (-1 if the Event has no token).
+            Numerical values are grouped by (code, unit) so that each group is resolved with a single `np.searchsorted`."""
+        if isinstance(events, Timeline):
+            return self.lookup_timeline(events)
+        token_ids: np.ndarray = np.full(len(events), -1, dtype=np.int32)
+        range_key_id_2_idxs_values: Dict[int, Tuple[List[int], List[float]]] = {}
+        for idx, e in enumerate(events):
+            code_id: Optional[int] = self.code_2_code_id.get(e.code)
+            if code_id is None:
+                continue
+            value = e.value
+            # If numerical code...
+            if self.code_id_2_is_numerical[code_id] and value is not None and isinstance(value, (float, int)):
+                range_key_id: Optional[int] = self.range_key_2_range_key_id.get((code_id, e.unit if self.is_match_units else None))
+                if range_key_id is not None:
+                    idxs, values = range_key_id_2_idxs_values.setdefault(range_key_id, ([], []))
+                    idxs.append(idx)
+                    values.append(value)
+                continue
+            # If textual code...
+            categorical: Optional[Dict[str, int]] = self.code_id_2_categorical[code_id]
+            if categorical is not None and value is not None and value != '' and isinstance(value, str):
+                token_ids[idx] = categorical.get(value, -1)
+                continue
+            # If just vanilla code...
+            token_ids[idx] = self.code_id_2_token_id[code_id]
+
+        # Resolve all numerical values with one binary search per (code, unit)
+        for range_key_id, (idxs, values) in range_key_id_2_idxs_values.items():
+            token_ids[idxs] = self._lookup_ranges(range_key_id, np.asarray(values, dtype=np.float64))
+        return token_ids
+
+    def _lookup_ranges(self, range_key_id: int, values: np.ndarray) -> np.ndarray:
+        """Vectorized version of `_lookup_range()` -- return token id for every value in `values` (-1 if no matching range)"""
+        if range_key_id in self.range_key_id_2_linear_ranges:
+            return np.array([ self._lookup_range(range_key_id, value) for value in values.tolist() ], dtype=np.int32)
+        start_idx: int = self.range_offsets[range_key_id]
+        end_idx: int = self.range_offsets[range_key_id + 1]
+        range_idxs: np.ndarray = start_idx + np.searchsorted(self.range_ends[start_idx:end_idx], values, side='left')
+        is_in_bounds: np.ndarray = range_idxs < end_idx
+        is_match: np.ndarray = np.zeros(len(values), dtype=bool)
+        is_match[is_in_bounds] = self.range_starts[range_idxs[is_in_bounds]] <= values[is_in_bounds]
+        token_ids: np.ndarray = np.full(len(values), -1, dtype=np.int32)
+        token_ids[is_match] = self.range_token_ids[range_idxs[is_match]]
+        return token_ids
+
+    def lookup_timeline(self, timeline: Timeline) -> np.ndarray:
+        """Same as `lookup_events()`, but reads a Timeline's columns directly.
+            Only loops (in Python) over the timeline's unique strings and unique (code, unit) / (code, value) pairs, rather than every event."""
+        token_ids: np.ndarray = np.full(len(timeline), -1, dtype=np.int32)
+        string_idx_2_code_id: np.ndarray = np.array([ self.code_2_code_id.get(x, -1) for x in timeline.strings ], dtype=np.int64)
+        code_ids: np.ndarray = string_idx_2_code_id[timeline.code_ids] if len(timeline) > 0 else np.zeros(0, dtype=np.int64)
+        is_known: np.ndarray = code_ids >= 0
+        if not is_known.any():
+            return token_ids
+        code_ids = np.where(is_known, code_ids, 0)
+
+        # If numerical code...
+        is_numerical: np.ndarray = is_known & self.code_id_2_is_numerical[code_ids] & timeline.is_numeric
+        idxs: np.ndarray = np.nonzero(is_numerical)[0]
+        if len(idxs) > 0:
+            # Group by (code, unit), then resolve each group with a single binary search
+            unit_ids: np.ndarray = timeline.unit_ids[idxs] if self.is_match_units else np.full(len(idxs), -1, dtype=np.int32)
+            keys, inverse = np.unique(np.stack([ code_ids[idxs], unit_ids ]), axis=1, return_inverse=True)
+            inverse = inverse.reshape(-1)
+            order: np.ndarray = np.argsort(inverse, kind='stable') # [group_starts[key_idx]:group_ends[key_idx]] = idxs (into `idxs`) in group `key_idx`
+            group_ends: np.ndarray = np.cumsum(np.bincount(inverse, minlength=keys.shape[1]))
+            group_starts: np.ndarray = np.concatenate([ [ 0 ], group_ends[:-1] ])
+            for key_idx, (code_id, unit_id) in enumerate(keys.T.tolist()):
+                range_key_id: Optional[int] = self.range_key_2_range_key_id.get((code_id, timeline.strings[unit_id] if unit_id >= 0 else None))
+                if range_key_id is None:
+                    continue
+                group_idxs: np.ndarray = idxs[order[group_starts[key_idx]:group_ends[key_idx]]]
+                token_ids[group_idxs] = self._lookup_ranges(range_key_id, timeline.values[group_idxs])
+
+        # If textual code...
+        is_code: np.ndarray = is_known & ~is_numerical
+        idxs = np.nonzero(is_code & (timeline.text_value_ids >= 0))[0]
+        if len(idxs) > 0:
+            keys, inverse = np.unique(np.stack([ code_ids[idxs], timeline.text_value_ids[idxs] ]), axis=1, return_inverse=True)
+            key_token_ids: List[int] = []
+            for (code_id, text_value_id) in keys.T.tolist():
+                categorical: Optional[Dict[str, int]] = self.code_id_2_categorical[code_id]
+                value: str = timeline.strings[text_value_id]
+                # NOTE: -2 => not a categorical token, so fall back to the vanilla code below
+                key_token_ids.append(categorical.get(value, -1) if categorical is not None and value != '' else -2)
+            categorical_token_ids: np.ndarray = np.array(key_token_ids, dtype=np.int32)[inverse.reshape(-1)]
+            is_categorical: np.ndarray = categorical_token_ids != -2
+            token_ids[idxs[is_categorical]] = categorical_token_ids[is_categorical]
+            is_code[idxs[is_categorical]] = False
+
+        # If just vanilla code...
+        token_ids[is_code] = self.code_id_2_token_id[code_ids[is_code]]
+        return token_ids
+
 class BaseTokenizer(PreTrainedTokenizer):
     path_to_tokenizer_config: str
     
@@ -151,6 +514,17 @@ class BaseTokenizer(PreTrainedTokenizer):
     def convert_event_to_token(self, e: Event, **kwargs) -> Optional[str]:
         raise NotImplementedError("Must implement `self.convert_event_to_token()` in child class")
 
+    def truncate_at_random_positions(self, tokenized_batch: Dict[str, torch.Tensor], max_length: int, seed: int) -> Dict[str, torch.Tensor]:
+        """Truncate every timeline in a padded batch to a window of `max_length` tokens starting at a random position.
+            Windows for the whole batch are gathered with a single index tensor."""
+        lengths: torch.Tensor = (tokenized_batch['input_ids'] != self.pad_token_id).sum(dim=1) # count of non-PAD tokens
+        start_idxs: torch.Tensor = get_random_truncation_start_idxs(lengths, max_length, seed)
+        window_size: int = min(max_length, tokenized_batch['input_ids'].shape[1])
+        window_idxs: torch.Tensor = start_idxs.unsqueeze(1) + torch.arange(window_size).unsqueeze(0) # [idx] = token idxs in timeline `idx` to keep
+        for key in tokenized_batch.keys():
+            tokenized_batch[key] = torch.gather(tokenized_batch[key], 1, window_idxs.to(tokenized_batch[key].device))
+        return tokenized_batch
+
     ########################################################
     # Caching / versioning
     ########################################################
@@ -222,78 +596,134 @@ class BaseTokenizer(PreTrainedTokenizer):
         print(f"Creating new folder for this dataset of this version of the tokenizer at `{path_to_new_folder}` with metadata={dataset.metadata}")
         return path_to_new_folder
 
-    def get_seq_length(self, args: Tuple['Dataset', int, int]) -> List[Tuple[int, int]]:
-        """Given a dataset and a range of indices, return the sequence length of each patient in that range"""
-        from hf_ehr.data.datasets import FEMRDataset, MEDSDataset
-        dataset_metadata, start_idx, end_idx = args # type is: FEMRDataset, int, int
-        
-        dataset_cls = None
-        if dataset_metadata.get('cls') == 'MEDSDataset':
-            dataset_cls = MEDSDataset
-        else:
-            dataset_cls = FEMRDataset
+    def get_seq_length_of_events(self, events: List[Event]) -> int:
+        """Return the number of tokens in this timeline (without special tokens)"""
+        return len(self.__call__(events)['input_ids'][0])
 
-        # remove extraneous keys so that we can init FEMRDataset() without errors
-        dataset_metadata = { key: val for key, val in dataset_metadata.items() if key not in [ 'cls', 'tokenizer_metadata', 'max_length' ] }
-        
-        dataset = dataset_cls(**dataset_metadata)
-        results: List[Tuple[int, int]] = []
+    def get_seq_length(self, dataset: 'Dataset', start_idx: int, end_idx: int) -> np.ndarray:
+        """Given a patient-level dataset and a range of indices, return the sequence length of each patient in that range"""
+        seq_lengths: np.ndarray = np.zeros(end_idx - start_idx, dtype=np.int64)
         for idx in range(start_idx, end_idx):
             events: List[Event] = dataset.__getitem__(idx)[1]
-            results.append((idx, len(self.__call__(events)['input_ids'][0])))
-        return results
+            seq_lengths[idx - start_idx] = self.get_seq_length_of_events(events)
+        return seq_lengths
+
+    def is_seq_length_per_patient_cached(self, dataset) -> bool:
+        """Return TRUE if `get_seq_length_per_patient(dataset)` can load its result from cache (rather than tokenizing every patient)"""
+        path_to_dataset_dir: str = self.get_path_to_dataset_dir(dataset)
+        path_to_cache_file: str = os.path.join(path_to_dataset_dir, 'seq_length_per_patient.npy')
+        if os.path.exists(path_to_cache_file):
+            return np.load(path_to_cache_file, mmap_mode='r').shape[0] == dataset.get_n_patients()
+        return os.path.exists(os.path.join(path_to_dataset_dir, 'seq_length_per_patient.json'))
 
-    def get_seq_length_per_patient(self, dataset, n_procs: int = 5, is_force_refresh: bool = False) -> List[int]:
+    def get_seq_length_per_patient(self, dataset, n_procs: int = 5, is_force_refresh: bool = False, chunk_size: int = 5_000) -> np.ndarray:
         """
-            Fetch the sequence length of every patient in `dataset`, save to cache, and return the list of lengths.
+            Fetch the sequence length of every patient in `dataset`, save to cache, and return the lengths (int64 array).
             If cache exists, then load from cache (unless `is_force_refresh` is set to TRUE).
             If cache doesn't exist or `is_force_refresh` is TRUE, then calculate the lengths in parallel. 
-                For CLMBRTokenizer, `n_procs=5`, this takes ~5 hrs for 2.5M patients (train dataset)
-                For DescTokenizer, `n_procs=5`, this takes ~11 hrs for 2.5M patients (train dataset)
+                Patients are split into contiguous chunks of `chunk_size`, and each chunk's lengths are checkpointed to disk as soon as they're done,
+                so if this crashes, then rerunning it will resume from the last finished chunk.
+                Previously (with `n_procs=1`), this took ~5 hrs (CLMBRTokenizer) or ~11 hrs (DescTokenizer) for 2.5M patients (train dataset)
         """
         # Check if cache exists
         path_to_dataset_dir: str = self.get_path_to_dataset_dir(dataset)
-        path_to_cache_file: str = os.path.join(path_to_dataset_dir, 'seq_length_per_patient.json')
+        path_to_cache_file: str = os.path.join(path_to_dataset_dir, 'seq_length_per_patient.npy')
+        path_to_legacy_cache_file: str = os.path.join(path_to_dataset_dir, 'seq_length_per_patient.json')
+        path_to_chunks_dir: str = os.path.join(path_to_dataset_dir, 'seq_length_per_patient_chunks/')
+        n_patients: int = dataset.get_n_patients()
 
         if not is_force_refresh:
             # If NOT force refresh, try to load from cache
+            # NOTE: `path_to_dataset_dir` is specific to this tokenizer's + dataset's metadata, so only need to check # of patients
             if os.path.exists(path_to_cache_file):
-                print(f"Loading `seq_length_per_patient.json` from `{path_to_cache_file}` for split=`{dataset.split}`")
-                data: TokenizerSeqLengthPerPatientCache = json.load(open(path_to_cache_file, 'r'))
-                seq_lengths: List[int] = data['seq_lengths']
+                print(f"Loading `seq_length_per_patient.npy` from `{path_to_cache_file}` for split=`{dataset.split}`")
+                seq_lengths: np.ndarray = np.load(path_to_cache_file)
+                if len(seq_lengths) == n_patients:
+                    return seq_lengths
+                print(f"The # of `seq_lengths` in `{path_to_cache_file}` didn't match this dataset's length ({len(seq_lengths)} != {n_patients}), so recreating `seq_length_per_patient.npy` from scratch now...")
+            elif os.path.exists(path_to_legacy_cache_file):
+                # Convert old `seq_length_per_patient.json` => `seq_length_per_patient.npy`
+                print(f"Loading `seq_length_per_patient.json` from `{path_to_legacy_cache_file}` for split=`{dataset.split}`")
+                data: TokenizerSeqLengthPerPatientCache = json.load(open(path_to_legacy_cache_file, 'r'))
                 if (
-                    len(seq_lengths) == dataset.get_n_patients() 
+                    len(data['seq_lengths']) == n_patients
                     and is_metadata_equal(self.metadata, data.get('tokenizer_metadata'))
                     and is_metadata_equal(dataset.metadata, data.get('dataset_metadata'))
                 ):
+                    seq_lengths: np.ndarray = np.array(data['seq_lengths'], dtype=np.int64)
+                    np.save(path_to_cache_file, seq_lengths)
                     return seq_lengths
-                print(f"The # of `seq_lengths` in `{path_to_cache_file}` didn't match this dataset's length ({len(seq_lengths)} != {dataset.get_n_patients()}) or the `metadata` differed for tokenizer ({self.metadata} != {data['tokenizer_metadata']}) or dataset ({dataset.metadata} != {data['dataset_metadata']}), so recreating `seq_length_per_patient.json` from scratch now...")
+                print(f"The # of `seq_lengths` in `{path_to_legacy_cache_file}` didn't match this dataset's length or the `metadata` differed, so recreating `seq_length_per_patient.npy` from scratch now...")
             else:
-                print(f"No `seq_length_per_patient.json` found at `{path_to_cache_file}` for split=`{dataset.split}`. Generating `seq_length_per_patient.json` now...")
-
-        # Calculate seq lengths in parallel
-        n_procs = 1 # TODO - remove
-        if n_procs == 1:
-            tasks: List[Tuple] = [(dataset.metadata, start, min(dataset.get_n_patients(), start + 1),) for start in range(0, dataset.get_n_patients(), 1) ]
-            results: List[List[Tuple[int,int]]] = [ self.get_seq_length(t) for t in tqdm(tasks, total=len(tasks), desc=f"tokenizer.get_seq_length_per_patient() | n_procs={n_procs}") ]
-        else:
-            chunk_size: int = 5_000
-            tasks: List[Tuple] = [(dataset.metadata, start, min(dataset.get_n_patients(), start + chunk_size),) for start in range(0, dataset.get_n_patients(), chunk_size) ]
-            with multiprocessing.Pool(processes=n_procs) as pool:
-                results: List[List[Tuple[int,int]]] = list(tqdm(pool.imap_unordered(self.get_seq_length, tasks), total=len(tasks), desc=f"tokenizer.get_seq_length_per_patient() | n_procs={n_procs}"))
-        flattened_results: List[Tuple[int, int]] = [ x for sublist in results for x in sublist ] # type: ignore
-        seq_lengths: List[int] = [ x[1] for x in sorted(flattened_results, key=lambda x: x[0]) ]
-        json.dump({ 
-            'timestamp' : datetime.datetime.now().isoformat(), 
-            'tokenizer_metadata' : self.metadata, 
-            'dataset_metadata' : dataset.metadata, 
-            'seq_lengths' : seq_lengths 
-        }, open(path_to_cache_file, 'w'), indent=2)
+                print(f"No `seq_length_per_patient.npy` found at `{path_to_cache_file}` for split=`{dataset.split}`. Generating `seq_length_per_patient.npy` now...")
+        elif os.path.exists(path_to_chunks_dir):
+            # Don't resume from old checkpoints
+            shutil.rmtree(path_to_chunks_dir, ignore_errors=True)
+        os.makedirs(path_to_chunks_dir, exist_ok=True)
+
+        # Skip chunks that were already checkpointed by a previous (crashed) run
+        chunks: List[Tuple[int, int]] = [ (start, min(n_patients, start + chunk_size)) for start in range(0, n_patients, chunk_size) ]
+        get_path_to_chunk = lambda chunk: os.path.join(path_to_chunks_dir, f"{chunk[0]}-{chunk[1]}.npy")
+        tasks: List[Tuple[int, int]] = [ chunk for chunk in chunks if not os.path.exists(get_path_to_chunk(chunk)) ]
+        if len(tasks) < len(chunks):
+            print(f"Resuming from {len(chunks) - len(tasks)} / {len(chunks)} chunks already checkpointed in `{path_to_chunks_dir}`")
+
+        # NOTE: Every DDP rank may run this at the same time on the first run, so another process can finish first and
+        # delete `path_to_chunks_dir` while we're still using it -- in that case, just load its `seq_length_per_patient.npy`
+        stale_cache_mtime_ns: Optional[int] = os.stat(path_to_cache_file).st_mtime_ns if os.path.exists(path_to_cache_file) else None
+        is_cache_written_by_other_process = lambda: os.path.exists(path_to_cache_file) and os.stat(path_to_cache_file).st_mtime_ns != stale_cache_mtime_ns
+        try:
+            # Calculate seq lengths in parallel
+            # NOTE: AllTokensFEMRDataset indexes subsequences, not patients, so we need to load the underlying patient-level dataset
+            from hf_ehr.data.datasets import FEMRDataset, MEDSDataset
+            worker_dataset = dataset if type(dataset) in [ FEMRDataset, MEDSDataset ] else None
+            n_procs = max(1, min(n_procs, len(tasks)))
+            if n_procs == 1:
+                init_seq_length_worker(self, dataset.metadata, worker_dataset)
+                results = ( calc_seq_length_chunk(task) for task in tasks )
+                for task, seq_lengths in tqdm(results, total=len(tasks), desc=f"tokenizer.get_seq_length_per_patient() | n_procs={n_procs}"):
+                    save_seq_length_chunk(seq_lengths, get_path_to_chunk(task))
+            else:
+                # Send the tokenizer + open the dataset ONCE per worker (rather than once per task)
+                with multiprocessing.Pool(processes=n_procs, initializer=init_seq_length_worker, initargs=(self, dataset.metadata,)) as pool:
+                    results = pool.imap_unordered(calc_seq_length_chunk, tasks)
+                    for task, seq_lengths in tqdm(results, total=len(tasks), desc=f"tokenizer.get_seq_length_per_patient() | n_procs={n_procs}"):
+                        save_seq_length_chunk(seq_lengths, get_path_to_chunk(task))
+
+            # Merge chunks (unless another process already did)
+            if not is_cache_written_by_other_process():
+                seq_lengths: np.ndarray = np.concatenate([ np.load(get_path_to_chunk(chunk)) for chunk in chunks ]) if len(chunks) > 0 else np.zeros(0, dtype=np.int64)
+                assert len(seq_lengths) == n_patients, f"ERROR - Expected {n_patients} seq_lengths, but got {len(seq_lengths)}"
+                save_seq_length_chunk(seq_lengths, path_to_cache_file)
+        except FileNotFoundError:
+            if not is_cache_written_by_other_process():
+                raise
+            print(f"Another process finished `{path_to_cache_file}` first, so loading it")
+        seq_lengths: np.ndarray = np.load(path_to_cache_file)
+        assert len(seq_lengths) == n_patients, f"ERROR - Expected {n_patients} seq_lengths in `{path_to_cache_file}`, but got {len(seq_lengths)}"
+        shutil.rmtree(path_to_chunks_dir, ignore_errors=True)
         return seq_lengths
 
 class BaseCodeTokenizer(BaseTokenizer):
+    is_match_units: bool = False # if TRUE, then a numerical value's unit must match the token's unit when looking up its token
+    compiled_cache_format_version: int = 1 # bump to invalidate all compiled tokenizer caches
 
     def __init__(self) -> None:
+        # Load tokens + lookup tables from the compiled tokenizer cache (if it exists), otherwise build them from `tokenizer_config`
+        # NOTE: Must set `self.path_to_tokenizer_config` and `self.metadata` before calling this
+        if isinstance(self.metadata, DictConfig):
+            self.metadata = OmegaConf.to_container(self.metadata, resolve=True)
+        path_to_compiled_dir: str = self.get_path_to_compiled_tokenizer_dir()
+        compiled_lookup: Optional[CompiledCodeLookup] = None
+        if os.path.exists(os.path.join(path_to_compiled_dir, 'metadata.json')):
+            self.non_special_tokens = decode_strings(*[ np.load(os.path.join(path_to_compiled_dir, f'non_special_tokens__{key}.npy')) for key in [ 'blob', 'offsets', 'is_null' ] ])
+            compiled_lookup = CompiledCodeLookup.load(os.path.join(path_to_compiled_dir, 'lookup/'))
+            # `tokenizer_config`, `code_2_token`, etc. aren't needed for tokenization, so only load them on first access (see `__getattr__()`)
+            self.is_tokenizer_config_lazy: bool = True
+        else:
+            self.load_tokenizer_config()
+            self.is_tokenizer_config_lazy: bool = False
+
         # Create vocab
         self.special_tokens = [ '[BOS]', '[EOS]', '[UNK]', '[SEP]', '[PAD]', '[CLS]', '[MASK]']
         self.vocab = self.special_tokens + self.non_special_tokens
@@ -312,25 +742,111 @@ class BaseCodeTokenizer(BaseTokenizer):
             cls_token='[CLS]',
             mask_token='[MASK]',
         )
-        self.add_tokens(self.non_special_tokens)
+        self.add_non_special_tokens()
         self.clean_up_tokenization_spaces = False # to avoid HuggingFace deprecation warning
+
+        # Compile `code_2_token` into integer lookup tables for fast Event => token id conversion
+        if compiled_lookup is None:
+            compiled_lookup = CompiledCodeLookup(self.code_2_token, self.token_2_idx, is_match_units=self.is_match_units)
+            self.save_to_compiled_cache(path_to_compiled_dir, compiled_lookup)
+        self.compiled_lookup: CompiledCodeLookup = compiled_lookup
+
+    def __getattr__(self, key: str) -> Any:
+        # Only called if `key` isn't already set, i.e. for attributes that we skipped when loading from the compiled tokenizer cache
+        if key in [ 'tokenizer_config', 'excluded_tokens', 'code_2_token' ] and self.__dict__.get('is_tokenizer_config_lazy', False):
+            self.load_tokenizer_config()
+            self.is_tokenizer_config_lazy = False
+            return getattr(self, key)
+        return super().__getattr__(key)
+
+    def load_tokenizer_config(self) -> None:
+        """Load `self.tokenizer_config` from `self.path_to_tokenizer_config`, then build `self.code_2_token` + `self.non_special_tokens` from it.
+            Child classes can override this to filter the config first."""
+        self.tokenizer_config: List[TokenizerConfigEntry] = load_tokenizer_config_from_path(self.path_to_tokenizer_config)
+        self.code_2_token, self.non_special_tokens = build_code_2_token(self.tokenizer_config)
+
+    def add_non_special_tokens(self) -> None:
+        """
+            Equivalent to `self.add_tokens(self.non_special_tokens)`, but ~50x faster for large vocabs (i.e. 30s => 0.6s for 350k tokens).
+            HuggingFace's `add_tokens()` recomputes `all_special_tokens` for every token, then rebuilds `self.tokens_trie`.
+            We skip both -- none of our tokens are special, and `self.tokens_trie` is only used by `PreTrainedTokenizer.tokenize()`, which we override.
+        """
+        for token in self.non_special_tokens:
+            if token == '' or token in self._added_tokens_encoder:
+                continue
+            token_idx: int = self.token_2_idx[token]
+            self._added_tokens_decoder[token_idx] = AddedToken(token, rstrip=False, lstrip=False, normalized=True, special=False)
+            self._added_tokens_encoder[token] = token_idx
+        self._update_total_vocab_size()
+
+    ########################################################
+    # Compiled tokenizer cache
+    ########################################################
+    def get_path_to_compiled_tokenizer_dir(self) -> str:
+        """
+            Example path: /share/pi/nigam/mwornow/hf_ehr/cache/tokenizer_v8/versions/2021-08-10_15-00-00/compiled/5f1d.../
+
+            Folder containing this tokenizer's tokens + lookup tables, so that we don't have to rebuild them from `tokenizer_config` every time.
+            Keyed by a hash of `tokenizer_config.json` (its size + last modified time) + `self.metadata`, so editing either one invalidates the cache.
+        """
+        config_stat: os.stat_result = os.stat(self.path_to_tokenizer_config)
+        key: str = hashlib.sha256(json.dumps({
+            'format_version' : self.compiled_cache_format_version,
+            'metadata' : self.metadata,
+            'path_to_tokenizer_config' : os.path.basename(self.path_to_tokenizer_config),
+            'tokenizer_config_size' : config_stat.st_size,
+            'tokenizer_config_mtime_ns' : config_stat.st_mtime_ns,
+        }, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        return os.path.join(self.get_path_to_tokenizer_version_dir(), 'compiled/', key)
+
+    def save_to_compiled_cache(self, path_to_compiled_dir: str, compiled_lookup: CompiledCodeLookup) -> None:
+        """Write tokens + lookup tables to `path_to_compiled_dir`. 
+            Writes to a temp folder first, then renames it, so that concurrent processes never see a partially written cache."""
+        path_to_tmp_dir: str = f"{path_to_compiled_dir.rstrip('/')}.tmp-{os.getpid()}"
+        try:
+            os.makedirs(path_to_tmp_dir, exist_ok=True)
+            for key, val in encode_strings(self.non_special_tokens).items():
+                np.save(os.path.join(path_to_tmp_dir, f'non_special_tokens__{key}.npy'), val)
+            compiled_lookup.save(os.path.join(path_to_tmp_dir, 'lookup/'))
+            json.dump({
+                'timestamp' : datetime.datetime.now().isoformat(),
+                'metadata' : self.metadata,
+                'path_to_tokenizer_config' : self.path_to_tokenizer_config,
+            }, open(os.path.join(path_to_tmp_dir, 'metadata.json'), 'w'), indent=2)
+            os.rename(path_to_tmp_dir, path_to_compiled_dir)
+        except OSError as e:
+            # e.g. another process already created the cache, or read-only filesystem
+            if not os.path.exists(os.path.join(path_to_compiled_dir, 'metadata.json')):
+                print(f"Could not save compiled tokenizer to `{path_to_compiled_dir}`: {e}")
+        finally:
+            shutil.rmtree(path_to_tmp_dir, ignore_errors=True)
     
     def __call__(self, 
-                 batch_of_events: Union[List[Event], List[List[Event]]],
+                 batch_of_events: Union[List[Event], List[List[Event]], Timeline, List[Timeline]],
                  is_truncation_random: bool = False,
                  seed: int = 1,
+                 is_fast_path: bool = True,
                  **kwargs) -> Dict[str, torch.Tensor]:
         """Tokenize a batch of patient timelines, where each timeline is a list of event codes.
             We add the ability to truncate seqs at random time points.
             
-            Expects as input a list of Events
+            Expects as input a list of Events (or a Timeline)
+
+            If `is_fast_path` is TRUE (and `kwargs` are supported), then we skip HuggingFace's PreTrainedTokenizer.__call__() 
+            and go directly from Events => token ids => padded tensors. Outputs are identical to the HuggingFace path.
 
             NOTE: Must set `is_split_into_words=True` b/c we've already pre-tokenized our inputs (i.e. we're passing in a List of tokens, not a string)
         """
-        if not isinstance(batch_of_events[0], list):
+        if not isinstance(batch_of_events[0], (list, Timeline)):
             # List[Event] => List[List[Event]]
             batch_of_events = [ batch_of_events ] # type: ignore
+        is_fast_path = is_fast_path and self.is_fast_path_supported(**kwargs)
         
+        if is_fast_path:
+            # Convert all Events => token ids, then skip straight to truncation + padding
+            batch: List[List[int]] = [ self.convert_events_to_token_ids(x) for x in batch_of_events ]
+            return self.call_on_token_ids(batch, is_truncation_random=is_truncation_random, seed=seed, **kwargs)
+
         # First, convert all Events => ProtoTokens
         batch: List[List[str]] = [ self.convert_events_to_tokens(x) for x in batch_of_events ]
 
@@ -344,37 +860,12 @@ class BaseCodeTokenizer(BaseTokenizer):
 
         # Third, tokenize the batch
         if is_truncation_random:
-            max_length: int = kwargs.get("max_length")
-            if not max_length:
-                raise ValueError(f"If you specify `is_truncation_random`, then you must also provide a non-None value for `max_length`")
-
-            # Tokenize without truncation
+            max_length: int = self.check_random_truncation_kwargs(**kwargs)
             kwargs.pop('max_length')
             kwargs.pop('truncation')
+            # Tokenize without truncation, then truncate at random positions
             tokenized_batch: Dict[str, torch.Tensor] = super().__call__(batch, **kwargs, truncation=None, is_split_into_words=True)
-
-            # Truncate at random positions
-            random.seed(seed)
-            start_idxs: List[int] = []
-            for timeline in tokenized_batch['input_ids']:
-                length: int = (timeline != self.pad_token_id).sum() # count of non-PAD tokens
-                if length > max_length:
-                    # Calculate a random start index
-                    start_index: int = random.randint(0, length - max_length)
-                    start_idxs.append(start_index)
-                else:
-                    start_idxs.append(0)
-                    
-            for key in tokenized_batch.keys():
-                truncated_batch: List[List[int]] = []
-                for idx, timeline in enumerate(tokenized_batch[key]):
-                    new_timeline = timeline[start_idxs[idx]:start_idxs[idx] + max_length]
-                    assert new_timeline.shape[0] <= max_length, f"Error in truncating by random positions: new_timeline.shape = {new_timeline.shape[0]} !<= max_length={max_length}"
-                    truncated_batch.append(new_timeline)
-                if kwargs.get('return_tensors') == 'pt':
-                    tokenized_batch[key] = torch.stack(truncated_batch, dim=0)
-                else:
-                    tokenized_batch[key] = truncated_batch
+            tokenized_batch = self.truncate_at_random_positions(tokenized_batch, max_length, seed)
         else:
             try:
                 tokenized_batch: Dict[str, torch.Tensor] = super().__call__(batch, **kwargs, is_split_into_words=True)
@@ -384,6 +875,131 @@ class BaseCodeTokenizer(BaseTokenizer):
 
         return tokenized_batch
 
+    def call_on_token_ids(self, 
+                          batch_of_token_ids: List[Union[List[int], np.ndarray]],
+                          is_truncation_random: bool = False,
+                          seed: int = 1,
+                          **kwargs) -> BatchEncoding:
+        """Same as `__call__()`, but for timelines that have already been converted to token ids
+            (e.g. by `convert_events_to_token_ids()`, or loaded from a `PretokenizedDataset`).
+            Only supports the `kwargs` accepted by `is_fast_path_supported()`.
+        """
+        assert self.is_fast_path_supported(**kwargs), f"ERROR - Unsupported kwargs for `call_on_token_ids()`: {kwargs}"
+        batch: List[List[int]] = [ x.tolist() if isinstance(x, np.ndarray) else x for x in batch_of_token_ids ]
+
+        # Add special tokens (if applicable)
+        if kwargs.get("add_special_tokens", False):
+            batch = [ [ self.cls_token_id, self.bos_token_id ] + x + [ self.eos_token_id ] for x in batch ]
+
+        # Replace timelines with length 0 with a timeline of length 1 (i.e. [self.pad_token_id]) to match HuggingFace path
+        batch = [ x if len(x) > 0 else [ self.pad_token_id ] for x in batch ]
+
+        if is_truncation_random:
+            max_length: int = self.check_random_truncation_kwargs(**kwargs)
+            # Truncate token ids at random positions BEFORE padding, so we never materialize the untruncated batch
+            batch = self.truncate_token_ids_at_random_positions(batch, max_length, seed)
+            return self.pad_token_ids(batch, truncation=None)
+        return self.pad_token_ids(batch, truncation=kwargs.get('truncation'), max_length=kwargs.get('max_length'))
+
+    def call_on_token_ids_packed(self, 
+                                 batch_of_token_ids: List[Union[List[int], np.ndarray]],
+                                 max_length: int,
+                                 is_truncation_random: bool = False,
+                                 seed: int = 1) -> BatchEncoding:
+        """Same as `call_on_token_ids(..., truncation=True, padding=True, add_special_tokens=True, return_tensors='pt')`, 
+            except that instead of padding each timeline to the longest timeline in the batch, we pack several timelines into each row (see `pack_token_ids()`).
+            Each timeline is wrapped in [CLS] [BOS] ... [EOS], so the boundaries between packed timelines are explicit.
+        """
+        batch: List[List[int]] = [ x.tolist() if isinstance(x, np.ndarray) else x for x in batch_of_token_ids ]
+        batch = [ [ self.cls_token_id, self.bos_token_id ] + x + [ self.eos_token_id ] for x in batch ]
+        if is_truncation_random:
+            batch = self.truncate_token_ids_at_random_positions(batch, max_length, seed)
+        else:
+            batch = [ x[:max_length] for x in batch ]
+        return self.pack_token_ids(batch, max_length)
+
+    def truncate_token_ids_at_random_positions(self, batch: List[List[int]], max_length: int, seed: int) -> List[List[int]]:
+        """Keep a random window of `max_length` token ids from each timeline in `batch`"""
+        lengths: torch.Tensor = torch.tensor([ len(x) for x in batch ], dtype=torch.long)
+        start_idxs: List[int] = get_random_truncation_start_idxs(lengths, max_length, seed).tolist()
+        return [ x[start_idx:start_idx + max_length] for x, start_idx in zip(batch, start_idxs) ]
+
+    def check_random_truncation_kwargs(self, **kwargs) -> int:
+        """Validate `kwargs` for `is_truncation_random=True`, and return `max_length`"""
+        max_length: int = kwargs.get("max_length")
+        if not max_length:
+            raise ValueError(f"If you specify `is_truncation_random`, then you must also provide a non-None value for `max_length`")
+        if kwargs.get('return_tensors') != 'pt':
+            raise ValueError(f"If you specify `is_truncation_random`, then you must also set `return_tensors='pt'`")
+        return max_length
+
+    def get_seq_length_of_events(self, events: List[Event]) -> int:
+        """Return the number of tokens in this timeline (without special tokens). 
+            Same as `len(self.__call__(events)['input_ids'][0])`, but skips padding/tensor creation."""
+        return max(1, len(self.convert_events_to_token_ids(events))) # timelines with 0 tokens get replaced by [PAD] in __call__()
+
+    def is_fast_path_supported(self, **kwargs) -> bool:
+        """Return TRUE if `pad_token_ids()` can exactly reproduce HuggingFace's PreTrainedTokenizer.__call__() for these `kwargs`,
+            i.e. right-side truncation to `max_length`, right-side padding to the longest seq in the batch, returning PyTorch tensors."""
+        return (
+            set(kwargs.keys()).issubset({ 'truncation', 'padding', 'max_length', 'add_special_tokens', 'return_tensors' })
+            and kwargs.get('return_tensors') == 'pt'
+            and kwargs.get('padding') in [ True, 'longest' ]
+            and kwargs.get('truncation') in [ None, False, True, 'longest_first' ]
+            and self.padding_side == 'right'
+            and self.truncation_side == 'right'
+        )
+
+    def pad_token_ids(self, 
+                      batch: List[List[int]], 
+                      truncation: Optional[Union[bool, str]] = None, 
+                      max_length: Optional[int] = None) -> BatchEncoding:
+        """Truncate (right-side) and pad (right-side, to longest seq in batch) a batch of token ids into preallocated tensors."""
+        lengths: List[int] = [ len(x) for x in batch ]
+        if truncation and max_length is not None:
+            lengths = [ min(length, max_length) for length in lengths ]
+        input_ids: np.ndarray = np.full((len(batch), max(lengths)), self.pad_token_id, dtype=np.int64)
+        attention_mask: np.ndarray = np.zeros((len(batch), max(lengths)), dtype=np.int64)
+        for idx, (token_ids, length) in enumerate(zip(batch, lengths)):
+            input_ids[idx, :length] = token_ids[:length]
+            attention_mask[idx, :length] = 1
+        return BatchEncoding({
+            'input_ids' : torch.from_numpy(input_ids),
+            'token_type_ids' : torch.zeros(input_ids.shape, dtype=torch.long),
+            'attention_mask' : torch.from_numpy(attention_mask),
+        })
+
+    def pack_token_ids(self, batch: List[List[int]], max_length: int) -> BatchEncoding:
+        """
+            Pack a batch of (already truncated) token ids into rows of at most `max_length` tokens, then right-pad to the longest row.
+            In addition to the usual `input_ids`, `token_type_ids`, and `attention_mask` (1 for non-PAD tokens), returns:
+                `position_ids`: Position of each token within its own timeline (i.e. resets to 0 at the start of each timeline)
+                `segment_ids`: 1, 2, 3, ... for the 1st, 2nd, 3rd, ... timeline packed into each row; 0 for PAD tokens
+            Models must use `segment_ids` to build a block-diagonal attention mask (see `BaseModel.get_model_inputs()`), 
+            otherwise timelines packed into the same row will attend to each other.
+        """
+        lengths: List[int] = [ len(x) for x in batch ]
+        assert max(lengths) <= max_length, f"ERROR - Must truncate token ids to `max_length={max_length}` before packing, but got a timeline of length {max(lengths)}"
+        rows: List[List[int]] = get_first_fit_decreasing_rows(lengths, max_length)
+        row_lengths: List[int] = [ sum(lengths[idx] for idx in row) for row in rows ]
+        input_ids: np.ndarray = np.full((len(rows), max(row_lengths)), self.pad_token_id, dtype=np.int64)
+        position_ids: np.ndarray = np.zeros((len(rows), max(row_lengths)), dtype=np.int64)
+        segment_ids: np.ndarray = np.zeros((len(rows), max(row_lengths)), dtype=np.int64)
+        for row_idx, row in enumerate(rows):
+            start: int = 0
+            for segment_idx, idx in enumerate(row):
+                input_ids[row_idx, start:start + lengths[idx]] = batch[idx]
+                position_ids[row_idx, start:start + lengths[idx]] = np.arange(lengths[idx])
+                segment_ids[row_idx, start:start + lengths[idx]] = segment_idx + 1
+                start += lengths[idx]
+        return BatchEncoding({
+            'input_ids' : torch.from_numpy(input_ids),
+            'token_type_ids' : torch.zeros(input_ids.shape, dtype=torch.long),
+            'attention_mask' : torch.from_numpy((segment_ids > 0).astype(np.int64)),
+            'position_ids' : torch.from_numpy(position_ids),
+            'segment_ids' : torch.from_numpy(segment_ids),
+        })
+
     """Mandatory overwrites of base class"""
     @property
     def vocab_size(self) -> int:
@@ -406,6 +1022,34 @@ class BaseCodeTokenizer(BaseTokenizer):
     def _convert_id_to_token(self, index: int) -> str:
         raise self.idx_2_token[index]
 
+    def convert_events_to_tokenized_events(self, events: Union[List[Event], Timeline], **kwargs) -> Union[List[Event], Timeline]:
+        """Returns all events that DO get mapped to tokens (as a Timeline if `events` is a Timeline)"""
+        is_tokenized: np.ndarray = self.compiled_lookup.lookup_events(events) >= 0
+        if isinstance(events, Timeline):
+            return events[is_tokenized]
+        return [ e for e, is_token in zip(events, is_tokenized.tolist()) if is_token ]
+
+    def convert_event_to_token_id(self, e: Event, **kwargs) -> int:
+        """Return token id for this Event (or -1 if no token)"""
+        token: Optional[str] = self.convert_event_to_token(e, **kwargs)
+        return self.token_2_idx[token] if token is not None else -1
+
+    def convert_events_to_token_ids(self, events: List[Event], **kwargs) -> List[int]:
+        """Provide default implementation that maps `convert_events_to_tokens()` => token ids"""
+        return [ self.token_2_idx[x] for x in self.convert_events_to_tokens(events, **kwargs) ]
+
+    def convert_events_to_token_ids_and_times(self, events: List[Event], **kwargs) -> Tuple[List[int], List[datetime.datetime]]:
+        """Provide default implementation for tokenizers that map each Event => at most one token, 
+            so each token's timestamp is the start time of its Event"""
+        token_ids: List[int] = []
+        token_times: List[datetime.datetime] = []
+        for e in events:
+            token_id: int = self.convert_event_to_token_id(e, **kwargs)
+            if token_id >= 0:
+                token_ids.append(token_id)
+                token_times.append(e.start)
+        return token_ids, token_times
+
 class CookbookTokenizer(BaseCodeTokenizer):
     """
         Settings:
@@ -416,11 +1060,12 @@ class CookbookTokenizer(BaseCodeTokenizer):
             min_code_occurrence_count: Optional[int]
                 - Only keep tokens with >= `min_code_occurrence_count` total occurrences in our dataset
     """
+    is_match_units: bool = True # NOTE: Cookbook requires units to match
+
     def __init__(self, 
                  path_to_tokenizer_config: str, 
                  metadata: Optional[Dict[str, Any]] = None) -> None:
         self.path_to_tokenizer_config: str = path_to_tokenizer_config
-        self.tokenizer_config: List[TokenizerConfigEntry] = load_tokenizer_config_from_path(path_to_tokenizer_config)
         
         # Set metadata
         self.metadata: Dict[str, Any] = {} if metadata is None else dict(metadata)
@@ -463,114 +1108,73 @@ class CookbookTokenizer(BaseCodeTokenizer):
         self.min_code_occurrence_count: Optional[int] = metadata.get('min_code_occurrence_count', None)
         self.keep_n_max_occurrence_codes: Optional[int] = metadata.get('keep_n_max_occurrence_codes', None)
 
+        # Create tokenizer
+        super().__init__()
+
+    def load_tokenizer_config(self) -> None:
+        self.tokenizer_config: List[TokenizerConfigEntry] = load_tokenizer_config_from_path(self.path_to_tokenizer_config)
+
         # Apply filtering
         self.tokenizer_config, self.excluded_tokens = filter_tokenizer_config(self.tokenizer_config, 
                                                                               self.excluded_vocabs, 
                                                                               self.min_code_occurrence_count,
                                                                               self.keep_n_max_occurrence_codes)
         # Tokens
-        self.code_2_token = {} # [key] = token; [val] = { 'type' : str, 'tokenization' : dict, 'token' : str }
-        self.non_special_tokens: List[str] = []
-        
-        # Preprocess tokenizer config for quick access
-        for entry in self.tokenizer_config: # NOTE: Takes ~10 seconds for 1.5M tokens
-            if entry.code not in self.code_2_token: self.code_2_token[entry.code] = {}
-            if entry.type not in self.code_2_token[entry.code]: self.code_2_token[entry.code][entry.type] = []
-            self.code_2_token[entry.code][entry.type].append({
-                'tokenization': entry.tokenization,
-                'token' : entry.to_token(),
-            })
-            self.non_special_tokens.append(entry.to_token())
-        
-        # Create tokenizer
-        super().__init__()
+        self.code_2_token, self.non_special_tokens = build_code_2_token(self.tokenizer_config)
 
     def convert_event_to_token(self, e: Event, **kwargs) -> Optional[str]:
-        """NOTE: This is basically the same as the CLMBR tokenizer's version."""
-        event_code = e.code
-        # If code isn't in vocab => ignore
-        if event_code not in self.code_2_token:
-            return None
-        
-        event_value = e.value
-        # If numerical code...
-        if (
-            'numerical_range' in self.code_2_token[event_code] # `numerical_range` is a valid type for this code
-            and event_value is not None # `value` is not None
-            and ( # `value` is numeric
-                isinstance(event_value, float)
-                or isinstance(event_value, int)
-            )
-        ):
-            for token_range in self.code_2_token[event_code]['numerical_range']:
-                assert 'token' in token_range, f"ERROR - Missing 'token' for code={e.code},type=numerical_range in self.code_2_token: {self.code_2_token[e.code]['numerical_range']}"
-                assert 'tokenization' in token_range, f"ERROR - Missing 'tokenization' for code={e.code},type=numerical_range in self.code_2_token: {self.code_2_token[e.code]['numerical_range']}"
-                token: str = token_range['token']
-                unit: str = token_range['tokenization']['unit']
-                range_start: float = token_range['tokenization']['range_start']
-                range_end: float = token_range['tokenization']['range_end']
-                if range_start <= event_value <= range_end and e.unit == unit:
-                    return token
-            return None
+        """NOTE: This is basically the same as the CLMBR tokenizer's version, except that units must match."""
+        token_id: int = self.convert_event_to_token_id(e, **kwargs)
+        return self.idx_2_token[token_id] if token_id >= 0 else None
 
-        # If textual code...
-        if (
-            'categorical' in self.code_2_token[event_code] # `categorical` is a valid type for this code
-            and event_value is not None # `value` is not None
-            and event_value != '' # `value` is not blank
-            and ( # `value` is textual
-                isinstance(event_value, str)
-            )
-        ):
-            for categorical_value in self.code_2_token[event_code]['categorical']:
-                assert 'token' in categorical_value, f"ERROR - Missing 'token' for code={event_code},type=categorical in self.code_2_token: {self.code_2_token[event_code]['categorical']}"
-                assert 'tokenization' in categorical_value, f"ERROR - Missing 'tokenization' for code={event_code},type=categorical in self.code_2_token: {self.code_2_token[event_code]['categorical']}"
-                if event_value in categorical_value['tokenization']['categories']:
-                    token: str = categorical_value['token']
-                    return token
-            return None
+    def convert_event_to_token_id(self, e: Event, **kwargs) -> int:
+        """Return token id for this Event (or -1 if no token), using the compiled lookup tables."""
+        return self.compiled_lookup.lookup(e.code, e.value, e.unit)
 
-        # If just vanilla code...
-        if (
-            'code' in self.code_2_token[event_code] # `code` is a valid type for this code
-        ):
-            token: str = self.code_2_token[event_code]['code'][0]['token']
-            return token
-
-        return None
-    
     def convert_events_to_tokens(self, events: List[Event], **kwargs) -> List[str]:
-        tokens: List[str] = []
+        return [ self.idx_2_token[x] for x in self.convert_events_to_token_ids(events, **kwargs) ]
+
+    def convert_events_to_token_ids(self, events: List[Event], **kwargs) -> List[int]:
+        return self.convert_events_to_token_ids_and_times(events, **kwargs)[0]
+
+    def convert_events_to_token_ids_and_times(self, events: Union[List[Event], Timeline], **kwargs) -> Tuple[List[int], List[datetime.datetime]]:
+        """Return token ids and the timestamp of each token. Inserted visit/ATT tokens get the start time of the event that triggered them."""
+        token_ids: List[int] = []
+        token_times: List[datetime.datetime] = [] # [idx] = timestamp of `token_ids[idx]`
+        event_token_ids: np.ndarray = self.compiled_lookup.lookup_events(events) # [idx] = token id of `events[idx]` (or -1 if no token)
+        starts, ends, is_visits = get_event_times_and_is_visit(events)
         current_visit_end: Optional[datetime.datetime] = None # track the end time of the currently active visit
         previous_visit_end: Optional[datetime.datetime] = None # track the end time of the immediately preceding visit
 
-        for e in events:
+        for idx, (start, end, is_visit, token_id) in enumerate(zip(starts, ends, is_visits, event_token_ids.tolist())):
 
             # Check if we need to add a visit end token
             if current_visit_end is not None and (
-                e.start > current_visit_end # If we have [VISIT A = { TOKEN 1, TOKEN 2 }] [TOKEN 3], then add a visit end token before [TOKEN 3]
-                or "Visit" in e.code # If we have [VISIT A = { TOKEN 1, TOKEN 2 }] [VISIT B = { TOKEN 3, TOKEN 4 }], then add a visit end token after [VISIT A]
+                start > current_visit_end # If we have [VISIT A = { TOKEN 1, TOKEN 2 }] [TOKEN 3], then add a visit end token before [TOKEN 3]
+                or is_visit # If we have [VISIT A = { TOKEN 1, TOKEN 2 }] [VISIT B = { TOKEN 3, TOKEN 4 }], then add a visit end token after [VISIT A]
             ):
                 # This token occurs after the currently active visit ends, so end it (if exists)
                 if self.is_add_visit_end:
-                    tokens.append(self.visit_end)
+                    token_ids.append(self.token_2_idx[self.visit_end])
+                    token_times.append(start)
                 current_visit_end = None
 
             # Check if the event is a visit
-            if "Visit" in e.code:
+            if is_visit:
                     
                 # Add ATT Tokens, if applicable
                 # This will be inserted between the prior visit and the current visit
                 if previous_visit_end is not None:
-                    interval: float = (e.start - previous_visit_end).days # Time (in days) between this visit's start and the immediately preceding visit's end
-                    assert interval >= 0, f"Interval has value = {interval} but should always be positive, but fails on {e}."
+                    interval: float = (start - previous_visit_end).days # Time (in days) between this visit's start and the immediately preceding visit's end
+                    assert interval >= 0, f"Interval has value = {interval} but should always be positive, but fails on {events[idx]}."
                     
                     if self.is_add_day_att:
                         if interval <= 1080:
                             att = self.day_atts_cehr_gpt[interval - 1]
                         else:
                             att = self.long_att_cehr_gpt
-                        tokens.append(att)
+                        token_ids.append(self.token_2_idx[att])
+                        token_times.append(start)
                     elif self.is_add_day_week_month_att:
                         if interval < 7:
                             att = self.day_atts_cehr_bert[interval - 1]
@@ -580,109 +1184,67 @@ class CookbookTokenizer(BaseCodeTokenizer):
                             att = self.month_atts[(interval // 30) - 1]
                         else:
                             att = self.long_att_cehr_bert
-                        tokens.append(att)
+                        token_ids.append(self.token_2_idx[att])
+                        token_times.append(start)
 
                 # Add visit start token, if applicable
                 # if self.is_add_visit_start:
-                #     tokens.append(self.visit_start)
+                #     token_ids.append(self.token_2_idx[self.visit_start])
             
                 # Add token itself
-                token = self.convert_event_to_token(e, **kwargs)
-                if token:
-                    tokens.append(token)
+                if token_id >= 0:
+                    token_ids.append(token_id)
+                    token_times.append(start)
 
                 # Keep track of this visit's end
-                current_visit_end = e.end
-                previous_visit_end = e.end
+                current_visit_end = end
+                previous_visit_end = end
             else:
-                token = self.convert_event_to_token(e, **kwargs)
-                if token:
-                    tokens.append(token)
+                if token_id >= 0:
+                    token_ids.append(token_id)
+                    token_times.append(start)
         
-        return tokens
+        return token_ids, token_times
 
 class CLMBRTokenizer(BaseCodeTokenizer):
-    def __init__(self, path_to_tokenizer_config: str) -> None:
+    is_match_units: bool = False # NOTE: CLMBR ignores units
+
+    def __init__(self, path_to_tokenizer_config: str, metadata: Optional[Dict[str, Any]] = None) -> None:
         self.path_to_tokenizer_config: str = path_to_tokenizer_config
-        self.tokenizer_config: List[TokenizerConfigEntry] = load_tokenizer_config_from_path(path_to_tokenizer_config)
         
         # Set metadata        
-        self.metadata: Dict[str, Any] = {}
+        self.metadata: Dict[str, Any] = {} if metadata is None else dict(metadata)
         self.metadata['cls'] = 'CLMBRTokenizer'
 
-        # Preprocess tokenizer config for quick access
-        self.code_2_token = {} # [key] = token; [val] = { 'type' : str, 'tokenization' : dict, 'token' : str }
-        self.non_special_tokens: List[str] = []
-        for entry in self.tokenizer_config:
-            if entry.code not in self.code_2_token: self.code_2_token[entry.code] = {}
-            if entry.type not in self.code_2_token[entry.code]: self.code_2_token[entry.code][entry.type] = []
-            self.code_2_token[entry.code][entry.type].append({
-                'tokenization': entry.tokenization,
-                'token' : entry.to_token(),
-            })
-            self.non_special_tokens.append(entry.to_token())
-
         # assert len(self.non_special_tokens) == 39811, f"ERROR - Expected 39811 self.non_special_tokens, but got {len(self.non_special_tokens)}"
 
         # Create tokenizer
         super().__init__()
 
     def convert_event_to_token(self, e: Event, **kwargs) -> Optional[str]:
-        # If code isn't in CLMBR vocab => ignore
-        if e.code not in self.code_2_token:
-            return None
-        
-        # If numerical code...
-        if (
-            'numerical_range' in self.code_2_token[e.code] # `numerical_range` is a valid type for this code
-            and e.value is not None # `value` is not None
-            and ( # `value` is numeric
-                isinstance(e.value, float)
-                or isinstance(e.value, int)
-            )
-        ):
-            # NOTE: CLMBR ignores units
-            for token_range in self.code_2_token[e.code]['numerical_range']:
-                assert 'token' in token_range, f"ERROR - Missing 'token' for code={e.code},type=numerical_range in self.code_2_token: {self.code_2_token[e.code]['numerical_range']}"
-                assert 'tokenization' in token_range, f"ERROR - Missing 'tokenization' for code={e.code},type=numerical_range in self.code_2_token: {self.code_2_token[e.code]['numerical_range']}"
-                token: str = token_range['token']
-                range_start: float = token_range['tokenization']['range_start']
-                range_end: float = token_range['tokenization']['range_end']
-                if range_start <= e.value <= range_end:
-                    return token
-            return None
+        token_id: int = self.convert_event_to_token_id(e, **kwargs)
+        return self.idx_2_token[token_id] if token_id >= 0 else None
 
-        # If textual code...
-        if (
-            'categorical' in self.code_2_token[e.code] # `categorical` is a valid type for this code
-            and e.value is not None # `value` is not None
-            and e.value != '' # `value` is not blank
-            and ( # `value` is textual
-                isinstance(e.value, str)
-            )
-        ):
-            for categorical_value in self.code_2_token[e.code]['categorical']:
-                assert 'token' in categorical_value, f"ERROR - Missing 'token' for code={e.code},type=categorical in self.code_2_token: {self.code_2_token[e.code]['categorical']}"
-                assert 'tokenization' in categorical_value, f"ERROR - Missing 'tokenization' for code={e.code},type=categorical in self.code_2_token: {self.code_2_token[e.code]['categorical']}"
-                if e.value in categorical_value['tokenization']['categories']:
-                    token: str = categorical_value['token']
-                    return token
-            return None
+    def convert_event_to_token_id(self, e: Event, **kwargs) -> int:
+        """Return token id for this Event (or -1 if no token), using the compiled lookup tables."""
+        return self.compiled_lookup.lookup(e.code, e.value, e.unit)
 
-        # If just vanilla code...
-        if (
-            'code' in self.code_2_token[e.code] # `code` is a valid type for this code
-        ):
-            token: str = self.code_2_token[e.code]['code'][0]['token']
-            return token
+    def convert_events_to_token_ids(self, events: List[Event], **kwargs) -> List[int]:
+        token_ids: np.ndarray = self.compiled_lookup.lookup_events(events)
+        return token_ids[token_ids >= 0].tolist()
 
-        return None
+    def convert_events_to_token_ids_and_times(self, events: Union[List[Event], Timeline], **kwargs) -> Tuple[List[int], List[datetime.datetime]]:
+        token_ids: np.ndarray = self.compiled_lookup.lookup_events(events)
+        if isinstance(events, Timeline):
+            return token_ids[token_ids >= 0].tolist(), events.starts[token_ids >= 0].tolist()
+        return token_ids[token_ids >= 0].tolist(), [ e.start for e, token_id in zip(events, token_ids) if token_id >= 0 ]
 
 
 class CEHRTokenizer(BaseCodeTokenizer):
+    is_match_units: bool = False # NOTE: CEHR ignores units
+
     def __init__(self, path_to_tokenizer_config: str, metadata: Optional[Dict[str, Any]] = None) -> None:
         self.path_to_tokenizer_config: str = path_to_tokenizer_config
-        self.tokenizer_config: List[TokenizerConfigEntry] = load_tokenizer_config_from_path(path_to_tokenizer_config)
         
         # Set metadata        
         self.metadata: Dict[str, Any] = {} if metadata is None else dict(metadata)
@@ -708,143 +1270,114 @@ class CEHRTokenizer(BaseCodeTokenizer):
             self.visit_start, self.visit_end, self.long_att_cehr_gpt, self.long_att_cehr_bert
         ] + self.day_atts_cehr_gpt + self.day_atts_cehr_bert + self.week_atts + self.month_atts
 
-        # Preprocess tokenizer config for quick access
-        self.code_2_token = {} # [key] = token; [val] = { 'type' : str, 'tokenization' : dict, 'token' : str }
-        self.non_special_tokens: List[str] = []
-        for entry in self.tokenizer_config:
-            if entry.code not in self.code_2_token: self.code_2_token[entry.code] = {}
-            if entry.type not in self.code_2_token[entry.code]: self.code_2_token[entry.code][entry.type] = []
-            self.code_2_token[entry.code][entry.type].append({
-                'tokenization': entry.tokenization,
-                'token' : entry.to_token(),
-            })
-            self.non_special_tokens.append(entry.to_token())
-
         # assert len(self.non_special_tokens) == 39811, f"ERROR - Expected 39811 self.non_special_tokens, but got {len(self.non_special_tokens)}"
 
         # Create tokenizer
         super().__init__()
 
     def convert_event_to_token(self, e: Event, **kwargs) -> Optional[str]:
-        # If code isn't in CLMBR vocab => ignore
-        if e.code not in self.code_2_token:
-            return None
-        
-        # If numerical code...
-        if (
-            'numerical_range' in self.code_2_token[e.code] # `numerical_range` is a valid type for this code
-            and e.value is not None # `value` is not None
-            and ( # `value` is numeric
-                isinstance(e.value, float)
-                or isinstance(e.value, int)
-            )
-        ):
-            # NOTE: CLMBR ignores units
-            for token_range in self.code_2_token[e.code]['numerical_range']:
-                assert 'token' in token_range, f"ERROR - Missing 'token' for code={e.code},type=numerical_range in self.code_2_token: {self.code_2_token[e.code]['numerical_range']}"
-                assert 'tokenization' in token_range, f"ERROR - Missing 'tokenization' for code={e.code},type=numerical_range in self.code_2_token: {self.code_2_token[e.code]['numerical_range']}"
-                token: str = token_range['token']
-                range_start: float = token_range['tokenization']['range_start']
-                range_end: float = token_range['tokenization']['range_end']
-                if range_start <= e.value <= range_end:
-                    return token
-            return None
+        token_id: int = self.convert_event_to_token_id(e, **kwargs)
+        return self.idx_2_token[token_id] if token_id >= 0 else None
 
-        # If textual code...
-        if (
-            'categorical' in self.code_2_token[e.code] # `categorical` is a valid type for this code
-            and e.value is not None # `value` is not None
-            and e.value != '' # `value` is not blank
-            and ( # `value` is textual
-                isinstance(e.value, str)
-            )
-        ):
-            for categorical_value in self.code_2_token[e.code]['categorical']:
-                assert 'token' in categorical_value, f"ERROR - Missing 'token' for code={e.code},type=categorical in self.code_2_token: {self.code_2_token[e.code]['categorical']}"
-                assert 'tokenization' in categorical_value, f"ERROR - Missing 'tokenization' for code={e.code},type=categorical in self.code_2_token: {self.code_2_token[e.code]['categorical']}"
-                if e.value in categorical_value['tokenization']['categories']:
-                    token: str = categorical_value['token']
-                    return token
-            return None
-
-        # If just vanilla code...
-        if (
-            'code' in self.code_2_token[e.code] # `code` is a valid type for this code
-        ):
-            token: str = self.code_2_token[e.code]['code'][0]['token']
-            return token
-
-        return None
+    def convert_event_to_token_id(self, e: Event, **kwargs) -> int:
+        """Return token id for this Event (or -1 if no token), using the compiled lookup tables."""
+        return self.compiled_lookup.lookup(e.code, e.value, e.unit)
     
     def convert_events_to_tokens(self, events: List[Event]) -> List[str]:
         """
         Convert a list of events into a list of tokens, inserting ATT tokens based on time intervals between visits.
         """
-        tokens = []
+        return [ self.idx_2_token[x] for x in self.convert_events_to_token_ids(events) ]
+
+    def convert_events_to_token_ids(self, events: List[Event], **kwargs) -> List[int]:
+        """
+        Convert a list of events into a list of token ids, inserting ATT tokens based on time intervals between visits.
+        """
+        return self.convert_events_to_token_ids_and_times(events, **kwargs)[0]
+
+    def convert_events_to_token_ids_and_times(self, events: Union[List[Event], Timeline], **kwargs) -> Tuple[List[int], List[datetime.datetime]]:
+        """
+        Same as `convert_events_to_token_ids()`, but also return the timestamp of each token.
+        Inserted visit/ATT tokens get the start time of the event that triggered them.
+        """
+        token_ids: List[int] = []
+        token_times: List[datetime.datetime] = [] # [idx] = timestamp of `token_ids[idx]`
+        event_token_ids: np.ndarray = self.compiled_lookup.lookup_events(events) # [idx] = token id of `events[idx]` (or -1 if no token)
+        starts, ends, is_visits = get_event_times_and_is_visit(events)
         current_visit_end = None
         previous_visit_end = None
-        for e in events:
+        for start, end, is_visit, token_id in zip(starts, ends, is_visits, event_token_ids.tolist()):
             # Add visit end token if the event is after the previous visit's end
-            if current_visit_end is not None and e.start > current_visit_end:
+            if current_visit_end is not None and start > current_visit_end:
                 if self.is_add_visit_end:
-                    tokens.append(self.visit_end)
+                    token_ids.append(self.token_2_idx[self.visit_end])
+                    token_times.append(start)
                 current_visit_end = None
 
             # Handling visits and adding ATT tokens
-            if "Visit" in e.code:
+            if is_visit:
                 # Ignore visits that last 0 seconds
-                if e.start == e.end:
+                if start == end:
                     # Visit is a point event, so ignore
                     continue
                 
                 # If another visit is currently open (but somehow overlaps with this visit), end the previous visit
                 if current_visit_end is not None:
                     if self.is_add_visit_end:
-                        tokens.append(self.visit_end)
+                        token_ids.append(self.token_2_idx[self.visit_end])
+                        token_times.append(start)
                     previous_visit_end = current_visit_end
                     current_visit_end = None
                 
                 # Add ATT tokens between visits based on time intervals
                 if previous_visit_end is not None:
-                    interval = (e.start - previous_visit_end).days
+                    interval = (start - previous_visit_end).days
                     if interval >= 0:
                         if self.is_add_day_att:
                             if interval <= 1080:
-                                tokens.append(self.day_atts_cehr_gpt[interval - 1])
+                                token_ids.append(self.token_2_idx[self.day_atts_cehr_gpt[interval - 1]])
+                                token_times.append(start)
                             else:
-                                tokens.append(self.long_att_cehr_gpt)
+                                token_ids.append(self.token_2_idx[self.long_att_cehr_gpt])
+                                token_times.append(start)
                         elif self.is_add_day_week_month_att:
                             if interval < 7:
-                                tokens.append(self.day_atts_cehr_bert[interval - 1])
+                                token_ids.append(self.token_2_idx[self.day_atts_cehr_bert[interval - 1]])
+                                token_times.append(start)
                             elif 7 <= interval < 30:
-                                tokens.append(self.week_atts[(interval // 7) - 1])
+                                token_ids.append(self.token_2_idx[self.week_atts[(interval // 7) - 1]])
+                                token_times.append(start)
                             elif 30 <= interval < 360:
-                                tokens.append(self.month_atts[(interval // 30) - 1])
+                                token_ids.append(self.token_2_idx[self.month_atts[(interval // 30) - 1]])
+                                token_times.append(start)
                             else:
-                                tokens.append(self.long_att_cehr_bert)
+                                token_ids.append(self.token_2_idx[self.long_att_cehr_bert])
+                                token_times.append(start)
 
                 # Add visit start token
                 if self.is_add_visit_start:
-                    tokens.append(self.visit_start)
+                    token_ids.append(self.token_2_idx[self.visit_start])
+                    token_times.append(start)
 
                 # Convert visit event to token and add it
-                token = self.convert_event_to_token(e)
-                if token:
-                    tokens.append(token)
+                if token_id >= 0:
+                    token_ids.append(token_id)
+                    token_times.append(start)
 
-                current_visit_end = e.end
-                previous_visit_end = e.end
+                current_visit_end = end
+                previous_visit_end = end
             else:
                 # Convert non-visit events to tokens
-                token = self.convert_event_to_token(e)
-                if token:
-                    tokens.append(token)
+                if token_id >= 0:
+                    token_ids.append(token_id)
+                    token_times.append(start)
                     
         # Close any visit that isn't closed by end of timeline
         if current_visit_end is not None:
             if self.is_add_visit_end:
-                tokens.append(self.visit_end)
-        return tokens
+                token_ids.append(self.token_2_idx[self.visit_end])
+                token_times.append(current_visit_end)
+        return token_ids, token_times
 
 class DescTokenizer(BaseTokenizer):
     """Converts codes => textual descriptions, then tokenizes using a normal text tokenizer (e.g. BERT)
@@ -924,7 +1457,7 @@ class DescTokenizer(BaseTokenizer):
             
             Expects as input a list of Events
         """
-        if not isinstance(batch_of_events[0], list):
+        if not isinstance(batch_of_events[0], (list, Timeline)):
             # List[Event] => List[List[Event]]
             batch_of_events = [ batch_of_events ] # type: ignore
         
@@ -946,6 +1479,9 @@ class DescTokenizer(BaseTokenizer):
             if not max_length:
                 raise ValueError(f"If you specify `is_truncation_random`, then you must also provide a non-None value for `max_length`")
 
+            if kwargs.get('return_tensors') != 'pt':
+                raise ValueError(f"If you specify `is_truncation_random`, then you must also set `return_tensors='pt'`")
+
             # Tokenize without truncation
             if 'max_length' in kwargs:
                 del kwargs['max_length']
@@ -954,27 +1490,7 @@ class DescTokenizer(BaseTokenizer):
             tokenized_batch: Dict[str, torch.Tensor] = self.tokenizer.__call__(batch, **kwargs, truncation=None)
 
             # Truncate at random positions
-            random.seed(seed)
-            start_idxs: List[int] = []
-            for timeline in tokenized_batch['input_ids']:
-                length: int = (timeline != self.pad_token_id).sum() # count of non-PAD tokens
-                if length > max_length:
-                    # Calculate a random start index
-                    start_index: int = random.randint(0, length - max_length)
-                    start_idxs.append(start_index)
-                else:
-                    start_idxs.append(0)
-                    
-            for key in tokenized_batch.keys():
-                truncated_batch: List[List[int]] = []
-                for idx, timeline in enumerate(tokenized_batch[key]):
-                    new_timeline = timeline[start_idxs[idx]:start_idxs[idx] + max_length]
-                    assert new_timeline.shape[0] <= max_length, f"Error in truncating by random positions: new_timeline.shape = {new_timeline.shape[0]} !<= max_length={max_length}"
-                    truncated_batch.append(new_timeline)
-                if kwargs.get('return_tensors') == 'pt':
-                    tokenized_batch[key] = torch.stack(truncated_batch, dim=0)
-                else:
-                    tokenized_batch[key] = truncated_batch
+            tokenized_batch = self.truncate_at_random_positions(tokenized_batch, max_length, seed)
         else:
             tokenized_batch: Dict[str, torch.Tensor] = self.tokenizer.__call__(batch, **kwargs)
 
@@ -1042,18 +1558,46 @@ def torch_mask_tokens(tokenizer: BaseTokenizer,
 
 def collate_femr_timelines(batch: List[Tuple[int, List[Event]]],
                              tokenizer: BaseTokenizer, 
-                             dataset_name: str, # 'FEMRDataset' or 'AllTokensFEMRDataset'
+                             dataset_name: str, # 'FEMRDataset', 'MEDSDataset', 'AllTokensFEMRDataset', or 'PretokenizedDataset'
                              max_length: int,
                              is_truncation_random: bool = False,
                              is_mlm: bool = False,
                              mlm_prob: float = 0.15,
-                             seed: int = 1) -> Dict[str, Any]:
+                             seed: int = 1,
+                             is_sequence_packing: bool = False) -> Dict[str, Any]:
     """
         Collate function for FEMR timelines
         Truncate or pad to max length in batch.
+        
+        If `is_sequence_packing`, then instead of padding every timeline to the longest timeline in the batch,
+        pack multiple timelines into each row of `max_length` tokens. The returned `tokens` will also contain
+        `position_ids` and `segment_ids` (see `BaseCodeTokenizer.pack_token_ids()`), and the number of rows
+        will generally be smaller than the number of patients in the batch.
     """
     timelines: List[List[Event]] = [ x[1] for x in batch if len(x[1]) > 0 ] # remove empty timelines
-    if dataset_name == 'AllTokensFEMRDataset':
+    if is_sequence_packing:
+        assert isinstance(tokenizer, BaseCodeTokenizer), f"ERROR - Sequence packing is only supported for subclasses of `BaseCodeTokenizer`, not `{type(tokenizer).__name__}`"
+        if dataset_name in ['FEMRDataset', 'MEDSDataset'] or (dataset_name == 'AllTokensFEMRDataset' and len(timelines) > 0 and not isinstance(timelines[0], np.ndarray)):
+            # Convert Events => token ids
+            timelines = [ tokenizer.convert_events_to_token_ids(x) for x in timelines ]
+        elif dataset_name not in ['AllTokensFEMRDataset', 'PretokenizedDataset']:
+            raise ValueError(f"ERROR - Unsupported 'dataset_name' of: `{dataset_name}`")
+        # NOTE: AllTokensFEMRDataset examples are windows that already fit in `max_length`, so never randomly truncate them
+        tokens: Dict[str, Float[torch.Tensor, 'B max_length']] = tokenizer.call_on_token_ids_packed(timelines, 
+                                                                                                    max_length=max_length,
+                                                                                                    is_truncation_random=is_truncation_random and dataset_name != 'AllTokensFEMRDataset',
+                                                                                                    seed=seed)
+    elif dataset_name == 'AllTokensFEMRDataset' and len(timelines) > 0 and isinstance(timelines[0], np.ndarray):
+        # For AllTokensFEMRDataset with `is_return_token_ids`, we are given slices of each patient's token ids, so skip straight to padding
+        tokens: Dict[str, Float[torch.Tensor, 'B max_length']] = tokenizer.call_on_token_ids(timelines, 
+                                                                                              truncation=True, 
+                                                                                              padding=True,
+                                                                                              max_length=max_length,
+                                                                                              is_truncation_random=False,
+                                                                                              add_special_tokens=True,
+                                                                                              seed=seed, 
+                                                                                              return_tensors='pt')
+    elif dataset_name == 'AllTokensFEMRDataset':
         # For AllTokensFEMRDataset, we are given explicit (start, end) idx's to subselect from each patient's timeline
         tokens: Dict[str, Float[torch.Tensor, 'B max_length']] = tokenizer(timelines, 
                                                                             truncation=True, 
@@ -1073,6 +1617,16 @@ def collate_femr_timelines(batch: List[Tuple[int, List[Event]]],
                                                                             add_special_tokens=True,
                                                                             seed=seed, 
                                                                             return_tensors='pt')
+    elif dataset_name == 'PretokenizedDataset':
+        # For PretokenizedDataset, timelines are already token ids, so skip straight to truncation + padding
+        tokens: Dict[str, Float[torch.Tensor, 'B max_length']] = tokenizer.call_on_token_ids(timelines, 
+                                                                                              truncation=True, 
+                                                                                              padding=True, 
+                                                                                              max_length=max_length,
+                                                                                              is_truncation_random=is_truncation_random,
+                                                                                              add_special_tokens=True,
+                                                                                              seed=seed, 
+                                                                                              return_tensors='pt')
     else:
         raise ValueError(f"ERROR - Unsupported 'dataset_name' of: `{dataset_name}`")
     
@@ -1080,6 +1634,9 @@ def collate_femr_timelines(batch: List[Tuple[int, List[Event]]],
     if is_mlm:
         # Masked LM
         tokens["input_ids"], tokens["labels"] = torch_mask_tokens(tokenizer, tokens["input_ids"], mlm_prob)
+    elif is_sequence_packing:
+        # Causal LM -- don't predict the first token of a timeline from the end of the previous timeline in the same row, or any PAD tokens
+        tokens['labels'] = tokens['input_ids'].masked_fill((tokens['position_ids'] == 0) | (tokens['segment_ids'] == 0), -100)
     else:
         # Causal LM
         tokens['labels'] = tokens['input_ids']
@@ -1089,7 +1646,142 @@ def collate_femr_timelines(batch: List[Tuple[int, List[Event]]],
         'tokens' : tokens,
     }
 
+class FEMRCollator():
+    """
+        Picklable wrapper around `collate_femr_timelines()` to use as a DataLoader's `collate_fn`.
+        
+        If DataLoader workers are forked, they simply inherit `self.tokenizer`. Otherwise (e.g. `multiprocessing_context='spawn'`), 
+        the tokenizer is dropped when this collator is pickled, and each worker re-loads it ONCE in `worker_init_fn()`
+        (which is fast b/c it reads the compiled tokenizer cache). Use with `persistent_workers=True` so this only happens once per run.
+    """
+    def __init__(self,
+                 tokenizer: BaseTokenizer,
+                 dataset_name: str,
+                 max_length: int,
+                 is_truncation_random: bool = False,
+                 is_mlm: bool = False,
+                 mlm_prob: float = 0.15,
+                 seed: int = 1,
+                 is_sequence_packing: bool = False):
+        self.tokenizer: Optional[BaseTokenizer] = tokenizer
+        self.tokenizer_cls: type = type(tokenizer)
+        self.path_to_tokenizer_config: str = tokenizer.path_to_tokenizer_config
+        # NOTE: CookbookTokenizer pops its visit / ATT settings from `metadata` in `__init__()`, so read them off the tokenizer itself
+        # (via `__dict__` to avoid triggering `BaseCodeTokenizer.__getattr__()`), otherwise the re-loaded tokenizer would use the defaults
+        self.tokenizer_metadata: Dict[str, Any] = { 
+            **tokenizer.metadata, 
+            **{ key: tokenizer.__dict__[key] for key in [ 'is_add_visit_start', 'is_add_visit_end', 'is_add_day_att', 'is_add_day_week_month_att' ] if key in tokenizer.__dict__ },
+        }
+        self.dataset_name: str = dataset_name
+        self.max_length: int = max_length
+        self.is_truncation_random: bool = is_truncation_random
+        self.is_mlm: bool = is_mlm
+        self.mlm_prob: float = mlm_prob
+        self.seed: int = seed
+        self.is_sequence_packing: bool = is_sequence_packing
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Don't pickle the tokenizer -- it gets re-loaded in `load_tokenizer()`
+        state = self.__dict__.copy()
+        state['tokenizer'] = None
+        return state
+
+    def load_tokenizer(self) -> BaseTokenizer:
+        if self.tokenizer is None:
+            self.tokenizer = self.tokenizer_cls(self.path_to_tokenizer_config, metadata=self.tokenizer_metadata)
+        return self.tokenizer
+
+    def worker_init_fn(self, worker_id: int):
+        """Pass as the DataLoader's `worker_init_fn` to load the tokenizer when each worker starts (rather than on its first batch)"""
+        self.load_tokenizer()
+
+    def __call__(self, batch: List[Tuple[int, List[Event]]]) -> Dict[str, Any]:
+        return collate_femr_timelines(batch, 
+                                      self.load_tokenizer(), 
+                                      self.dataset_name, 
+                                      self.max_length, 
+                                      self.is_truncation_random, 
+                                      self.is_mlm, 
+                                      self.mlm_prob, 
+                                      self.seed, 
+                                      self.is_sequence_packing)
+
 if __name__ == '__main__':
+    # Check that the fast path (Events => token ids => tensors) matches HuggingFace's PreTrainedTokenizer.__call__() (runs on CPU)
+    import random
+    import tempfile
+    from hf_ehr.config import CodeTCE, NumericalRangeTCE, CategoricalTCE
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as path_to_tmp_dir:
+        # Synthetic tokenizer config with every type of token
+        tokenizer_config: List[TokenizerConfigEntry] = []
+        for idx in range(30):
+            code: str = f"Visit/{idx}" if idx % 10 == 0 else f"LOINC/{idx}"
+            tokenizer_config.append(CodeTCE(code=code))
+            if idx % 3 == 0:
+                for unit in [ 'mg', None ]:
+                    tokenizer_config += [ NumericalRangeTCE(code=code, tokenization={ 'unit' : unit, 'range_start' : start, 'range_end' : end }) for start, end in [ (-1.7976931348623157e+308, 0.0), (0.0, 5.0), (5.0, 1.7976931348623157e+308) ] ]
+            if idx % 5 == 0:
+                tokenizer_config += [ CategoricalTCE(code=code, tokenization={ 'categories' : categories }) for categories in [ ['A'], ['B', 'C'] ] ]
+        # CEHRTokenizer's visit / ATT tokens must be in the tokenizer config
+        tokenizer_config += [ CodeTCE(code=x) for x in [ '[VISIT START]', '[VISIT END]', '[LONG TERM]' ] + [ f"[DAY {i}]" for i in range(1, 1081) ] ]
+        path_to_tokenizer_config: str = os.path.join(path_to_tmp_dir, 'tokenizer_config.json')
+        save_tokenizer_config_to_path(path_to_tokenizer_config, tokenizer_config)
+
+        # Synthetic timelines of various lengths (incl. empty, and codes / values that aren't in the vocab)
+        timelines: List[List[Event]] = []
+        for n_events in [ 0, 1, 7, 50, 300 ]:
+            time: datetime.datetime = datetime.datetime(2020, 1, 1)
+            timeline: List[Event] = []
+            for _ in range(n_events):
+                idx: int = random.randint(0, 32)
+                time += datetime.timedelta(hours=random.randint(0, 100))
+                value: Optional[Any] = random.choice([ None, None, random.uniform(-10, 10), random.choice([ 'A', 'B', 'C', 'D' ]) ])
+                timeline.append(Event(code=f"Visit/{idx}" if idx % 10 == 0 else f"LOINC/{idx}", value=value, unit=random.choice([ 'mg', None ]), start=time, end=time + datetime.timedelta(hours=1)))
+            timelines.append(timeline)
+
+        # NOTE: CookbookTokenizer's visit tokens are commented out (see `CookbookTokenizer.__init__()`), so it can't tokenize visits
+        timelines_no_visits: List[List[Event]] = [ [ e for e in timeline if not e.code.startswith('Visit/') ] for timeline in timelines ]
+        for tokenizer, batch in [
+            (CLMBRTokenizer(path_to_tokenizer_config), timelines),
+            (CookbookTokenizer(path_to_tokenizer_config, metadata={}), timelines_no_visits),
+            (CEHRTokenizer(path_to_tokenizer_config, metadata={}), timelines),
+        ]:
+            for kwargs in [
+                { 'truncation' : True, 'padding' : True, 'max_length' : 1024, 'add_special_tokens' : True, 'return_tensors' : 'pt' },
+                { 'truncation' : True, 'padding' : True, 'max_length' : 8, 'add_special_tokens' : True, 'return_tensors' : 'pt' },
+                { 'truncation' : True, 'padding' : True, 'max_length' : 64, 'is_truncation_random' : True, 'seed' : 0, 'add_special_tokens' : True, 'return_tensors' : 'pt' },
+                { 'truncation' : True, 'padding' : 'longest', 'max_length' : 5, 'return_tensors' : 'pt' },
+                { 'truncation' : False, 'padding' : True, 'return_tensors' : 'pt' },
+            ]:
+                tokens_fast = tokenizer(batch, **kwargs)
+                tokens_hf = tokenizer(batch, is_fast_path=False, **kwargs)
+                assert list(tokens_fast.keys()) == list(tokens_hf.keys()), f"ERROR - Key mismatch for {tokenizer.metadata['cls']}: {tokens_fast.keys()} != {tokens_hf.keys()}"
+                for key in tokens_hf.keys():
+                    assert torch.equal(tokens_fast[key], tokens_hf[key]), f"ERROR - Mismatch in `{key}` for {tokenizer.metadata['cls']} with kwargs={kwargs}"
+            print(f"Fast path matches HuggingFace path for {tokenizer.metadata['cls']}")
+
+        # Check that a FEMRCollator re-loads the same tokenizer after being pickled (i.e. sent to a spawned DataLoader worker)
+        import pickle
+        att_metadata: Dict[str, Any] = { 'is_add_visit_start' : False, 'is_add_visit_end' : True, 'is_add_day_att' : False, 'is_add_day_week_month_att' : False }
+        for tokenizer, batch in [
+            (CLMBRTokenizer(path_to_tokenizer_config), timelines),
+            (CookbookTokenizer(path_to_tokenizer_config, metadata=att_metadata), timelines_no_visits),
+            (CEHRTokenizer(path_to_tokenizer_config, metadata=att_metadata), timelines),
+        ]:
+            collator = FEMRCollator(tokenizer, 'FEMRDataset', max_length=64)
+            collator_unpickled = pickle.loads(pickle.dumps(collator))
+            tokenizer_unpickled = collator_unpickled.load_tokenizer()
+            for key in att_metadata.keys():
+                assert getattr(tokenizer, key, None) == getattr(tokenizer_unpickled, key, None), f"ERROR - Mismatch in `{key}` for {tokenizer.metadata['cls']} after pickling FEMRCollator"
+            assert tokenizer.metadata == tokenizer_unpickled.metadata, f"ERROR - Mismatch in `metadata` for {tokenizer.metadata['cls']} after pickling FEMRCollator"
+            tokens = collator(list(enumerate(batch)))['tokens']
+            tokens_unpickled = collator_unpickled(list(enumerate(batch)))['tokens']
+            assert torch.equal(tokens['input_ids'], tokens_unpickled['input_ids']), f"ERROR - Mismatch in `input_ids` for {tokenizer.metadata['cls']} after pickling FEMRCollator"
+            print(f"Pickled FEMRCollator matches original for {tokenizer.metadata['cls']}")
+    print("Success! Fast path matches HuggingFace path for all tokenizers, and FEMRCollator can be pickled")
+
+    # NOTE: The checks below need the v8 extract + tokenizers on the Shah lab cluster
     from hf_ehr.data.datasets import FEMRDataset
     
     PATH_TO_CACHE_DIR: str = '/share/pi/nigam/mwornow/hf_ehr/cache/'
@@ -1106,11 +1798,14 @@ if __name__ == '__main__':
     PATH_TO_TOKENIZER_CEHR_v8_DIR: str = os.path.join(PATH_TO_TOKENIZERS_DIR, 'cehr_v8/')
     PATH_TO_TOKENIZER_CEHR_v8_CONFIG: str = os.path.join(PATH_TO_TOKENIZER_CEHR_v8_DIR, 'tokenizer_config.json')
 
+    if not os.path.exists(PATH_TO_FEMR_EXTRACT_v8):
+        exit()
+
     # Load v8 dataset
     print("Loading v8 dataset...")
     path_to_femr_extract: str = PATH_TO_FEMR_EXTRACT_v8
     dataset = FEMRDataset(path_to_femr_extract, split='train', is_debug=False)
-    
+
     # Cookbook Tokenizer
     if False:
         print("Loading tokenizer...")
@@ -10,7 +10,6 @@ python3 ehrshot.py \
 """
 
 import argparse
-import collections
 import os
 import pickle
 import numpy as np
@@ -24,7 +23,7 @@ from tqdm import tqdm
 from loguru import logger
 from femr.labelers import LabeledPatients, load_labeled_patients
 from hf_ehr.utils import load_config_from_path, load_tokenizer_from_path, load_model_from_path
-from hf_ehr.config import Event
+from hf_ehr.config import Timeline
 
 class CookbookModelWithClassificationHead(torch.nn.Module):
     def __init__(self, model: torch.nn.Module, aggregation_strat: str, n_classes: int):
@@ -159,25 +158,19 @@ def process_in_batches(run_name, database, patient_ids, label_times, tokenizer,
         batch_label_times = label_times[batch_start:batch_end]
         
         # Create batch-specific patient_id_2_events
-        batch_patient_id_2_events: Dict[str, List[Event]] = collections.defaultdict(list)
+        batch_patient_id_2_events: Dict[str, Timeline] = {}
         
         # Cache events for current batch of patients
         for pid in tqdm(batch_patient_ids, desc='Caching patient events', total=total_batch):
             if pid not in batch_patient_id_2_events:
-                for e in database[pid].events:
-                    batch_patient_id_2_events[pid].append(
-                        Event(code=e.code, value=e.value, unit=e.unit, 
-                              start=e.start, end=e.end, omop_table=e.omop_table)
-                    )
+                batch_patient_id_2_events[pid] = Timeline.from_events(database[pid].events)
         
         # Process each patient in the current batch
         batch_tokenized_timelines = []
         for pid, l_time in tqdm(zip(batch_patient_ids, batch_label_times), desc='Tokenizing timelines', total=total_batch):
             # Create patient timeline
-            valid_events = [
-                e for e in batch_patient_id_2_events[pid]
-                if e.start <= l_time  # Ignore events after label time
-            ]
+            events: Timeline = batch_patient_id_2_events[pid]
+            valid_events: Timeline = events[events.starts <= np.datetime64(l_time, 'us')] # Ignore events after label time
             
             # Tokenize timeline
             timeline = tokenizer(valid_events, add_special_tokens=False)['input_ids'][0]
@@ -1,3 +1,5 @@
+import math
+import time
 import torch
 from torch import optim
 import lightning as L
@@ -6,16 +8,170 @@ from tqdm import tqdm
 from omegaconf import DictConfig
 from torchmetrics.aggregation import SumMetric, CatMetric
 from jaxtyping import Float
-from typing import Dict, List, Any, Optional, Union
+from typing import Dict, Iterable, List, Any, Optional, Tuple, Union
 import wandb
 from lightning.pytorch.utilities import rank_zero_only
 from hf_ehr.utils import lr_warmup_with_constant_plateau
 from loguru import logger
 
-def calculate_flops_per_token(model, vocab_size: int) -> int:
-    """Returns FLOPs per token for model."""
-    # TODO - remove; needs to be done on input size level
-    return 0
+# Order of the cumulative training metrics in `BaseModel.sync_train_metrics()`
+TRAIN_SUM_METRICS: List[str] = [ 'train_total_examples', 'train_total_tokens_PAD', 'train_total_tokens_nonPAD', 'train_total_flops', 'train_total_nan_batches' ]
+
+# Peak dense bf16/fp16 tensor-core FLOP/s per device, used for MFU if `trainer.peak_flops_per_device` isn't set
+PEAK_FLOPS_PER_DEVICE: Dict[str, float] = {
+    'H100': 989e12,
+    'A100': 312e12,
+    'A6000': 155e12,
+    'L40': 181e12,
+    'A40': 150e12,
+    'V100': 125e12,
+}
+
+def calculate_flops_per_token(model_name: str, model_config: Any, seq_length: int) -> int:
+    """
+        Returns the FLOPs of a forward pass per token for a sequence of `seq_length` tokens (including PAD).
+        Counts 2 FLOPs per multiply-accumulate of each matmul (plus the LM head) and the per-token O(seq_length) cost of attention;
+        ignores norms, activations, and biases. Training (forward + backward) is ~3x this.
+        NOTE: Mamba / Hyena / Based mixers are not plain matmuls, so their numbers are approximate.
+    """
+    def get(*keys: str, default: Any = None) -> Any:
+        # HF configs use different names for the same hyperparameter (and `based`'s mixer configs are dicts)
+        for key in keys:
+            val = model_config.get(key) if isinstance(model_config, (dict, DictConfig)) else getattr(model_config, key, None)
+            if val is not None:
+                return val
+        return default
+    d_model: int = get('hidden_size', 'n_embd', 'd_model')
+    n_layers: int = get('num_hidden_layers', 'n_layer', 'num_layers')
+    lm_head: int = 2 * d_model * get('vocab_size')
+
+    if 'gpt' in model_name or 'bert' in model_name or 'llama' in model_name:
+        n_heads: int = get('num_attention_heads', 'n_head')
+        n_kv_heads: int = get('num_key_value_heads', default=n_heads)
+        head_dim: int = d_model // n_heads
+        d_ff: int = get('intermediate_size', 'n_inner', default=4 * d_model)
+        n_ff_matrices: int = 3 if 'llama' in model_name else 2 # Llama's SwiGLU MLP has gate + up + down projections
+        attn: int = 2 * d_model * (2 * d_model + 2 * n_kv_heads * head_dim) + 2 * 2 * seq_length * d_model # Q/K/V/O projections + QK^T and AV
+        mlp: int = 2 * n_ff_matrices * d_model * d_ff
+        if 'bert' in model_name:
+            # MLM head has an extra dense transform before the decoder
+            lm_head += 2 * d_model * d_model
+        return n_layers * (attn + mlp) + lm_head
+    elif 't5' in model_name:
+        n_heads: int = get('num_heads', 'num_attention_heads')
+        d_inner: int = n_heads * get('d_kv', default=d_model // n_heads)
+        n_dec_layers: int = get('num_decoder_layers', default=n_layers)
+        n_ff_matrices: int = 3 if get('is_gated_act', default=False) else 2
+        attn: int = 2 * 4 * d_model * d_inner + 2 * 2 * seq_length * d_inner
+        mlp: int = 2 * n_ff_matrices * d_model * get('d_ff')
+        # Encoder and decoder both see `seq_length` tokens; each decoder layer adds cross-attention over the encoder's outputs
+        return n_layers * (attn + mlp) + n_dec_layers * (2 * attn + mlp) + lm_head
+    elif 'mamba' in model_name:
+        d_inner: int = get('intermediate_size', default=2 * d_model)
+        d_state: int = get('state_size', default=16)
+        dt_rank: Union[int, str] = get('time_step_rank', default='auto')
+        dt_rank = math.ceil(d_model / 16) if dt_rank == 'auto' else dt_rank
+        in_out_proj: int = 2 * d_model * 2 * d_inner + 2 * d_inner * d_model
+        conv: int = 2 * d_inner * get('conv_kernel', default=4)
+        x_dt_proj: int = 2 * d_inner * (dt_rank + 2 * d_state) + 2 * dt_rank * d_inner
+        scan: int = 9 * d_inner * d_state # selective scan, see Section 3.3 of the Mamba paper
+        return n_layers * (in_out_proj + conv + x_dt_proj + scan) + lm_head
+    elif 'hyena' in model_name:
+        order: int = get('hyena_order', default=2)
+        d_inner: int = get('d_inner', default=4 * d_model)
+        proj: int = 2 * d_model * (order + 1) * d_model + 2 * d_model * d_model # input + output projections
+        short_conv: int = 2 * (order + 1) * d_model * get('short_filter_order', default=3)
+        long_conv: int = order * d_model * (10 * math.ceil(math.log2(2 * seq_length)) + 6) # FFT + iFFT of length 2L + complex multiply
+        mlp: int = 2 * 2 * d_model * d_inner
+        return n_layers * (proj + short_conv + long_conv + mlp) + lm_head
+    elif 'based' in model_name:
+        d_ff: int = get('n_inner', default=4 * d_model)
+        n_ff_matrices: int = 3 if 'glu' in str(get('activation_function', default='')) else 2
+        mlp: int = 2 * n_ff_matrices * d_model * d_ff
+        mixer, alt_mixer, alt_mixer_2 = get('mixer', default={}), get('alt_mixer', default={}), get('alt_mixer_2', default={})
+        alt_mixer_layers: List[int] = list(get('alt_mixer_layers', default=[])) if alt_mixer else []
+        alt_mixer_2_layers: List[int] = list(get('alt_mixer_2_layers', default=[])) if alt_mixer_2 else []
+        # Default mixer is a gated BaseConv: expanded input / output projections + a short conv
+        expand: int = mixer.get('expand_proj', 1) if mixer else 1
+        kernel_sizes: Union[int, List[int]] = mixer.get('kernel_sizes', 3) if mixer else 3
+        kernel_size: int = max(max(kernel_sizes) if isinstance(kernel_sizes, Iterable) else kernel_sizes, 1)
+        conv_flops: int = 2 * 2 * d_model * expand * d_model + 2 * expand * d_model * kernel_size
+        # Linear attention with a 2nd-order Taylor feature map of size 1 + f + f^2 per head
+        feature_dim: int = alt_mixer.get('feature_dim', 16) if alt_mixer else 16
+        n_heads: int = alt_mixer.get('num_heads', 16) if alt_mixer else 16
+        linear_attn_flops: int = 2 * d_model * (2 * feature_dim * n_heads + 2 * d_model) + 2 * 2 * (1 + feature_dim + feature_dim ** 2) * d_model
+        # Sliding window attention
+        window: int = min(alt_mixer_2.get('window_size', seq_length) if alt_mixer_2 else seq_length, seq_length)
+        window_attn_flops: int = 2 * 4 * d_model * d_model + 2 * 2 * window * d_model
+        n_conv_layers: int = n_layers - len(alt_mixer_layers) - len(alt_mixer_2_layers)
+        return n_conv_layers * conv_flops + len(alt_mixer_layers) * linear_attn_flops + len(alt_mixer_2_layers) * window_attn_flops + n_layers * mlp + lm_head
+    else:
+        raise ValueError(f"Unsupported model for FLOPs calculation: `{model_name}`")
+
+def get_segment_attention_mask(segment_ids: torch.Tensor, is_causal: bool) -> torch.Tensor:
+    """
+        Given the `segment_ids` of a packed batch (see `collate_femr_timelines(is_sequence_packing=True)`), return a boolean (B, L, L) mask
+        where `mask[b, i, j]` is TRUE iff token `i` can attend to token `j`, i.e. both tokens belong to the same timeline (and `j <= i` if `is_causal`).
+        NOTE: PAD tokens (segment 0) only attend to each other, so no row of the mask is ever fully masked out (which would cause NaNs)
+    """
+    mask: torch.Tensor = segment_ids[:, :, None] == segment_ids[:, None, :]
+    if is_causal:
+        mask = mask & torch.ones(mask.shape[1:], dtype=torch.bool, device=mask.device).tril()
+    return mask
+
+ATTN_BACKENDS: List[str] = [ 'eager', 'sdpa' ] # 'eager' = materialize the full L x L attention matrix; 'sdpa' = `torch.nn.functional.scaled_dot_product_attention` (flash / memory-efficient kernels if available, math fallback otherwise)
+
+#######################################
+## Rotary Positional Embedding (ROPE) ##
+#######################################
+class RotaryEmbedding(torch.nn.Module):
+    """
+        Cache of the RoPE cos / sin tables for positions [0, max_length), so that they aren't recomputed on every forward pass.
+        Tables are non-persistent buffers (so they follow the model across devices, but aren't saved in checkpoints), and are 
+            cast to each dtype they're requested in at most once. A single instance can be shared by every attention layer of a model.
+    """
+    def __init__(self, dim: int, max_length: int, base: float = 10000.0) -> None:
+        super().__init__()
+        assert dim % 2 == 0, f"ERROR - RoPE requires an even head dim, not {dim}"
+        self.dim: int = dim
+        self.register_buffer('inv_freq', 1.0 / (base ** (torch.arange(0, dim, 2, dtype=torch.float32) / dim)), persistent=False)
+        self.set_max_length(max_length)
+
+    def set_max_length(self, max_length: int) -> None:
+        """(Re)build the cos / sin tables for positions [0, max_length)"""
+        freqs: torch.Tensor = torch.outer(torch.arange(max_length, dtype=torch.float32, device=self.inv_freq.device), self.inv_freq.float())
+        self.register_buffer('cos', freqs.cos(), persistent=False) # shape = (max_length, dim // 2)
+        self.register_buffer('sin', freqs.sin(), persistent=False) # shape = (max_length, dim // 2)
+        self.cos_sin_cache: Dict[torch.dtype, Tuple[torch.Tensor, torch.Tensor]] = {} # [key] = dtype, [value] = (cos, sin) cast to that dtype
+
+    def _apply(self, *args, **kwargs):
+        # Moving / casting this module (i.e. `.to()`, `.cuda()`) invalidates the tables we already cast
+        self.cos_sin_cache = {}
+        return super()._apply(*args, **kwargs)
+
+    def forward(self, seq_length: int, dtype: torch.dtype, position_offset: int = 0) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Return (cos, sin) for positions [position_offset, position_offset + seq_length), each of shape (seq_length, dim // 2)"""
+        if position_offset + seq_length > self.cos.shape[0]:
+            # Sequence is longer than any we've seen, so grow the tables (rarely happens, since `max_length` is the model's context window)
+            self.set_max_length(max(position_offset + seq_length, 2 * self.cos.shape[0]))
+        if dtype not in self.cos_sin_cache:
+            self.cos_sin_cache[dtype] = (self.cos.to(dtype), self.sin.to(dtype))
+        (cos, sin) = self.cos_sin_cache[dtype]
+        return (cos[position_offset:position_offset + seq_length], sin[position_offset:position_offset + seq_length])
+
+def apply_rotary_pos_emb_(x: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor) -> torch.Tensor:
+    """
+        Apply RoPE to `x` (shape = (..., L, D)) IN-PLACE, i.e. rotate each pair of adjacent channels (x[..., 2i], x[..., 2i + 1]) by angle `freq_i * position`.
+        `cos` / `sin` have shape (L, D // 2) (see `RotaryEmbedding`). Only allocates a single half-size temporary (rather than 
+            the ~6 full-size copies of the out-of-place version), and stays traceable by `torch.compile`.
+        NOTE: `x` can't be (a view of) one of several outputs of the same op (i.e. `split()` / `chunk()`), since autograd doesn't allow in-place writes to those
+    """
+    x_pairs: torch.Tensor = x.unflatten(-1, (-1, 2))
+    x1, x2 = x_pairs[..., 0], x_pairs[..., 1]
+    x1_sin: torch.Tensor = x1 * sin
+    x1.mul_(cos).addcmul_(x2, sin, value=-1) # x1 * cos - x2 * sin
+    x2.mul_(cos).add_(x1_sin) # x2 * cos + x1 * sin
+    return x
 
 class BaseModel(L.LightningModule):
     """
@@ -44,7 +200,10 @@ class BaseModel(L.LightningModule):
             'train_total_examples': SumMetric(),
             'train_total_tokens_PAD': SumMetric(),
             'train_total_tokens_nonPAD': SumMetric(),
+            'train_total_flops': SumMetric(),
+            'train_total_nan_batches': SumMetric(),
         })
+        self.sum_metrics['train_total_flops'].set_dtype(torch.float64) # float32 loses precision past ~1e16 FLOPs
         self.cat_metrics: Dict[str, CatMetric] = torch.nn.ModuleDict({
             'val_batch_loss': CatMetric(),
             'val_batch_tokens_nonPAD': CatMetric(),
@@ -52,7 +211,17 @@ class BaseModel(L.LightningModule):
     
     def post_init(self):
         """Post-initialization method to be called by subclass."""
-        self.flops_per_token = 0
+        self.flops_per_token = calculate_flops_per_token(self.model_name, self.get_model_config(), self.config.data.dataloader.max_length)
+        self.seq_length_2_flops_per_token: Dict[int, int] = {}
+        # Peak FLOP/s of this device (for MFU) -- set in `on_train_start()`
+        self.peak_flops_per_device: Optional[float] = None
+        self.last_train_step_time: Optional[float] = None
+        # Training metrics accumulated since the last sync, and cumulative totals across all processes as of the last sync (see `sync_train_metrics()`)
+        self.pending_train_tokens: Optional[torch.Tensor] = None
+        self.pending_train_examples: int = 0
+        self.pending_train_flops: int = 0
+        self.pending_train_nan_batches: int = 0
+        self.train_metric_totals: Optional[torch.Tensor] = None
         # Track batch_idx
         self.batch_idx: int = 0
 
@@ -67,6 +236,47 @@ class BaseModel(L.LightningModule):
     def get_param_count(self) -> int:
         return sum(p.numel() for p in self.parameters() if p.requires_grad)
 
+    def get_model_config(self) -> Any:
+        """Returns the HF config of `self.model`."""
+        return getattr(self, 'model_config', None) or self.model.config
+
+    def get_train_flops(self, input_ids: torch.Tensor) -> int:
+        """Returns the FLOPs of a training step (forward + backward = 3x forward) on a (B, L) batch, including PAD tokens."""
+        B, L = input_ids.shape
+        if L not in self.seq_length_2_flops_per_token:
+            self.seq_length_2_flops_per_token[L] = calculate_flops_per_token(self.model_name, self.get_model_config(), L)
+        return 3 * B * L * self.seq_length_2_flops_per_token[L]
+
+    def get_peak_flops_per_device(self) -> Optional[float]:
+        """Returns the peak FLOP/s of this device from `trainer.peak_flops_per_device`, else looks it up by GPU name. None if unknown."""
+        peak_flops: Optional[float] = getattr(self.config.trainer, 'peak_flops_per_device', None)
+        if peak_flops not in [None, "None"]:
+            return float(peak_flops)
+        if not torch.cuda.is_available():
+            return None
+        device_name: str = torch.cuda.get_device_name(self.device)
+        for key, val in PEAK_FLOPS_PER_DEVICE.items():
+            if key in device_name:
+                return val
+        logger.warning(f"Unknown peak FLOP/s for device `{device_name}`, so not logging `train/mfu`. Set `trainer.peak_flops_per_device` to fix this.")
+        return None
+
+    def get_model_inputs(self, tokens: Dict[str, Any]) -> Dict[str, Any]:
+        """Return the kwargs to pass to `self.model()` for this batch of `tokens`.
+            For packed batches (i.e. `tokens` contains `segment_ids`), replace the 2D padding mask with a 
+            block-diagonal mask so that each timeline only attends to itself."""
+        if 'segment_ids' not in tokens:
+            return tokens
+        inputs: Dict[str, Any] = { key: val for key, val in tokens.items() if key != 'segment_ids' }
+        inputs['attention_mask'] = self.get_packed_attention_mask(tokens['segment_ids'])
+        return inputs
+
+    def get_packed_attention_mask(self, segment_ids: torch.Tensor) -> Optional[torch.Tensor]:
+        """Causal block-diagonal mask in HF's 4D additive format, i.e. (B, 1, L, L) with 0 = attend and -inf = ignore"""
+        dtype: torch.dtype = next(self.model.parameters()).dtype
+        is_attend: torch.Tensor = get_segment_attention_mask(segment_ids, is_causal=True)
+        return torch.zeros(is_attend.shape, dtype=dtype, device=segment_ids.device).masked_fill_(~is_attend, torch.finfo(dtype).min)[:, None, :, :]
+
     def configure_optimizers(self):
         """ Sets Learning rate for different parameter groups."""
         lr: float = self.config.trainer.optimizer.lr
@@ -89,6 +299,9 @@ class BaseModel(L.LightningModule):
     
     def on_save_checkpoint(self, checkpoint):
         """Save each metric's state in the checkpoint."""
+        if self.is_batched_metrics():
+            # Flush any training metrics accumulated since the last sync so that they're included in the checkpoint
+            self.sync_train_metrics()
         for key, metric in self.sum_metrics.items():
             checkpoint[key] = metric.compute()
         for key, metric in self.cat_metrics.items():
@@ -101,6 +314,10 @@ class BaseModel(L.LightningModule):
         super().on_load_checkpoint(checkpoint)
         # Sum Metrics
         for key, metric in self.sum_metrics.items():
+            if key not in checkpoint:
+                # Checkpoints created before this metric was added
+                logger.warning(f"Metric `{key}` not found in checkpoint, so starting it from 0")
+                continue
             self.sum_metrics[key].update(checkpoint[key])
             logger.info(f"Loaded metric `{key}` from checkpoint with value: `{self.sum_metrics[key].cuda().compute()}`")
         # Cat Metrics
@@ -120,45 +337,60 @@ class BaseModel(L.LightningModule):
             tokens.pop("token_type_ids", None)
         
         # Forward pass
-        outputs = self.model(**tokens)
+        outputs = self.model(**self.get_model_inputs(tokens))
         loss: torch.Tensor = outputs.loss
                 
         if torch.isnan(loss).any():
-            nan_detected = torch.tensor([1.0], device=self.device)
-        else:
-            nan_detected = torch.tensor([0.0], device=self.device)
-
-        dist.all_reduce(nan_detected, op=dist.ReduceOp.MAX)
-        if nan_detected.item() == 1:
-            print("NaN detected in loss, skipping this batch across all processes.")
-            return  # Skip this batch on all processes
+            # Only skip this batch on this process -- the val loss is a token-weighted average over the batches of all processes,
+            # so there's no need for an all_reduce on every batch. NaN batches are summed across processes in `on_validation_epoch_end()`
+            print("NaN detected in loss, skipping this batch.")
+            self.n_val_nan_batches += 1
+            return
 
         # Logging
         self.log_validation_step(loss, tokens) # ! NOTE: I'm assuming this loss is averaged over all non-PAD tokens for this function call
 
         return loss
 
+    def is_length_bucketed_batches(self) -> bool:
+        """Return TRUE if the 'batch' dataloader mode is using a `LengthBucketedBatchSampler` (see `load_dataloaders()`)"""
+        return self.config.data.dataloader.mode == 'batch' and hasattr(self.trainer.train_dataloader.batch_sampler, 'set_epoch')
+
     def on_train_epoch_end(self):
-        # Needed for ApproxBatchSampler to reset random seed after every epoch
-        if self.config.data.dataloader.mode == 'approx':
+        # Needed for ApproxBatchSampler / PackedBatchSampler / LengthBucketedBatchSampler to reset random seed after every epoch
+        if self.config.data.dataloader.mode in ['approx', 'packed'] or self.is_length_bucketed_batches():
             self.trainer.train_dataloader.batch_sampler.set_epoch(self.current_epoch + 1)
+        elif self.config.data.dataloader.mode == 'streaming':
+            self.trainer.train_dataloader.dataset.set_epoch(self.current_epoch + 1)
+
+    def on_train_epoch_start(self):
+        # Don't count dataloader startup towards the first training step's MFU
+        self.last_train_step_time = None
+        # Log how much of each batch is padding for this epoch's batch plan
+        if self.config.data.dataloader.mode == 'packed':
+            batch_sampler = self.trainer.train_dataloader.batch_sampler
+            batch_sampler.get_batch_plan()
+            self.log('train/packing/padding_efficiency', batch_sampler.padding_efficiency, on_step=False, on_epoch=True)
+            self.log('train/packing/budget_efficiency', batch_sampler.budget_efficiency, on_step=False, on_epoch=True)
 
     def on_train_start(self):
         if rank_zero_only.rank == 0 and wandb and wandb.run:
             wandb.run.summary["tokenizer_vocab_size"] = self.vocab_size
             wandb.run.summary["tokenizer_pad_token_id"] = self.pad_token_id
             wandb.run.summary["model_parameter_count"] = self.get_param_count()
+            wandb.run.summary["model_flops_per_token"] = self.flops_per_token
+        self.peak_flops_per_device = self.get_peak_flops_per_device()
 
         ############################
         # Start of OOM detection
         # Create a fake full batch and pass through model for early detection of OOM
-        if self.config.data.dataloader.mode == 'approx':
+        if self.config.data.dataloader.mode in ['approx', 'packed']:
             fake_batch = {
                 'input_ids' : torch.ones((self.config.data.dataloader.approx_batch_sampler.max_tokens // self.config.data.dataloader.max_length, self.config.data.dataloader.max_length)).long().to(self.device),
                 'attention_mask' : torch.ones((self.config.data.dataloader.approx_batch_sampler.max_tokens // self.config.data.dataloader.max_length, self.config.data.dataloader.max_length)).to(self.device),
                 'labels' : torch.ones((self.config.data.dataloader.approx_batch_sampler.max_tokens // self.config.data.dataloader.max_length, self.config.data.dataloader.max_length)).long().to(self.device),
             }
-        elif self.config.data.dataloader.mode == 'batch':
+        elif self.config.data.dataloader.mode in ['batch', 'streaming']:
             fake_batch = {
                 'input_ids' : torch.ones((self.config.data.dataloader.batch_size, self.config.data.dataloader.max_length)).long().to(self.device),
                 'attention_mask' : torch.ones((self.config.data.dataloader.batch_size,self.config.data.dataloader.max_length)).to(self.device),
@@ -167,10 +399,14 @@ class BaseModel(L.LightningModule):
         else:
             raise ValueError(f"Unsupported config.data.dataloader.mode: `{self.config.data.dataloader.mode}`")
         assert fake_batch['input_ids'].numel() <= self.config.data.dataloader.approx_batch_sampler.max_tokens, f"Fake batch size is larger than max_tokens: {fake_batch['input_ids'].numel()} > {self.config.data.dataloader.approx_batch_sampler.max_tokens}"
+        if getattr(self.config.data.dataloader, 'is_sequence_packing', False):
+            # Packed batches also materialize a (B, L, L) attention mask, so include it in the OOM check
+            fake_batch['position_ids'] = torch.arange(self.config.data.dataloader.max_length, device=self.device).expand(fake_batch['input_ids'].shape)
+            fake_batch['segment_ids'] = torch.ones_like(fake_batch['input_ids'])
         if 'hyena' in self.model_name:
             # Hyena doesn't support `attention_mask` in the input, so remove it
             fake_batch.pop('attention_mask')
-        outputs = self.model(**fake_batch)
+        outputs = self.model(**self.get_model_inputs(fake_batch))
         del outputs
         del fake_batch
         # End of OOM detection
@@ -184,12 +420,27 @@ class BaseModel(L.LightningModule):
                 self.trainer.train_dataloader.batch_sampler.sampler.set_epoch(self.trainer.current_epoch)
                 self.trainer.train_dataloader.batch_sampler.start_batch_idx = self.batch_idx if self.batch_idx > 0 else self.trainer.global_step
                 logger.success(f"We are resuming from a checkpoint that used `ApproxBatchSampler`, so set: `epoch={self.trainer.current_epoch}` and `start_batch_idx={self.trainer.train_dataloader.batch_sampler.start_batch_idx}`")
+            elif self.config.data.dataloader.mode == 'packed':
+                self.trainer.train_dataloader.batch_sampler.set_epoch(self.trainer.current_epoch)
+                self.trainer.train_dataloader.batch_sampler.start_batch_idx = self.batch_idx if self.batch_idx > 0 else self.trainer.global_step
+                logger.success(f"We are resuming from a checkpoint that used `PackedBatchSampler`, so set: `epoch={self.trainer.current_epoch}` and `start_batch_idx={self.trainer.train_dataloader.batch_sampler.start_batch_idx}`")
+            elif self.is_length_bucketed_batches():
+                self.trainer.train_dataloader.batch_sampler.set_epoch(self.trainer.current_epoch)
+                self.trainer.train_dataloader.batch_sampler.start_batch_idx = self.batch_idx if self.batch_idx > 0 else self.trainer.global_step
+                logger.success(f"We are resuming from a checkpoint that used `LengthBucketedBatchSampler`, so set: `epoch={self.trainer.current_epoch}` and `start_batch_idx={self.trainer.train_dataloader.batch_sampler.start_batch_idx}`")
+            elif self.config.data.dataloader.mode == 'streaming':
+                self.trainer.train_dataloader.dataset.set_epoch(self.trainer.current_epoch)
+                self.trainer.train_dataloader.dataset.start_batch_idx = self.batch_idx if self.batch_idx > 0 else self.trainer.global_step
+                logger.success(f"We are resuming from a checkpoint that used `StreamingDataset`, so set: `epoch={self.trainer.current_epoch}` and `start_batch_idx={self.trainer.train_dataloader.dataset.start_batch_idx}`")
         torch.distributed.barrier()
 
     def on_validation_start(self):
         # When we restart validation, reset # of tokens that have gone into the val loss calculation to 0
         self.cat_metrics['val_batch_loss'].reset()
         self.cat_metrics['val_batch_tokens_nonPAD'].reset()
+        self.n_val_nan_batches: int = 0
+        # Don't count time spent in validation towards the next training step's MFU
+        self.last_train_step_time = None
 
     def on_validation_epoch_end(self):
         # Calculate per-token val loss and perplexity
@@ -207,6 +458,7 @@ class BaseModel(L.LightningModule):
         # Log the metrics
         self.log('val/loss', loss, on_step=False, on_epoch=True, sync_dist=True)
         self.log('val/ppl', torch.clamp(ppl, max=100).to(torch.float32), on_step=False, on_epoch=True, sync_dist=True)
+        self.log('val/nan_batches', float(getattr(self, 'n_val_nan_batches', 0)), on_step=False, on_epoch=True, sync_dist=True, reduce_fx='sum')
 
         # Log training metrics to sync val/loss to training metrics
         self.log('val/tokens/total_all', (self.sum_metrics['train_total_tokens_PAD'].compute() + self.sum_metrics['train_total_tokens_nonPAD'].compute()).to(torch.float32), on_step=False, on_epoch=True, sync_dist=True)
@@ -228,12 +480,10 @@ class BaseModel(L.LightningModule):
 
         # Metrics
         train_batch_examples: int = B
-        self.sum_metrics['train_total_examples'].update(train_batch_examples)
         self.log('optim/lr', lr)
         self.log('train/loss', loss, prog_bar=True)
         self.log('train/ppl', torch.clamp(ppl, max=100).to(torch.float32))  # artificially cap to 100 so that charts look prettier
         self.log('train/examples/batch', torch.tensor(B, dtype=torch.float32))
-        self.log('train/examples/total', self.sum_metrics['train_total_examples'].compute().to(torch.float32), sync_dist=True)
 
         if 'hyena' in self.model_name:
             # Hyena doesn't have `attention_mask` in the input, so manually calculate number of PAD tokens
@@ -244,13 +494,85 @@ class BaseModel(L.LightningModule):
         else:
             train_batch_tokens_PAD: torch.Tensor = (1 - tokens['attention_mask']).sum()
             train_batch_tokens_nonPAD: torch.Tensor = tokens['attention_mask'].sum()
+        self.log('train/tokens/batch_all', (train_batch_tokens_PAD + train_batch_tokens_nonPAD).to(torch.float32))
+        self.log('train/tokens/batch_PAD', train_batch_tokens_PAD.to(torch.float32))
+        self.log('train/tokens/batch_nonPAD', train_batch_tokens_nonPAD.to(torch.float32))
+
+        # FLOPs (PAD tokens still cost compute, so use the full (B, L) shape)
+        train_batch_flops: int = self.get_train_flops(tokens['input_ids'])
+        self.log('train/flops/batch', float(train_batch_flops))
+        # MFU = achieved FLOP/s on this device (measured between consecutive training steps) / peak FLOP/s
+        current_time: float = time.perf_counter()
+        if self.peak_flops_per_device and self.last_train_step_time is not None:
+            self.log('train/mfu', train_batch_flops / ((current_time - self.last_train_step_time) * self.peak_flops_per_device))
+        self.last_train_step_time = current_time
+
+        if self.is_batched_metrics():
+            # Accumulate on-device (token counts) / on-host (examples, FLOPs) without syncing;
+            # cumulative metrics get updated + logged every `sync_metrics_every_n_steps` steps in `on_train_batch_end()`
+            batch_tokens: torch.Tensor = torch.stack([ train_batch_tokens_PAD, train_batch_tokens_nonPAD ]).to(torch.float64)
+            self.pending_train_tokens = batch_tokens if self.pending_train_tokens is None else self.pending_train_tokens + batch_tokens
+            self.pending_train_examples += train_batch_examples
+            self.pending_train_flops += train_batch_flops
+            return
 
         # Update cumulative metrics
+        # NOTE: `.compute()` already sums across processes, so no need for `sync_dist=True`
+        self.sum_metrics['train_total_examples'].update(train_batch_examples)
         self.sum_metrics['train_total_tokens_PAD'].update(train_batch_tokens_PAD)
         self.sum_metrics['train_total_tokens_nonPAD'].update(train_batch_tokens_nonPAD)
-        self.log('train/tokens/batch_all', (train_batch_tokens_PAD + train_batch_tokens_nonPAD).to(torch.float32))
-        self.log('train/tokens/batch_PAD', train_batch_tokens_PAD.to(torch.float32))
-        self.log('train/tokens/batch_nonPAD', train_batch_tokens_nonPAD.to(torch.float32))
-        self.log('train/tokens/total_all', (self.sum_metrics['train_total_tokens_PAD'].compute() + self.sum_metrics['train_total_tokens_nonPAD'].compute()).to(torch.float32))
-        self.log('train/tokens/total_PAD', self.sum_metrics['train_total_tokens_PAD'].compute().to(torch.float32))
-        self.log('train/tokens/total_nonPAD', self.sum_metrics['train_total_tokens_nonPAD'].compute().to(torch.float32))
\ No newline at end of file
+        self.sum_metrics['train_total_flops'].update(train_batch_flops)
+        train_total_tokens_PAD: torch.Tensor = self.sum_metrics['train_total_tokens_PAD'].compute()
+        train_total_tokens_nonPAD: torch.Tensor = self.sum_metrics['train_total_tokens_nonPAD'].compute()
+        self.log('train/examples/total', self.sum_metrics['train_total_examples'].compute().to(torch.float32))
+        self.log('train/tokens/total_all', (train_total_tokens_PAD + train_total_tokens_nonPAD).to(torch.float32))
+        self.log('train/tokens/total_PAD', train_total_tokens_PAD.to(torch.float32))
+        self.log('train/tokens/total_nonPAD', train_total_tokens_nonPAD.to(torch.float32))
+        self.log('train/flops/total', self.sum_metrics['train_total_flops'].compute().to(torch.float32))
+
+    def is_batched_metrics(self) -> bool:
+        """Return TRUE if cumulative training metrics are only synced across processes every `logging.sync_metrics_every_n_steps` steps"""
+        return (getattr(self.config.logging, 'sync_metrics_every_n_steps', None) or 1) > 1
+
+    def sync_train_metrics(self) -> torch.Tensor:
+        """
+            Batched metrics mode: Flush the training metrics accumulated since the last sync into `self.sum_metrics`, and
+            return the cumulative totals across all processes for `TRAIN_SUM_METRICS` using a single fused all_reduce.
+            NOTE: Must be called on all processes at the same step, otherwise the all_reduce will hang.
+        """
+        pending_train_tokens: torch.Tensor = self.pending_train_tokens if self.pending_train_tokens is not None else torch.zeros(2, dtype=torch.float64, device=self.device)
+        pending: torch.Tensor = torch.cat([
+            torch.tensor([ self.pending_train_examples ], dtype=torch.float64, device=self.device),
+            pending_train_tokens,
+            torch.tensor([ self.pending_train_flops, self.pending_train_nan_batches ], dtype=torch.float64, device=self.device),
+        ])
+        self.pending_train_tokens, self.pending_train_examples, self.pending_train_flops, self.pending_train_nan_batches = None, 0, 0, 0
+        # Local (per-process) state, which gets summed across processes in `.compute()` (e.g. when saving checkpoints)
+        for key, val in zip(TRAIN_SUM_METRICS, pending):
+            self.sum_metrics[key].update(val)
+        if self.train_metric_totals is None:
+            # First sync since (re)starting, so initialize from `self.sum_metrics` (which includes any values loaded from a checkpoint)
+            self.train_metric_totals = torch.stack([ self.sum_metrics[key].compute().to(torch.float64) for key in TRAIN_SUM_METRICS ])
+        else:
+            if dist.is_available() and dist.is_initialized():
+                dist.all_reduce(pending, op=dist.ReduceOp.SUM)
+            self.train_metric_totals += pending
+        return self.train_metric_totals
+
+    def on_train_batch_end(self, outputs: Optional[Dict[str, Any]], batch: Dict[str, Any], batch_idx: int):
+        # `training_step()` returns None if the loss was NaN (i.e. it skipped this batch)
+        is_nan_batch: bool = not outputs or (isinstance(outputs, dict) and outputs.get('loss') is None)
+        if not self.is_batched_metrics():
+            if is_nan_batch:
+                self.sum_metrics['train_total_nan_batches'].update(1)
+            return
+        self.pending_train_nan_batches += int(is_nan_batch)
+        # NOTE: Called on all processes (even those that skipped this batch), so the all_reduce in `sync_train_metrics()` can't hang
+        if (batch_idx + 1) % self.config.logging.sync_metrics_every_n_steps == 0:
+            train_total_examples, train_total_tokens_PAD, train_total_tokens_nonPAD, train_total_flops, train_total_nan_batches = self.sync_train_metrics().to(torch.float32)
+            self.log('train/examples/total', train_total_examples)
+            self.log('train/tokens/total_all', train_total_tokens_PAD + train_total_tokens_nonPAD)
+            self.log('train/tokens/total_PAD', train_total_tokens_PAD)
+            self.log('train/tokens/total_nonPAD', train_total_tokens_nonPAD)
+            self.log('train/flops/total', train_total_flops)
+            self.log('train/nan_batches/total', train_total_nan_batches)
\ No newline at end of file
@@ -1,3 +1,4 @@
+import math
 import torch
 from transformers import AutoModelForMaskedLM, AutoConfig
 from jaxtyping import Float
@@ -5,32 +6,21 @@ from typing import Dict, Any, Optional, Union
 from torch import nn
 from omegaconf import DictConfig
 from transformers.models.bert.modeling_bert import BertSelfAttention
-from hf_ehr.models.base import BaseModel
+from hf_ehr.models.base import ATTN_BACKENDS, BaseModel, RotaryEmbedding, apply_rotary_pos_emb_, get_segment_attention_mask
 
 # Custom Bert Self Attention Layer with RoPE
 class RoPEBertSelfAttention(BertSelfAttention):
-    def __init__(self, config):
+    def __init__(self, config, rotary_emb: Optional[RotaryEmbedding] = None, attn_backend: str = 'sdpa'):
         super().__init__(config)
-        print("Initialized RoPEBertSelfAttention with RoPE enabled.")
+        assert attn_backend in ATTN_BACKENDS, f"ERROR - Unknown `attn_backend`: {attn_backend}. Must be one of {ATTN_BACKENDS}"
+        # NOTE: Pass the same `rotary_emb` to every layer so that the cos / sin tables are only stored once
+        self.rotary_emb: RotaryEmbedding = rotary_emb if rotary_emb is not None else RotaryEmbedding(self.attention_head_size, config.max_position_embeddings)
+        self.attn_backend: str = attn_backend
 
     def apply_rope(self, q, k):
-        seq_len = q.shape[2]
-        dim = q.shape[-1]
-        inv_freq = 1.0 / (10000 ** (torch.arange(0, dim, 2).float() / dim))
-
-        sinusoid_inp = torch.einsum("i,d->id", torch.arange(seq_len).float(), inv_freq)
-        sin = torch.sin(sinusoid_inp)
-        cos = torch.cos(sinusoid_inp)
-        sin, cos = sin.to(q.device), cos.to(q.device)
-
-        print(f"RoPE is being applied: Sequence Length = {seq_len}, Dim = {dim}")
-        q_sin_cos = torch.cat([q[..., ::2] * cos - q[..., 1::2] * sin,
-                               q[..., ::2] * sin + q[..., 1::2] * cos], dim=-1)
-        k_sin_cos = torch.cat([k[..., ::2] * cos - k[..., 1::2] * sin,
-                               k[..., ::2] * sin + k[..., 1::2] * cos], dim=-1)
-
-        print(f"q shape after RoPE: {q_sin_cos.shape}, k shape after RoPE: {k_sin_cos.shape}")
-        return q_sin_cos, k_sin_cos
+        # Rotates `q` and `k` in-place using the cached cos / sin tables
+        cos, sin = self.rotary_emb(q.shape[2], q.dtype)
+        return apply_rotary_pos_emb_(q, cos, sin), apply_rotary_pos_emb_(k, cos, sin)
 
     def forward(self, hidden_states, attention_mask=None, head_mask=None, encoder_hidden_states=None, encoder_attention_mask=None, past_key_value=None, output_attentions=False):
         mixed_query_layer = self.query(hidden_states)
@@ -47,8 +37,17 @@ class RoPEBertSelfAttention(BertSelfAttention):
 
         query_layer, key_layer = self.apply_rope(query_layer, key_layer)
 
+        if self.attn_backend == 'sdpa' and not output_attentions and head_mask is None:
+            # Never materializes the L x L attention matrix (if a flash / memory-efficient kernel is available)
+            # NOTE: SDPA can't return attention weights or apply a head mask, so fall back to eager attention for those
+            context_layer = torch.nn.functional.scaled_dot_product_attention(query_layer, key_layer, value_layer, 
+                                                                             attn_mask=attention_mask if attention_mask is None else attention_mask.to(query_layer.dtype), 
+                                                                             dropout_p=self.dropout.p if self.training else 0.0)
+            context_layer = context_layer.transpose(1, 2).reshape(*hidden_states.shape[:-1], self.all_head_size)
+            return (context_layer,)
+
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
-        attention_scores = attention_scores / torch.sqrt(torch.tensor(self.attention_head_size, dtype=torch.float32))
+        attention_scores = attention_scores / math.sqrt(self.attention_head_size)
 
         if attention_mask is not None:
             attention_scores = attention_scores + attention_mask
@@ -85,6 +84,7 @@ class BERTLanguageModel(BaseModel):
         # Model
         self.model = AutoModelForMaskedLM.from_config(model_config)
         self.is_use_rope = getattr(config.data.dataloader, 'is_use_rope', False) # added to replace default attention layers with custom RoPEGPT2Attention layers
+        self.attn_backend: str = getattr(config.model, 'attn_backend', 'sdpa') # attention implementation used by the RoPE attention layers
         
         if self.is_use_rope:
             self._replace_attention_with_rope()
@@ -94,8 +94,13 @@ class BERTLanguageModel(BaseModel):
     
     def _replace_attention_with_rope(self):
         # Iterate over each encoder layer and replace its self-attention layer with RoPE-enhanced version
+        rotary_emb = RotaryEmbedding(self.model.config.hidden_size // self.model.config.num_attention_heads, self.model.config.max_position_embeddings)
         for layer in self.model.bert.encoder.layer:
-            layer.attention.self = RoPEBertSelfAttention(self.model.config)
+            layer.attention.self = RoPEBertSelfAttention(self.model.config, rotary_emb=rotary_emb, attn_backend=self.attn_backend)
+
+    def get_packed_attention_mask(self, segment_ids: torch.Tensor) -> Optional[torch.Tensor]:
+        # BERT is bidirectional, and HF expands a 3D (B, L, L) mask of 1 = attend / 0 = ignore into the 4D additive mask itself
+        return get_segment_attention_mask(segment_ids, is_causal=False).long()
 
     def training_step(self, 
                       batch: Dict[str, Any],
@@ -103,7 +108,7 @@ class BERTLanguageModel(BaseModel):
         tokens: Dict[str, Float[torch.Tensor, 'B L']] = batch['tokens']
         B: int = tokens['input_ids'].shape[0]
 
-        outputs = self.model(**tokens)
+        outputs = self.model(**self.get_model_inputs(tokens))
         loss: torch.Tensor = outputs.loss
         ppl: torch.Tensor = torch.exp(loss).detach()
         
@@ -116,3 +121,33 @@ class BERTLanguageModel(BaseModel):
         self.log_training_step(loss.detach(), B, tokens, lr)
 
         return loss
+
+if __name__ == '__main__':
+    # Check that the 'sdpa' attention backend matches 'eager' for RoPEBertSelfAttention (runs on CPU)
+    from transformers import BertConfig, BertForMaskedLM
+    model_config = BertConfig(num_hidden_layers=2, num_attention_heads=4, hidden_size=64, intermediate_size=128, vocab_size=100, max_position_embeddings=64, 
+                              hidden_dropout_prob=0.0, attention_probs_dropout_prob=0.0)
+    rotary_emb = RotaryEmbedding(model_config.hidden_size // model_config.num_attention_heads, model_config.max_position_embeddings)
+    models: Dict[str, BertForMaskedLM] = {}
+    for attn_backend in [ 'eager', 'sdpa' ]:
+        torch.manual_seed(0)
+        models[attn_backend] = BertForMaskedLM(model_config)
+        for layer in models[attn_backend].bert.encoder.layer:
+            layer.attention.self = RoPEBertSelfAttention(model_config, rotary_emb=rotary_emb, attn_backend=attn_backend)
+        models[attn_backend].load_state_dict(models['eager'].state_dict())
+    input_ids = torch.randint(0, 100, (2, 32))
+    padding_mask = torch.ones_like(input_ids)
+    padding_mask[1, 20:] = 0
+    segment_ids = torch.cat([ torch.full((2, 10), 1), torch.full((2, 22), 2) ], dim=1)
+    packed_mask = get_segment_attention_mask(segment_ids, is_causal=False).long() # see `BERTLanguageModel.get_packed_attention_mask()`
+    for name, mask in [ ('padding mask', padding_mask), ('packed mask', packed_mask) ]:
+        outputs = { attn_backend: model(input_ids=input_ids, attention_mask=mask, labels=input_ids) for attn_backend, model in models.items() }
+        for output in outputs.values():
+            output.loss.backward()
+        valid = padding_mask.bool()
+        assert torch.allclose(outputs['eager'].logits[valid], outputs['sdpa'].logits[valid], atol=1e-5), f"ERROR - {name}: logits differ"
+        for p_eager, p_sdpa in zip(models['eager'].parameters(), models['sdpa'].parameters()):
+            if p_eager.grad is not None:
+                assert torch.allclose(p_eager.grad, p_sdpa.grad, atol=1e-5), f"ERROR - {name}: grads differ"
+            p_eager.grad, p_sdpa.grad = None, None
+    print("Success! 'sdpa' matches 'eager'")
@@ -1,91 +1,83 @@
 import torch
 import torch.distributed as dist
 from transformers import AutoModelForCausalLM, AutoConfig
-from transformers.models.gpt2.modeling_gpt2 import GPT2Attention
+from transformers.models.gpt2.modeling_gpt2 import GPT2Attention, eager_attention_forward
 from typing import Dict, Any, Optional, Union
 from omegaconf import DictConfig
 from typing import Dict, Any, Optional
 from jaxtyping import Float
 from lightning.pytorch.utilities import rank_zero_only
-from hf_ehr.models.base import BaseModel
-
-#######################################
-## Rotary Positional Embedding (ROPE) ##
-#######################################
-def rotate_every_two_v2(x):
-    """Performs rotary transformation on input tensor"""
-    flat_x = x.reshape(-1, x.shape[-1])
-    x1 = flat_x[:, ::2]
-    x2 = flat_x[:, 1::2]
-    result = torch.stack((-x2, x1), axis=-1).reshape(x.shape)
-    return result
-
-def fixed_pos_embedding(ages, dim, dtype):
-    """Generates sinusoidal positional embeddings based on inv freq of positions"""
-    inv_freq = 1.0 / (10000 ** (torch.linspace(0, dim - 1, steps=dim // 2, device=ages.device)))
-    inv_freq = inv_freq.reshape(1, 1, dim // 2)
-    ages = ages.reshape(ages.shape[0], 1)
-    t = inv_freq * ages
-    sin, cos = torch.sin(t), torch.cos(t)
-    final_shape = (ages.shape[0], 1, dim)
-    sin = torch.stack((sin, sin), axis=-1).reshape(final_shape).type(dtype)
-    cos = torch.stack((cos, cos), axis=-1).reshape(final_shape).type(dtype)
-    return sin, cos
-
-def apply_rotary_pos_emb(x, sincos):
-    """Applies rotary positional embedding"""
-    sin, cos = sincos
-    sin = sin.to(dtype=x.dtype)
-    cos = cos.to(dtype=x.dtype)
-
-    if sin.dim() == 3 and x.dim() == 4:
-        sin = sin.unsqueeze(1)  # Add extra dimension to sin and cos if necessary
-        cos = cos.unsqueeze(1)
-    
-    if sin.shape[0] != x.shape[0]:
-        sin = sin.transpose(0, 1)
-        cos = cos.transpose(0, 1)
-
-    sin = sin.expand_as(x)
-    cos = cos.expand_as(x)
-
-    result = (x * cos) + (rotate_every_two_v2(x) * sin)
-    assert result.shape == x.shape, f"Result shape mismatch: {result.shape} vs {x.shape}"
-
-    return result
+from hf_ehr.models.base import ATTN_BACKENDS, BaseModel, RotaryEmbedding, apply_rotary_pos_emb_
 
 # Custom GPT-2 Attention Layer with RoPE
 class RoPEGPT2Attention(GPT2Attention):
     """"Extends the default GPT-2 attention mechanism to support RoPE"""
-    def __init__(self, config):
-        super().__init__(config)
-        self.split_size = config.hidden_size
-
-    def forward(self, hidden_states, layer_past=None, attention_mask=None, head_mask=None, use_cache=False, output_attentions=False):
-        # linear transformation to create Q, K, V tensors 
-        mixed_x_layer = self.c_attn(hidden_states)
-
-        # Split into Q, K, V tensors
-        q, k, v = mixed_x_layer.split(self.split_size, dim=-1)        
-
-        # Generating Rotary Positional Embeddings 
-        seq_length = q.shape[-2]
-        sincos = fixed_pos_embedding(torch.arange(seq_length, device=q.device).float(), q.shape[-1], q.dtype)
-
-        # Applying Rotary Positionam Embeddings
-        q = apply_rotary_pos_emb(q, sincos)
-        k = apply_rotary_pos_emb(k, sincos)
+    def __init__(self, config, layer_idx: Optional[int] = None, rotary_emb: Optional[RotaryEmbedding] = None, attn_backend: str = 'sdpa'):
+        super().__init__(config, layer_idx=layer_idx)
+        assert attn_backend in ATTN_BACKENDS, f"ERROR - Unknown `attn_backend`: {attn_backend}. Must be one of {ATTN_BACKENDS}"
+        # NOTE: Pass the same `rotary_emb` to every layer so that the cos / sin tables are only stored once
+        self.rotary_emb: RotaryEmbedding = rotary_emb if rotary_emb is not None else RotaryEmbedding(self.head_dim, config.n_positions)
+        self.attn_backend: str = attn_backend
+
+    def sdpa_attention_forward(self, q, k, v, attention_mask) -> torch.Tensor:
+        """Same as `eager_attention_forward()`, but never materializes the L x L attention matrix (if a flash / memory-efficient kernel is available)"""
+        scale: float = (1.0 / (self.head_dim ** 0.5) if self.scale_attn_weights else 1.0) / (float(self.layer_idx + 1) if self.scale_attn_by_inverse_layer_idx else 1.0)
+        q_len, k_len = q.shape[-2], k.shape[-2]
+        is_causal: bool = False
+        if attention_mask is None and q_len == k_len:
+            # Let the kernel apply the causal mask itself
+            is_causal = q_len > 1
+        elif attention_mask is None and q_len == 1:
+            # Decoding a single token with a KV-cache, so it can attend to every cached token
+            pass
+        elif attention_mask is None or attention_mask.shape[-2] == 1:
+            # No mask or a padding-only mask (i.e. (B, 1, 1, L)), so we need to add the causal mask that `eager_attention_forward()` applies via `self.bias`
+            # NOTE: SDPA's `is_causal` aligns the mask to the top-left, which is wrong when the queries come after cached keys (i.e. `q_len < k_len`)
+            causal_mask = self.bias[:, :, k_len - q_len:k_len, :k_len]
+            attention_mask = torch.where(causal_mask, attention_mask if attention_mask is not None else 0.0, torch.finfo(q.dtype).min)
+        # Otherwise, the (B, 1, L, L) mask already includes the causal mask (i.e. HF's SDPA mask, or our packed block-diagonal mask)
+        attn_output = torch.nn.functional.scaled_dot_product_attention(q, k, v, 
+                                                                       attn_mask=attention_mask if attention_mask is None else attention_mask.to(q.dtype), 
+                                                                       dropout_p=self.attn_dropout.p if self.training else 0.0, 
+                                                                       is_causal=is_causal, 
+                                                                       scale=scale)
+        return attn_output.transpose(1, 2)
+
+    def forward(self, hidden_states, layer_past=None, attention_mask=None, head_mask=None, use_cache=False, output_attentions=False, **kwargs):
+        # linear transformation to create Q, K, V tensors, then split into heads
+        # NOTE: Select Q, K, V from a single view (rather than `split()`) so that RoPE can be applied to them in-place
+        B, L, _ = hidden_states.shape
+        qkv = self.c_attn(hidden_states).view(B, L, 3, self.num_heads, self.head_dim)
+        q = qkv[:, :, 0].transpose(1, 2) # (B, H, L, D)
+        k = qkv[:, :, 1].transpose(1, 2)
+        v = qkv[:, :, 2].transpose(1, 2)
+
+        # Applying Rotary Positional Embeddings (cached cos / sin tables)
+        # NOTE: If we have a KV-cache, then these tokens' positions start right after the cached tokens
+        past_length: int = layer_past[0].shape[-2] if layer_past is not None else 0
+        cos, sin = self.rotary_emb(L, q.dtype, position_offset=past_length)
+        apply_rotary_pos_emb_(q, cos, sin)
+        apply_rotary_pos_emb_(k, cos, sin)
+
+        # KV-cache -- cache keys AFTER RoPE is applied, so cached keys never need to be rotated again
+        if layer_past is not None:
+            past_key, past_value = layer_past
+            k = torch.cat((past_key, k), dim=-2)
+            v = torch.cat((past_value, v), dim=-2)
+        present = (k, v) if use_cache else None
 
         # Attention step
-        attn_output, present = self._attn(q, k, v, attention_mask, head_mask)
-
-        # Reshape attn_output to match hidden_states' batch and sequence dimensions
-        if attn_output.shape[1] != hidden_states.shape[1]:
-            attn_output = attn_output.mean(dim=1)
+        # NOTE: SDPA can't return attention weights or apply a head mask, so fall back to eager attention for those
+        if self.attn_backend == 'sdpa' and not output_attentions and head_mask is None and not self.reorder_and_upcast_attn:
+            attn_output, attn_weights = self.sdpa_attention_forward(q, k, v, attention_mask), None
+        else:
+            attn_output, attn_weights = eager_attention_forward(self, q, k, v, attention_mask, head_mask=head_mask)
 
-        # Final linear projection
+        # Merge heads + final linear projection
+        attn_output = attn_output.reshape(B, L, self.embed_dim)
         attn_output = self.c_proj(attn_output)
-        return attn_output, present
+        attn_output = self.resid_dropout(attn_output)
+        return (attn_output, present, attn_weights) if output_attentions else (attn_output, present)
 
 class GPTLanguageModel(BaseModel):
     """
@@ -125,16 +117,41 @@ class GPTLanguageModel(BaseModel):
             
         # ROPE
         self.is_use_rope = getattr(config.data.dataloader, 'is_use_rope', False) # added to replace default attention layers with custom RoPEGPT2Attention layers
+        self.attn_backend: str = getattr(config.model, 'attn_backend', 'sdpa') # attention implementation used by the RoPE attention layers
         if self.is_use_rope:
             self._replace_attention_with_rope()
 
+        # Sequence packing -- GPT2Model flattens `attention_mask` to 2D, so we inject the block-diagonal mask directly into each attention layer
+        self.packed_attention_mask: Optional[torch.Tensor] = None
+        for block in self.model.transformer.h:
+            block.attn.register_forward_pre_hook(self._set_packed_attention_mask, with_kwargs=True)
+        self.model.register_forward_hook(self._clear_packed_attention_mask)
+
         # Run any post-init handlers from super()
         self.post_init()
 
     def _replace_attention_with_rope(self):
         """Adds RoPE for all layers"""
-        for block in self.model.transformer.h:
-            block.attn = RoPEGPT2Attention(self.model.config)
+        rotary_emb = RotaryEmbedding(self.model.config.n_embd // self.model.config.n_head, self.model.config.n_positions)
+        for layer_idx, block in enumerate(self.model.transformer.h):
+            block.attn = RoPEGPT2Attention(self.model.config, layer_idx=layer_idx, rotary_emb=rotary_emb, attn_backend=self.attn_backend)
+
+    def _set_packed_attention_mask(self, module, args, kwargs):
+        """Forward pre-hook for each attention layer that swaps in the block-diagonal mask of the current packed batch (if any)"""
+        if self.packed_attention_mask is not None:
+            kwargs['attention_mask'] = self.packed_attention_mask
+        return args, kwargs
+
+    def _clear_packed_attention_mask(self, module, args, outputs):
+        """Forward hook for `self.model` so that a packed batch's mask never leaks into the next forward pass"""
+        self.packed_attention_mask = None
+
+    def get_model_inputs(self, tokens: Dict[str, Any]) -> Dict[str, Any]:
+        inputs: Dict[str, Any] = super().get_model_inputs(tokens)
+        if 'segment_ids' in tokens:
+            # Pass the 4D mask to `_set_packed_attention_mask()` instead of GPT2Model (which would flatten it)
+            self.packed_attention_mask = inputs.pop('attention_mask')
+        return inputs
     
     def training_step(self, 
                       batch: Dict[str, Any],
@@ -143,7 +160,7 @@ class GPTLanguageModel(BaseModel):
         tokens: Dict[str, Float[torch.Tensor, 'B L']] = batch['tokens']
         B: int = tokens['input_ids'].shape[0]
 
-        outputs = self.model(**tokens)
+        outputs = self.model(**self.get_model_inputs(tokens))
         loss: torch.Tensor = outputs.loss
 
         # Check if loss is NaN and handle accordingly
@@ -160,4 +177,47 @@ class GPTLanguageModel(BaseModel):
         # Logging + Metrics
         self.log_training_step(loss.detach(), B, tokens, lr)
 
-        return loss
\ No newline at end of file
+        return loss
+if __name__ == '__main__':
+    # Check that the 'sdpa' attention backend matches 'eager' for RoPEGPT2Attention, and that its KV-cache is correct (runs on CPU)
+    from transformers import GPT2Config, GPT2LMHeadModel
+    from hf_ehr.models.base import get_segment_attention_mask
+    torch.manual_seed(0)
+    model_config = GPT2Config(n_layer=2, n_head=4, n_embd=64, n_positions=64, vocab_size=100, attn_pdrop=0.0, resid_pdrop=0.0, embd_pdrop=0.0)
+    rotary_emb = RotaryEmbedding(model_config.n_embd // model_config.n_head, model_config.n_positions)
+    models: Dict[str, GPT2LMHeadModel] = {}
+    for attn_backend in [ 'eager', 'sdpa' ]:
+        torch.manual_seed(0)
+        models[attn_backend] = GPT2LMHeadModel(model_config)
+        for layer_idx, block in enumerate(models[attn_backend].transformer.h):
+            block.attn = RoPEGPT2Attention(model_config, layer_idx=layer_idx, rotary_emb=rotary_emb, attn_backend=attn_backend)
+        models[attn_backend].load_state_dict(models['eager'].state_dict())
+    input_ids = torch.randint(0, 100, (2, 32))
+    padding_mask = torch.ones_like(input_ids)
+    padding_mask[1, 20:] = 0
+    segment_ids = torch.cat([ torch.full((2, 10), 1), torch.full((2, 22), 2) ], dim=1)
+    packed_mask = torch.zeros((2, 1, 32, 32)).masked_fill_(~get_segment_attention_mask(segment_ids, is_causal=True)[:, None], torch.finfo(torch.float32).min)
+    for name, kwargs in [ ('no mask', {}), ('padding mask', { 'attention_mask' : padding_mask }) ]:
+        outputs = { attn_backend: model(input_ids=input_ids, labels=input_ids, **kwargs) for attn_backend, model in models.items() }
+        for attn_backend, output in outputs.items():
+            output.loss.backward()
+        valid = padding_mask.bool() if 'attention_mask' in kwargs else torch.ones_like(padding_mask).bool()
+        assert torch.allclose(outputs['eager'].logits[valid], outputs['sdpa'].logits[valid], atol=1e-5), f"ERROR - {name}: logits differ"
+        for (_, p_eager), (_, p_sdpa) in zip(models['eager'].named_parameters(), models['sdpa'].named_parameters()):
+            assert torch.allclose(p_eager.grad, p_sdpa.grad, atol=1e-5), f"ERROR - {name}: grads differ"
+            p_eager.grad, p_sdpa.grad = None, None
+    # Packed block-diagonal mask is passed directly to each attention layer (see `GPTLanguageModel._set_packed_attention_mask()`)
+    hidden_states = torch.randn(2, 32, 64)
+    outputs = [ model.transformer.h[0].attn(hidden_states, attention_mask=packed_mask)[0] for model in models.values() ]
+    assert torch.allclose(outputs[0], outputs[1], atol=1e-5), "ERROR - packed mask: outputs differ"
+    # KV-cache -- prefilling a prompt, then a chunk, then decoding token-by-token should match a single forward pass over the whole sequence
+    for attn_backend, model in models.items():
+        model.eval()
+        with torch.no_grad():
+            logits = model(input_ids=input_ids).logits
+            outputs = [ model(input_ids=input_ids[:, :16], use_cache=True) ]
+            outputs.append(model(input_ids=input_ids[:, 16:24], past_key_values=outputs[-1].past_key_values, use_cache=True))
+            for idx in range(24, input_ids.shape[1]):
+                outputs.append(model(input_ids=input_ids[:, idx:idx + 1], past_key_values=outputs[-1].past_key_values, use_cache=True))
+        assert torch.allclose(logits, torch.cat([ x.logits for x in outputs ], dim=1), atol=1e-5), f"ERROR - KV-cache ({attn_backend}): logits differ"
+    print("Success! 'sdpa' matches 'eager', and KV-cache matches no cache")
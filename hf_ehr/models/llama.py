@@ -39,6 +39,13 @@ class LlamaLanguageModel(BaseModel):
         # Run any post-init handlers from super()
         self.post_init()
 
+    def get_packed_attention_mask(self, segment_ids: torch.Tensor) -> Optional[torch.Tensor]:
+        if self.model_config._attn_implementation == 'flash_attention_2':
+            # Flash Attention doesn't accept 4D masks, but if `attention_mask=None` then HF detects packed timelines 
+            # from `position_ids` resetting to 0 and uses `flash_attn_varlen_func` (i.e. no cross-timeline attention)
+            return None
+        return super().get_packed_attention_mask(segment_ids)
+
     def training_step(self, 
                       batch: Dict[str, Any],
                       batch_idx: int) -> Optional[torch.Tensor]:
@@ -47,7 +54,7 @@ class LlamaLanguageModel(BaseModel):
 
         tokens.pop("token_type_ids", None)
 
-        outputs = self.model(**tokens)
+        outputs = self.model(**self.get_model_inputs(tokens))
         loss: torch.Tensor = outputs.loss
         
         # Learning rate scheduler
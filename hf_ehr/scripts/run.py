@@ -23,7 +23,7 @@ from hf_ehr.models.mamba import MambaLanguageModel
 from hf_ehr.models.llama import LlamaLanguageModel
 from hf_ehr.models.based import BasedLanguageModel
 from hf_ehr.models.t5 import T5LanguageModel
-from hf_ehr.trainer.loaders import load_datasets, load_dataloaders
+from hf_ehr.trainer.loaders import load_datasets, load_dataloaders, is_length_bucketed_batches
 from hf_ehr.config import rewrite_paths_for_carina_from_config
 from hf_ehr.logger.reloggers import WandbRelogger
 import torch.distributed as dist
@@ -414,7 +414,15 @@ def main(config: DictConfig) -> None:
         ]
     if getattr(config.callbacks.model_checkpointing, 'every_n_flops', None) not in [None, "None"]:
         # Save checkpoint every `every_n_flops` FLOPs; persists all models
-        logger.error(f"Skipping FLOPs checkpoint b/c incorrectly calculated")
+        logger.critical("Adding MetricBasedCheckpoint for FLOPs...")
+        callbacks += [ 
+            MetricBasedCheckpoint(
+                dirpath=path_to_ckpt_dir,
+                metric_name="train/flops/total",
+                is_valid_metric_func=lambda x,y: train_flops_metric_func(x, y, config),
+                is_run_val=config.callbacks.model_checkpointing.is_run_eval_on_checkpoint,
+            ),
+        ]
         
     if is_log_grad_norm:
         callbacks += [ GradNormCallback() ]
@@ -442,7 +450,7 @@ def main(config: DictConfig) -> None:
         accumulate_grad_batches=config.trainer.accumulate_grad_batches,
         gradient_clip_val=config.trainer.gradient_clip_value,
         gradient_clip_algorithm=config.trainer.gradient_clip_algorithm,
-        use_distributed_sampler=False if getattr(config.data.dataloader, 'mode', 'batch') == 'approx' else True
+        use_distributed_sampler=False if getattr(config.data.dataloader, 'mode', 'batch') in ['approx', 'packed'] or is_length_bucketed_batches(config) else True
     )
 
     # Run
@@ -8,7 +8,7 @@ import numpy as np
 from tqdm import tqdm
 from typing import Callable, List, Dict, Optional, Set, Tuple, Any
 from hf_ehr.config import (
-    Event,
+    Timeline,
     CodeTCE, 
     CategoricalTCE,
     CountOccurrencesTCEStat, 
@@ -274,20 +274,23 @@ def calc_code_2_occurrence_count(args: Tuple) -> Dict[str, int]:
     start_time = datetime.datetime.now()
     results: Dict[str, int] = collections.defaultdict(int)
     for pid in tqdm(pids, total=len(pids), desc='pids'):
-        for event in femr_db[pid].events:
-            if dataset_cls == 'FEMRDataset':
-                e = event
-            elif dataset_cls == 'MEDSDataset':
-                unit: str = event.code.split("//")[-1] if event.numeric_value is not None else None
-                value = event.text_value if event.text_value is not None else (event.numeric_value if event.numeric_value is not None else None)
-                e = Event(
-                    code=event.code,
-                    value=value,
-                    unit=unit
-                )
-            token = tokenizer.convert_event_to_token(e)
-            if token is not None:
-                results[token] += 1
+        if dataset_cls == 'FEMRDataset':
+            timeline: Timeline = Timeline.from_events(femr_db[pid].events)
+        elif dataset_cls == 'MEDSDataset':
+            events = list(femr_db[pid].events)
+            timeline: Timeline = Timeline.from_columns(
+                codes=[ e.code for e in events ],
+                values=[ e.text_value if e.text_value is not None else e.numeric_value for e in events ],
+                units=[ e.code.split("//")[-1] if e.numeric_value is not None else None for e in events ],
+                starts=[ None ] * len(events),
+                ends=[ None ] * len(events),
+                omop_tables=[ None ] * len(events),
+            )
+        # Map every event => token id, then count each token
+        token_ids: np.ndarray = tokenizer.compiled_lookup.lookup_events(timeline)
+        unique_token_ids, counts = np.unique(token_ids[token_ids >= 0], return_counts=True)
+        for token_id, count in zip(unique_token_ids.tolist(), counts.tolist()):
+            results[tokenizer.idx_2_token[token_id]] += count
     print(f"Finish | Processing events | Time= {datetime.datetime.now() - start_time}s")
     
     # Save to cached file (if applicable)
@@ -1,16 +1,63 @@
+import os
+import torch
 from torch.utils.data import DataLoader
-from typing import Any, Dict, Optional, Union, List
-from hf_ehr.trainer.samplers import ApproxBatchSampler, SortishSampler
+from typing import Any, Dict, Optional, Union
+from hf_ehr.trainer.samplers import ApproxBatchSampler, SortishSampler, PackedBatchSampler, LengthBucketedBatchSampler
 from omegaconf import DictConfig 
-from hf_ehr.data.datasets import FEMRDataset, BaseDataset, AllTokensFEMRDataset, MEDSDataset
-from hf_ehr.data.tokenization import BaseTokenizer, collate_femr_timelines
+from hf_ehr.data.datasets import FEMRDataset, BaseDataset, AllTokensFEMRDataset, MEDSDataset, PretokenizedDataset, StreamingDataset, get_n_events_per_patient
+from hf_ehr.data.tokenization import BaseTokenizer, FEMRCollator
 from loguru import logger
 import numpy as np
 
+def get_idx_to_seq_length(dataset_name: str, dataset: BaseDataset, tokenizer: BaseTokenizer) -> np.ndarray:
+    """Return the sequence length of each example in `dataset`"""
+    if dataset_name in ['FEMRDataset', 'MEDSDataset']:
+        # Each example in the dataset is a patient, so simply return the sequence length of each patient
+        return tokenizer.get_seq_length_per_patient(dataset)
+    elif dataset_name == 'AllTokensFEMRDataset':
+        # Each example in the dataset is a SUBSET of a patient, so return the sequence length of each example -- slightly trickier than FEMRDataset
+        return dataset.idx_to_seq_length
+    elif dataset_name == 'PretokenizedDataset':
+        # Each example in the dataset is a patient, and the token store already knows the sequence length of each patient
+        return dataset.seq_length_per_patient
+    else:
+        raise ValueError(f"Unknown dataset_name: {dataset_name}")
+
+def get_idx_to_approx_seq_length(dataset_name: str, dataset: BaseDataset, tokenizer: BaseTokenizer) -> np.ndarray:
+    """Return a value that roughly orders examples in `dataset` by sequence length (i.e. good enough for bucketing, but not for token budgets).
+        Uses the tokenizer's cached sequence lengths if they exist; otherwise falls back to the # of events per patient in the extract 
+        (which is much cheaper than tokenizing every patient, and is shared across tokenizers)."""
+    if dataset_name in ['FEMRDataset', 'MEDSDataset'] and not tokenizer.is_seq_length_per_patient_cached(dataset):
+        return get_n_events_per_patient(dataset)
+    return get_idx_to_seq_length(dataset_name, dataset, tokenizer)
+
+def is_length_bucketed_batches(config: DictConfig) -> bool:
+    """Return TRUE if the 'batch' dataloader mode should group examples of similar lengths into the same batch (see `LengthBucketedBatchSampler`)"""
+    batch_sampler: Optional[Any] = getattr(config.data.dataloader, 'batch_sampler', None)
+    return getattr(config.data.dataloader, 'mode', 'batch') == 'batch' and getattr(batch_sampler, 'is_length_bucketed', False)
+
+def get_rank() -> int:
+    """Return the global rank of this process. Unlike `torch.distributed.get_rank()`, this also works before DDP has been initialized 
+        (i.e. while loading datasets), since Lightning sets these env vars when it launches each process."""
+    if torch.distributed.is_initialized():
+        return torch.distributed.get_rank()
+    for key in [ 'RANK', 'LOCAL_RANK', 'SLURM_PROCID' ]:
+        if key in os.environ:
+            return int(os.environ[key])
+    return 0
+
+def is_shard_by_rank(config: DictConfig) -> bool:
+    """Return TRUE if each GPU's process should only load its own shard of each dataset (see `AllTokensFEMRDataset`)"""
+    return getattr(config.data.dataset, 'is_shard_by_rank', False) and len(config.trainer.devices) > 1
+
 def load_dataloaders(config: DictConfig, 
                      datasets: Dict[str, BaseDataset], 
                      tokenizer: BaseTokenizer) -> Dict[str, DataLoader]:
     dataset_name: str = config.data.dataset.name
+    if getattr(config.data.dataset, 'is_pretokenized', False) and dataset_name != 'AllTokensFEMRDataset':
+        # Timelines are already token ids, so collate them as such
+        # NOTE: AllTokensFEMRDataset returns token ids itself when `is_pretokenized`, so keep its name (its examples are windows, not patients)
+        dataset_name = 'PretokenizedDataset'
     batch_size: Optional[int] = getattr(config.data.dataloader, 'batch_size', None)
     approx_batch_sampler: Optional[Any] = getattr(config.data.dataloader, 'approx_batch_sampler', None)
     dataloader_mode: str = getattr(config.data.dataloader, 'mode', 'batch')
@@ -21,9 +68,17 @@ def load_dataloaders(config: DictConfig,
         if config.model.name == 'bert':
             is_mlm = True  # MLM is typically associated with BERT
     mlm_prob: float = config.data.mlm_prob if is_mlm else 0.0
+    is_sequence_packing: bool = getattr(config.data.dataloader, 'is_sequence_packing', False)
+    if is_sequence_packing:
+        # Packed rows need a block-diagonal attention mask, which only our attention-based models know how to build
+        assert config.model.name in ['gpt', 'llama', 'bert'], f"ERROR - `data.dataloader.is_sequence_packing` is only supported for 'gpt', 'llama', and 'bert' models, not `{config.model.name}`"
     n_workers: int = config.data.dataloader.n_workers
     seed: int = config.main.seed
     n_replicas: int = len(config.trainer.devices)
+    if is_shard_by_rank(config):
+        # Each dataset only holds this GPU's shard of examples, so the samplers shouldn't split them any further
+        assert is_length_bucketed_batches(config), f"ERROR - `data.dataset.is_shard_by_rank` requires `data.dataloader.mode` = 'batch' with `batch_sampler.is_length_bucketed`, not mode = `{dataloader_mode}`"
+        n_replicas = 1
     
     # Samplers
     if dataloader_mode == 'approx':
@@ -35,77 +90,142 @@ def load_dataloaders(config: DictConfig,
         secondary_sort_key = None
 
         # Get sequence lengths for each example in dataset
-        if dataset_name == 'FEMRDataset':
-            # Each example in the dataset is a patient, so simply return the sequence length of each patient
-            train_idx_to_seq_length: List[int] = tokenizer.get_seq_length_per_patient(datasets['train'])
-            val_idx_to_seq_length: List[int] = tokenizer.get_seq_length_per_patient(datasets['val'])
-            test_idx_to_seq_length: List[int] = tokenizer.get_seq_length_per_patient(datasets['test'])
-        elif dataset_name == 'AllTokensFEMRDataset':
-            # Each example in the dataset is a SUBSET of a patient, so return the sequence length of each example -- slightly trickier than FEMRDataset
-            train_idx_to_seq_length: List[int] = datasets['train'].idx_to_seq_length
-            val_idx_to_seq_length: List[int] = datasets['val'].idx_to_seq_length
-            test_idx_to_seq_length: List[int] = datasets['test'].idx_to_seq_length
+        train_idx_to_seq_length: np.ndarray = get_idx_to_seq_length(dataset_name, datasets['train'], tokenizer)
+        val_idx_to_seq_length: np.ndarray = get_idx_to_seq_length(dataset_name, datasets['val'], tokenizer)
+        test_idx_to_seq_length: np.ndarray = get_idx_to_seq_length(dataset_name, datasets['test'], tokenizer)
+        if dataset_name == 'AllTokensFEMRDataset':
             is_random_shuffle_within_buckets = False # for more cache hits since we will repeatedly query the same patient for subsets of their timeline
-            secondary_sort_key = [ x[0] for x in datasets['train'].idx_to_pidx_start_end ] # get patient id's to serve as a secondary sort key
-        elif dataset_name == 'MEDSDataset':
-            train_idx_to_seq_length: List[int] = tokenizer.get_seq_length_per_patient(datasets['train'])
-            val_idx_to_seq_length: List[int] = tokenizer.get_seq_length_per_patient(datasets['val'])
-            test_idx_to_seq_length: List[int] = tokenizer.get_seq_length_per_patient(datasets['test'])
-        else:
-            raise ValueError(f"Unknown dataset_name: {dataset_name}")
+            secondary_sort_key = datasets['train'].idx_to_pidx_start_end[:, 0] # get patient id's to serve as a secondary sort key
+
+        # Cache each epoch's batch plan next to the tokenizer's other dataset-specific files (i.e. `seq_length_per_patient.npy`)
+        path_to_batch_plans_dirs: Dict[str, str] = { 
+            split: os.path.join(tokenizer.get_path_to_dataset_dir(datasets[split]), 'batch_plans/') 
+            for split in [ 'train', 'val', 'test' ] 
+        }
 
         # For Multi-GPU training, need to do this to first determine # of sequences in each batch so that we can evenly distribute batches across GPUs
-        train_sort_sampler = SortishSampler(train_idx_to_seq_length, train_bucket_size, is_random_shuffle_across_buckets=is_random_shuffle_across_buckets, is_random_shuffle_within_buckets=is_random_shuffle_within_buckets, secondary_sort_key=secondary_sort_key, n_replicas=1, rank=0)
-        train_batch_sampler = ApproxBatchSampler( train_idx_to_seq_length, train_sort_sampler, max_length, batch_max_tokens, )
+        # NOTE: `len()` computes each batch plan once per epoch (or loads it from `path_to_batch_plans_dirs`), so building samplers twice is cheap
+        train_sort_sampler = SortishSampler(train_idx_to_seq_length, train_bucket_size, is_random_shuffle_across_buckets=is_random_shuffle_across_buckets, is_random_shuffle_within_buckets=is_random_shuffle_within_buckets, secondary_sort_key=secondary_sort_key, n_replicas=1, rank=0, seed=seed)
+        train_batch_sampler = ApproxBatchSampler( train_idx_to_seq_length, train_sort_sampler, max_length, batch_max_tokens, path_to_cache_dir=path_to_batch_plans_dirs['train'])
         _ = len(train_batch_sampler)
         train_n_samples_per_batch = train_batch_sampler.n_samples_per_batch
         val_sort_sampler = SortishSampler( val_idx_to_seq_length, 1, is_random_shuffle_across_buckets=False, is_random_shuffle_within_buckets=False, n_replicas=1, rank=0)
-        val_batch_sampler = ApproxBatchSampler( val_idx_to_seq_length, val_sort_sampler, max_length, batch_max_tokens, )
+        val_batch_sampler = ApproxBatchSampler( val_idx_to_seq_length, val_sort_sampler, max_length, batch_max_tokens, path_to_cache_dir=path_to_batch_plans_dirs['val'])
         _ = len(val_batch_sampler)
         val_n_samples_per_batch = val_batch_sampler.n_samples_per_batch
         test_sort_sampler = SortishSampler( test_idx_to_seq_length, 1, is_random_shuffle_across_buckets=False, is_random_shuffle_within_buckets=False, n_replicas=1, rank=0)
-        test_batch_sampler = ApproxBatchSampler( test_idx_to_seq_length, test_sort_sampler, max_length, batch_max_tokens, )
+        test_batch_sampler = ApproxBatchSampler( test_idx_to_seq_length, test_sort_sampler, max_length, batch_max_tokens, path_to_cache_dir=path_to_batch_plans_dirs['test'])
         _ = len(test_batch_sampler)
         test_n_samples_per_batch = test_batch_sampler.n_samples_per_batch
 
         # Train -- randomize (if desired) within/across batch sequence ordering
         print('=>', len(train_n_samples_per_batch), len(val_n_samples_per_batch), len(test_n_samples_per_batch))
-        train_sort_sampler = SortishSampler(train_idx_to_seq_length, train_bucket_size, is_random_shuffle_across_buckets=is_random_shuffle_across_buckets, is_random_shuffle_within_buckets=is_random_shuffle_within_buckets, secondary_sort_key=secondary_sort_key, n_samples_per_batch=train_n_samples_per_batch, n_replicas=n_replicas)
-        train_batch_sampler = ApproxBatchSampler( train_idx_to_seq_length, train_sort_sampler, max_length, batch_max_tokens, )
+        train_sort_sampler = SortishSampler(train_idx_to_seq_length, train_bucket_size, is_random_shuffle_across_buckets=is_random_shuffle_across_buckets, is_random_shuffle_within_buckets=is_random_shuffle_within_buckets, secondary_sort_key=secondary_sort_key, n_samples_per_batch=train_n_samples_per_batch, n_replicas=n_replicas, seed=seed)
+        train_batch_sampler = ApproxBatchSampler( train_idx_to_seq_length, train_sort_sampler, max_length, batch_max_tokens, path_to_cache_dir=path_to_batch_plans_dirs['train'])
         train_batch_sampler_kwargs = { 'batch_sampler' : train_batch_sampler, }
         # For val / test -- always sort by length, then execute in fixed sequence
         ## Val
         val_sort_sampler = SortishSampler( val_idx_to_seq_length, 1, is_random_shuffle_across_buckets=False, is_random_shuffle_within_buckets=False, n_samples_per_batch=val_n_samples_per_batch, n_replicas=n_replicas)
-        val_batch_sampler = ApproxBatchSampler( val_idx_to_seq_length, val_sort_sampler, max_length, batch_max_tokens, )
+        val_batch_sampler = ApproxBatchSampler( val_idx_to_seq_length, val_sort_sampler, max_length, batch_max_tokens, path_to_cache_dir=path_to_batch_plans_dirs['val'])
         val_batch_sampler_kwargs = { 'batch_sampler' : val_batch_sampler, }
         ## Test
         test_sort_sampler = SortishSampler( test_idx_to_seq_length, 1, is_random_shuffle_across_buckets=False, is_random_shuffle_within_buckets=False, n_samples_per_batch=test_n_samples_per_batch, n_replicas=n_replicas)
-        test_batch_sampler = ApproxBatchSampler( test_idx_to_seq_length, test_sort_sampler, max_length, batch_max_tokens, )
+        test_batch_sampler = ApproxBatchSampler( test_idx_to_seq_length, test_sort_sampler, max_length, batch_max_tokens, path_to_cache_dir=path_to_batch_plans_dirs['test'])
+        test_batch_sampler_kwargs = { 'batch_sampler' : test_batch_sampler, }
+    elif dataloader_mode == 'packed':
+        logger.info("====> Loading PackedBatchSampler")
+        train_bucket_size = approx_batch_sampler.bucket_size
+        batch_max_tokens = approx_batch_sampler.max_tokens
+        is_random_shuffle_across_buckets = approx_batch_sampler.is_random_shuffle_across_buckets
+
+        # Get sequence lengths for each example in dataset
+        train_idx_to_seq_length: np.ndarray = get_idx_to_seq_length(dataset_name, datasets['train'], tokenizer)
+        val_idx_to_seq_length: np.ndarray = get_idx_to_seq_length(dataset_name, datasets['val'], tokenizer)
+        test_idx_to_seq_length: np.ndarray = get_idx_to_seq_length(dataset_name, datasets['test'], tokenizer)
+        
+        # Train -- shuffle order of batches (if desired)
+        # NOTE: Every GPU computes the same global batch plan, then takes every `n_replicas`-th batch, so no need to pre-compute `n_samples_per_batch`
+        # NOTE: DDP isn't initialized yet, so pass `rank` explicitly (otherwise every GPU would take rank 0's batches)
+        train_batch_sampler = PackedBatchSampler(train_idx_to_seq_length, max_length, batch_max_tokens, bucket_size=train_bucket_size, is_random_shuffle_batches=is_random_shuffle_across_buckets, seed=seed, n_replicas=n_replicas, rank=get_rank())
+        train_batch_sampler_kwargs = { 'batch_sampler' : train_batch_sampler, }
+        # For val / test -- always execute in fixed sequence
+        val_batch_sampler = PackedBatchSampler(val_idx_to_seq_length, max_length, batch_max_tokens, is_random_shuffle_batches=False, seed=seed, n_replicas=n_replicas, rank=get_rank())
+        val_batch_sampler_kwargs = { 'batch_sampler' : val_batch_sampler, }
+        test_batch_sampler = PackedBatchSampler(test_idx_to_seq_length, max_length, batch_max_tokens, is_random_shuffle_batches=False, seed=seed, n_replicas=n_replicas, rank=get_rank())
+        test_batch_sampler_kwargs = { 'batch_sampler' : test_batch_sampler, }
+        logger.info(f"PackedBatchSampler | train: {len(train_batch_sampler)} batches / GPU, padding_efficiency={train_batch_sampler.padding_efficiency:.4f}, budget_efficiency={train_batch_sampler.budget_efficiency:.4f}")
+    elif dataloader_mode == 'streaming':
+        logger.info("====> Loading StreamingDataset")
+        streaming: Optional[Any] = getattr(config.data.dataloader, 'streaming', None)
+        # Train -- stream batches, sharded across GPUs + workers
+        # NOTE: StreamingDataset yields batches itself, so set `batch_size=None`
+        datasets = { **datasets, 'train' : StreamingDataset(datasets['train'], 
+                                                            batch_size, 
+                                                            block_size=getattr(streaming, 'block_size', 1024), 
+                                                            shuffle_buffer_size=getattr(streaming, 'shuffle_buffer_size', 10_000), 
+                                                            is_shuffle=True, 
+                                                            seed=seed, 
+                                                            n_replicas=n_replicas) }
+        train_batch_sampler_kwargs = { 'batch_size' : None, }
+        # For val / test -- need to see every example exactly once, so keep as map-style datasets
+        val_batch_sampler_kwargs = { 'batch_size' : batch_size, }
+        test_batch_sampler_kwargs = { 'batch_size' : batch_size, }
+    elif is_length_bucketed_batches(config):
+        logger.info("====> Loading LengthBucketedBatchSampler")
+        batch_sampler: Optional[Any] = getattr(config.data.dataloader, 'batch_sampler', None)
+        n_batches_per_bucket: int = getattr(batch_sampler, 'n_batches_per_bucket', 100)
+
+        # Get (approximate) sequence lengths for each example in dataset
+        train_idx_to_seq_length: np.ndarray = get_idx_to_approx_seq_length(dataset_name, datasets['train'], tokenizer)
+        val_idx_to_seq_length: np.ndarray = get_idx_to_approx_seq_length(dataset_name, datasets['val'], tokenizer)
+        test_idx_to_seq_length: np.ndarray = get_idx_to_approx_seq_length(dataset_name, datasets['test'], tokenizer)
+
+        # NOTE: DDP isn't initialized yet, so pass `rank` explicitly (otherwise every GPU would take rank 0's batches)
+        # Train -- shuffle examples, then batch together examples of similar length within each bucket
+        train_batch_sampler = LengthBucketedBatchSampler(train_idx_to_seq_length, batch_size, n_batches_per_bucket=n_batches_per_bucket, is_random_shuffle=True, seed=seed, n_replicas=n_replicas, rank=0 if is_shard_by_rank(config) else get_rank())
+        train_batch_sampler_kwargs = { 'batch_sampler' : train_batch_sampler, }
+        # For val / test -- always sort by length, then execute in fixed sequence
+        val_batch_sampler = LengthBucketedBatchSampler(val_idx_to_seq_length, batch_size, is_random_shuffle=False, seed=seed, n_replicas=n_replicas, rank=0 if is_shard_by_rank(config) else get_rank())
+        val_batch_sampler_kwargs = { 'batch_sampler' : val_batch_sampler, }
+        test_batch_sampler = LengthBucketedBatchSampler(test_idx_to_seq_length, batch_size, is_random_shuffle=False, seed=seed, n_replicas=n_replicas, rank=0 if is_shard_by_rank(config) else get_rank())
         test_batch_sampler_kwargs = { 'batch_sampler' : test_batch_sampler, }
     else:
         train_batch_sampler_kwargs = { 'batch_size' : batch_size, }
         val_batch_sampler_kwargs = { 'batch_size' : batch_size, }
         test_batch_sampler_kwargs = { 'batch_size' : batch_size, }
 
+    # Collator is picklable, and each worker loads the tokenizer at most once (see `FEMRCollator`)
+    collator: FEMRCollator = FEMRCollator(tokenizer, dataset_name, max_length, is_truncation_random, is_mlm, mlm_prob, seed, is_sequence_packing)
+    # Keep workers alive across epochs / validation runs so we don't re-fork workers (and re-load datasets + tokenizer) every time
+    persistent_workers: bool = getattr(config.data.dataloader, 'persistent_workers', True) and n_workers > 0
+    prefetch_factor: Optional[int] = getattr(config.data.dataloader, 'prefetch_factor', 2) if n_workers > 0 else None
+    worker_kwargs: Dict[str, Any] = {
+        'num_workers' : n_workers,
+        'worker_init_fn' : collator.worker_init_fn if n_workers > 0 else None,
+        'prefetch_factor' : prefetch_factor,
+        'pin_memory' : True,
+    }
+
     train_loader = DataLoader(
         dataset=datasets['train'],
-        collate_fn=lambda x: collate_femr_timelines(x, tokenizer, dataset_name, max_length, is_truncation_random, is_mlm, mlm_prob, seed),
-        num_workers=n_workers,
-        pin_memory=True,
+        collate_fn=collator,
+        # NOTE: StreamingDataset is iterated inside each worker, so persistent workers would never see `set_epoch()` updates
+        persistent_workers=persistent_workers and dataloader_mode != 'streaming',
+        **worker_kwargs,
         **train_batch_sampler_kwargs,
     )
     val_loader = DataLoader(
         dataset=datasets['val'],
-        collate_fn=lambda x: collate_femr_timelines(x, tokenizer, dataset_name, max_length, is_truncation_random, is_mlm, mlm_prob, seed),
-        num_workers=n_workers,
-        pin_memory=True,
+        collate_fn=collator,
+        persistent_workers=persistent_workers,
+        **worker_kwargs,
         **val_batch_sampler_kwargs,
     )
     test_loader = DataLoader(
         dataset=datasets['test'],
-        collate_fn=lambda x: collate_femr_timelines(x, tokenizer, dataset_name, max_length, is_truncation_random, is_mlm, mlm_prob, seed),
-        num_workers=n_workers,
-        pin_memory=True,
+        collate_fn=collator,
+        persistent_workers=persistent_workers,
+        **worker_kwargs,
         **test_batch_sampler_kwargs,
     )
     return {
@@ -118,32 +238,52 @@ def load_datasets(config: DictConfig, tokenizer: Optional[BaseTokenizer]) -> Dic
     """Load all FEMR datasets. 
         - Takes ~8s for each dataset to load using /local-scratch/.
         - Takes ~8s for each dataset to load using /share/pi/.
+        - For FEMR, only the first dataset pays this cost -- the split of each patient is then cached (see `get_femr_split_hashes()`)
     """
     dataset_name: str = config.data.dataset.name
     is_debug: bool = getattr(config.data.dataset, 'is_debug', False)
     seed: int = config.main.seed
+    # Read patients ahead of time on a thread pool (in each dataloader worker), so that I/O latency doesn't stall collation
+    prefetch_kwargs: Dict[str, int] = {
+        'n_prefetch_threads' : getattr(config.data.dataset, 'n_prefetch_threads', 0),
+        'prefetch_queue_size' : getattr(config.data.dataset, 'prefetch_queue_size', 64),
+    }
+    
+    if is_shard_by_rank(config):
+        assert dataset_name == 'AllTokensFEMRDataset', f"ERROR - `data.dataset.is_shard_by_rank` is only supported for AllTokensFEMRDataset, not {dataset_name}"
     
     # Load datasets
     if dataset_name == 'FEMRDataset':
         path_to_femr_extract: str = config.data.dataset.path_to_femr_extract
-        train_dataset = FEMRDataset(path_to_femr_extract, split='train', is_debug=is_debug, seed=seed)
-        val_dataset = FEMRDataset(path_to_femr_extract, split='val', is_debug=is_debug, seed=seed)
-        test_dataset = FEMRDataset(path_to_femr_extract, split='test', is_debug=is_debug, seed=seed)
+        train_dataset = FEMRDataset(path_to_femr_extract, split='train', is_debug=is_debug, seed=seed, **prefetch_kwargs)
+        val_dataset = FEMRDataset(path_to_femr_extract, split='val', is_debug=is_debug, seed=seed, **prefetch_kwargs)
+        test_dataset = FEMRDataset(path_to_femr_extract, split='test', is_debug=is_debug, seed=seed, **prefetch_kwargs)
     elif dataset_name == 'AllTokensFEMRDataset':
         path_to_femr_extract: str = config.data.dataset.path_to_femr_extract
         max_length: int = config.data.dataloader.max_length
+        cache_max_bytes: int = getattr(config.data.dataset, 'cache_max_bytes', 512 * 1024**2)
+        is_return_token_ids: bool = getattr(config.data.dataset, 'is_pretokenized', False)
+        # Only hold this GPU's shard of examples (rather than every GPU holding the full dataset)
+        shard_kwargs: Dict[str, int] = { 'shard_rank' : get_rank(), 'n_shards' : len(config.trainer.devices) } if is_shard_by_rank(config) else {}
         assert tokenizer is not None, "Tokenizer must be provided for AllTokensFEMRDataset"
-        train_dataset = AllTokensFEMRDataset(tokenizer, max_length, path_to_femr_extract, split='train', is_debug=is_debug, seed=seed)
-        val_dataset = AllTokensFEMRDataset(tokenizer, max_length, path_to_femr_extract, split='val', is_debug=is_debug, seed=seed)
-        test_dataset = AllTokensFEMRDataset(tokenizer, max_length, path_to_femr_extract, split='test', is_debug=is_debug, seed=seed)
+        train_dataset = AllTokensFEMRDataset(tokenizer, max_length, path_to_femr_extract, split='train', is_debug=is_debug, seed=seed, cache_max_bytes=cache_max_bytes, is_return_token_ids=is_return_token_ids, **shard_kwargs, **prefetch_kwargs)
+        val_dataset = AllTokensFEMRDataset(tokenizer, max_length, path_to_femr_extract, split='val', is_debug=is_debug, seed=seed, cache_max_bytes=cache_max_bytes, is_return_token_ids=is_return_token_ids, **shard_kwargs, **prefetch_kwargs)
+        test_dataset = AllTokensFEMRDataset(tokenizer, max_length, path_to_femr_extract, split='test', is_debug=is_debug, seed=seed, cache_max_bytes=cache_max_bytes, is_return_token_ids=is_return_token_ids, **shard_kwargs, **prefetch_kwargs)
     elif dataset_name == 'MEDSDataset':
         path_to_meds_extract: str = config.data.dataset.path_to_meds_reader_extract
-        train_dataset = MEDSDataset(path_to_meds_extract, split='train', is_debug=is_debug, seed=seed)
-        val_dataset = MEDSDataset(path_to_meds_extract, split='val', is_debug=is_debug, seed=seed)
-        test_dataset = MEDSDataset(path_to_meds_extract, split='test', is_debug=is_debug, seed=seed)
+        train_dataset = MEDSDataset(path_to_meds_extract, split='train', is_debug=is_debug, seed=seed, **prefetch_kwargs)
+        val_dataset = MEDSDataset(path_to_meds_extract, split='val', is_debug=is_debug, seed=seed, **prefetch_kwargs)
+        test_dataset = MEDSDataset(path_to_meds_extract, split='test', is_debug=is_debug, seed=seed, **prefetch_kwargs)
     else:
         raise ValueError(f"Unknown value for config.data.dataset.name: {dataset_name}")
     
+    if getattr(config.data.dataset, 'is_pretokenized', False) and dataset_name != 'AllTokensFEMRDataset':
+        assert dataset_name in ['FEMRDataset', 'MEDSDataset'], f"ERROR - `is_pretokenized` only supported for FEMRDataset, MEDSDataset, and AllTokensFEMRDataset, not {dataset_name}"
+        assert tokenizer is not None, "Tokenizer must be provided for `is_pretokenized`"
+        train_dataset = PretokenizedDataset(tokenizer, train_dataset)
+        val_dataset = PretokenizedDataset(tokenizer, val_dataset)
+        test_dataset = PretokenizedDataset(tokenizer, test_dataset)
+
     return { 
         'train' : train_dataset, 
         'val' : val_dataset, 
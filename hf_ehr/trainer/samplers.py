@@ -1,6 +1,8 @@
 """Credit: https://github.com/microsoft/protein-sequence-models/blob/main/sequence_models/samplers.py"""
 from typing import List, Tuple, Generator, Optional
+import os
 import math
+import hashlib
 import numpy as np
 import torch
 from torch.utils.data import Sampler, BatchSampler
@@ -8,6 +10,8 @@ from torch.utils.data import Sampler, BatchSampler
 class SortishSampler(Sampler):
     """Returns indices such that inputs with similar lengths are close together.
     Set bucket_size = 1 to do perfect sampling
+
+    Every epoch, shuffles one contiguous index array (seeded by `(seed, epoch)`), then returns a view of this GPU's slice of it.
     """
 
     def __init__(self, 
@@ -18,17 +22,30 @@ class SortishSampler(Sampler):
                  secondary_sort_key: Optional[List[int]] = None,
                  n_samples_per_batch: Optional[List[int]] = None,
                  n_replicas: int = 1,
-                 rank: Optional[int] = None):
+                 rank: Optional[int] = None,
+                 seed: int = 0):
         if secondary_sort_key is not None:
             self.data: np.ndarray = np.lexsort((np.array(secondary_sort_key), -1 * np.array(sequence_lengths))) # sort longest -> shortest; break ties by considering `secondary_sort_key`; useful if `secondary_sort_key` is patient_id for the AllTokensFEMRDataset so that we keep all subsequences from the same patient together
         else:
             self.data: np.ndarray = np.argsort(-1 * np.array(sequence_lengths)) # sort longest -> shortest; NOTE: keep so that if we blow out memory, we do so earlier rather than later
         self.n_replicas: int = n_replicas
         self.bucket_size: int = bucket_size
-        n_buckets: int = int(np.ceil(len(sequence_lengths) / self.bucket_size))
-        self.bucketed_data = [self.data[i * bucket_size: i * bucket_size + bucket_size] for i in range(n_buckets)]
+        self.seed: int = seed
         self.epoch: int = 0
+        self.indices: Optional[np.ndarray] = None # all GPUs' indices for `self.last_indices_epoch`, in order
+        self.last_indices_epoch: Optional[int] = None # for tracking `self.indices` caching
+        self.set_n_samples_per_batch(n_samples_per_batch)
+        self.is_random_shuffle_across_buckets: bool = is_random_shuffle_across_buckets
+        self.is_random_shuffle_within_buckets: bool = is_random_shuffle_within_buckets
+        self.rank: int = rank if rank is not None else torch.distributed.get_rank() if torch.distributed.is_initialized() else 0
+
+    @property
+    def bucketed_data(self) -> List[np.ndarray]:
+        """Unshuffled buckets (as views into `self.data`)"""
+        return [ self.data[i:i + self.bucket_size] for i in range(0, self.data.shape[0], self.bucket_size) ]
 
+    def set_n_samples_per_batch(self, n_samples_per_batch: Optional[List[int]]):
+        """Set how many samples each GPU gets"""
         self.n_samples_per_batch: Optional[List[int]] = n_samples_per_batch # [idx] = batch idx, [value] = number of samples in that batch
         if self.n_samples_per_batch is not None:
             # We've been told explicitly the number of samples per batch. Use this to split batches across GPUs.
@@ -38,34 +55,48 @@ class SortishSampler(Sampler):
             # even # of batches per GPU, b/c batches will be formed based on token counts rather than samples. 
             # If we don't evenly allocate the # of batches across GPUs, then torch trainer with DDP will stall
             self.n_batches_per_gpu: int = int(math.floor(len(self.n_samples_per_batch) * 1.0 / self.n_replicas))
-            self.n_samples_per_gpu: List[int] = [ sum(self.n_samples_per_batch[x * self.n_batches_per_gpu: (x + 1) * self.n_batches_per_gpu]) for x in range(self.n_replicas) ] # [idx] = GPU idx, [value] = number of samples on that GPU
+            batch_offsets: np.ndarray = np.concatenate([[0], np.cumsum(self.n_samples_per_batch, dtype=np.int64)])
+            self.n_samples_per_gpu: List[int] = [ int(batch_offsets[(x + 1) * self.n_batches_per_gpu] - batch_offsets[x * self.n_batches_per_gpu]) for x in range(self.n_replicas) ] # [idx] = GPU idx, [value] = number of samples on that GPU
         else:
             # We don't know the number of samples per batch, so we'll just split samples evenly across GPUs
             # Assume even number of samples per batch, so can evenly split samples across GPUs to get even # of batches per GPU
-            self.n_batches_per_gpu: int = int(math.floor(len(sequence_lengths) * 1.0 / self.n_replicas))
+            self.n_batches_per_gpu: int = int(math.floor(self.data.shape[0] * 1.0 / self.n_replicas))
             self.n_samples_per_gpu: List[int] = [ self.n_batches_per_gpu ] * self.n_replicas # [idx] = GPU idx, [value] = number of samples on that GPU
-
         assert len(self.n_samples_per_gpu) == self.n_replicas, f"ERROR: len(self.n_samples_per_gpu) ({len(self.n_samples_per_gpu)}) != self.n_replicas ({self.n_replicas})"
-        self.is_random_shuffle_across_buckets: bool = is_random_shuffle_across_buckets
-        self.is_random_shuffle_within_buckets: bool = is_random_shuffle_within_buckets
-        self.rank: int = rank if rank is not None else torch.distributed.get_rank() if torch.distributed.is_initialized() else 0
 
-    def __iter__(self):
-        """This gets called once at the start of every epoch."""
-        np.random.seed(0)
-        data = np.copy(self.bucketed_data) # copy to prevent modifying the original data; for deterministic shuffling between epochs
-        if self.is_random_shuffle_within_buckets:
-            for bucket in data:
-                np.random.shuffle(bucket)
+    def get_all_indices(self) -> np.ndarray:
+        """Return the indices of ALL GPUs for the current epoch, in order. Computed once per epoch."""
+        if self.indices is not None and self.last_indices_epoch == self.epoch:
+            return self.indices
+        rng: np.random.Generator = np.random.default_rng((self.seed, self.epoch))
+        n_samples: int = self.data.shape[0]
+        n_full: int = (n_samples // self.bucket_size) * self.bucket_size # number of samples in full buckets
+        order: np.ndarray = np.arange(n_samples) # [idx] = position in epoch, [value] = position in `self.data`
+        if self.is_random_shuffle_within_buckets and self.bucket_size > 1:
+            # Argsort random keys within each (full) bucket, then shuffle the last (partial) bucket
+            order[:n_full] = (np.argsort(rng.random((n_full // self.bucket_size, self.bucket_size)), axis=1) + np.arange(0, n_full, self.bucket_size)[:, None]).ravel()
+            order[n_full:] = n_full + rng.permutation(n_samples - n_full)
         if self.is_random_shuffle_across_buckets:
-            np.random.shuffle(data)
-        indices = [item for sublist in data for item in sublist]
+            # Concatenate buckets in a random order
+            bucket_starts: np.ndarray = rng.permutation(np.arange(0, n_samples, self.bucket_size))
+            bucket_sizes: np.ndarray = np.minimum(self.bucket_size, n_samples - bucket_starts)
+            new_bucket_starts: np.ndarray = np.cumsum(bucket_sizes) - bucket_sizes
+            order = order[np.arange(n_samples) + np.repeat(bucket_starts - new_bucket_starts, bucket_sizes)]
+        self.indices = self.data[order]
+        self.last_indices_epoch = self.epoch
+        return self.indices
+
+    def get_indices(self) -> np.ndarray:
+        """Return this GPU's indices for the current epoch (as a view into `get_all_indices()`)"""
         # subsample for this GPU. NOTE: the value of `start - end` might be different for each GPU 
         # b/c batches might be formed based on token counts rather than samples
         start: int = sum(self.n_samples_per_gpu[:self.rank])
         end: int = start + self.n_samples_per_gpu[self.rank]
-        indices = indices[start:end]
-        return iter(indices)
+        return self.get_all_indices()[start:end]
+
+    def __iter__(self):
+        """This gets called once at the start of every epoch."""
+        return iter(self.get_indices().tolist())
 
     def __len__(self) -> int:
         return self.n_samples_per_gpu[self.rank]
@@ -76,6 +107,62 @@ class SortishSampler(Sampler):
         self.epoch: int = epoch
 
 
+def get_greedy_batch_sizes(lengths: np.ndarray, 
+                           max_tokens: int, 
+                           max_examples: int = 99999999, 
+                           batch_mult: int = 1) -> np.ndarray:
+    """
+        Return the number of samples in each batch when greedily batching `lengths` (in order) such that
+        `len(batch) * max(lengths in batch) <= max_tokens`. Exactly matches the batches created by the original 
+        per-sample loop in `ApproxBatchSampler.__iter__()`, but only loops over batches (not samples) in Python.
+
+        For a batch with max length `m`, the next `max_tokens // m` samples fit unless one of them is longer than `m`,
+        which we check with a single `max()` over that slice. Since samples are (mostly) sorted longest -> shortest,
+        this is usually the only check needed per batch.
+        NOTE: Assumes every length is <= `max_tokens`
+    """
+    lengths: List[int] = np.asarray(lengths, dtype=np.int64).tolist()
+    n_samples: int = len(lengths)
+    batch_sizes: List[int] = []
+    start: int = 0 # idx of first sample in current batch
+    n_forced: int = 0 # number of samples at the start of current batch that are included regardless of `max_tokens` (i.e. leftovers from rounding to `batch_mult`)
+    while start < n_samples:
+        # Find largest `n` such that all of the samples in [start + n_forced, start + n) fit into the batch
+        n: int = max(1, n_forced)
+        m: int = max(lengths[start:start + n]) # max length in batch
+        max_n: int = min(n_samples - start, max_examples) if n_forced < max_examples else n_samples - start
+        while n < max_n:
+            guess_n: int = min(max_n, max_tokens // m) if m > 0 else max_n
+            if guess_n <= n:
+                break
+            if max(lengths[start + n:start + guess_n]) <= m:
+                # All samples up to `guess_n` are <= `m`, so they fit
+                n = guess_n
+                break
+            # Some sample is longer than `m`, so add samples up to it, then check if it fits
+            n = next(k for k in range(start + n, start + guess_n) if lengths[k] > m) - start
+            if (n + 1) * lengths[start + n] > max_tokens:
+                break
+            m = lengths[start + n]
+            n += 1
+        if n_forced < max_examples <= n:
+            # Batch hit `max_examples`, so yield it immediately
+            batch_sizes.append(max_examples)
+            start += max_examples
+            n_forced = 0
+        elif start + n >= n_samples:
+            # Ran out of samples, so yield everything that's left
+            batch_sizes.append(n_samples - start)
+            start = n_samples
+        else:
+            # Sample at `start + n` doesn't fit, so yield batch (rounded down to a multiple of `batch_mult`) and
+            # carry over the rest (plus the sample that didn't fit) into the next batch
+            rounded_n: int = max(1, (n // batch_mult) * batch_mult)
+            batch_sizes.append(rounded_n)
+            start += rounded_n
+            n_forced = n - rounded_n + 1
+    return np.array(batch_sizes, dtype=np.int64)
+
 class ApproxBatchSampler(BatchSampler):
     """
 	Parameters:
@@ -91,6 +178,9 @@ class ApproxBatchSampler(BatchSampler):
 
 	sample_lengths : array-like
 		List of lengths of sequences in the order of the dataset
+
+	path_to_cache_dir : Optional[str]
+		If set, then save each epoch's batch plan to this folder, keyed by a hash of (sampler order, sample lengths, batching args)
 	"""
 
     def __init__(self, 
@@ -100,8 +190,10 @@ class ApproxBatchSampler(BatchSampler):
                 max_tokens: int = 99999999, 
                 max_examples: int = 99999999, 
                 batch_mult: int = 1, 
-                drop_last: bool = True):
+                drop_last: bool = True,
+                path_to_cache_dir: Optional[str] = None):
         self.sample_lengths: List[int] = sample_lengths
+        self.sample_lengths_arr: Optional[np.ndarray] = None # `sample_lengths` as a NumPy array; created on first use
         self.sampler = sampler
         self.model_context_window: int = model_context_window # max size of seq that model can handle, so any seq great than this will get truncated anyway
         self.max_tokens: int = max_tokens # max tokens per batch
@@ -111,64 +203,77 @@ class ApproxBatchSampler(BatchSampler):
         self.length: int = None # result of len(self)
         self.n_samples_per_batch: List[int] = None # for tracking # of samples per batch -- used in Multi-GPU training to evenly distribute sample (b/c hard to know apriori how many samples are in a batch if splitting batches by max token limits)
         self.last_length_epoch_calc: int = None # for tracking self.length caching
+        self.path_to_cache_dir: Optional[str] = path_to_cache_dir
+        self.batch_plan: Optional[Tuple[np.ndarray, np.ndarray]] = None # (indices, batch_offsets) -- batch `i` = indices[batch_offsets[i]:batch_offsets[i+1]]; recomputed every epoch
         self.start_batch_idx: int = 0 # batch idx to start yielding at; used for resuming samping from the last index saved in a checkpoint
         assert self.max_tokens >= self.model_context_window, f"ERROR: max_tokens ({self.max_tokens}) must be >= model_context_window ({self.model_context_window}). Otherwise, you could get a sequence that is too long to be included in any batch, i.e. len(seq) == model_context_window > max_tokens, which means some batches will return empty which throws an error. It doesn't make sense to limit the batch size to be less than the model context window, b/c then you'll never fully fill the model's context window."
 
+    def get_batch_plan(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+            Return (indices, batch_offsets) for the current epoch, where batch `i` = indices[batch_offsets[i]:batch_offsets[i+1]].
+            Computed once per epoch (and loaded from `self.path_to_cache_dir` if we've seen this exact epoch before).
+        """
+        if self.batch_plan is not None and self.last_length_epoch_calc == self.sampler.epoch:
+            return self.batch_plan
+        if isinstance(self.sampler, SortishSampler) and self.sampler.n_samples_per_batch is not None:
+            # Batches are split across GPUs, so compute the batches of ALL GPUs (identical on every GPU), then take this GPU's share.
+            # NOTE: Need to redo this every epoch b/c the sampler's order (and thus the # of samples per GPU) changes every epoch
+            all_batch_sizes: np.ndarray = self.get_batch_sizes(self.sampler.get_all_indices())
+            self.sampler.set_n_samples_per_batch(all_batch_sizes.tolist())
+            indices: np.ndarray = self.sampler.get_indices()
+            n_batches_per_gpu: int = self.sampler.n_batches_per_gpu
+            batch_sizes: np.ndarray = all_batch_sizes[self.sampler.rank * n_batches_per_gpu:(self.sampler.rank + 1) * n_batches_per_gpu]
+        else:
+            indices: np.ndarray = self.sampler.get_indices() if isinstance(self.sampler, SortishSampler) else np.fromiter(iter(self.sampler), dtype=np.int64)
+            batch_sizes: np.ndarray = self.get_batch_sizes(indices)
+        assert batch_sizes.sum() == indices.shape[0], f"ERROR: sum(batch_sizes) ({batch_sizes.sum()}) != # of samples ({indices.shape[0]})"
+
+        self.batch_plan = (indices, np.concatenate([[0], np.cumsum(batch_sizes)]))
+        self.length = int(batch_sizes.shape[0])
+        self.n_samples_per_batch = batch_sizes.tolist()
+        self.last_length_epoch_calc = self.sampler.epoch
+        return self.batch_plan
+
+    def get_batch_sizes(self, indices: np.ndarray) -> np.ndarray:
+        """Return the # of samples in each batch when greedily batching `indices` (in order).
+            Loaded from `self.path_to_cache_dir` if we've seen this exact order before."""
+        if self.sample_lengths_arr is None:
+            self.sample_lengths_arr = np.asarray(self.sample_lengths, dtype=np.int64)
+        lengths: np.ndarray = np.minimum(self.sample_lengths_arr[indices], self.model_context_window) # min() b/c seq will get truncated to fit into context window anyway
+        
+        # Load plan from cache (if exists), otherwise compute it
+        path_to_cache: Optional[str] = None
+        if self.path_to_cache_dir is not None:
+            key: str = hashlib.sha256(np.ascontiguousarray(indices).tobytes() + lengths.tobytes() + str((self.max_tokens, self.max_examples, self.batch_mult)).encode('utf-8')).hexdigest()
+            path_to_cache = os.path.join(self.path_to_cache_dir, f'{key}.npy')
+            if os.path.exists(path_to_cache):
+                return np.load(path_to_cache)
+        batch_sizes: np.ndarray = get_greedy_batch_sizes(lengths, self.max_tokens, self.max_examples, self.batch_mult)
+        if path_to_cache is not None:
+            os.makedirs(self.path_to_cache_dir, exist_ok=True)
+            path_to_tmp: str = f"{path_to_cache}.tmp-{os.getpid()}.npy"
+            np.save(path_to_tmp, batch_sizes)
+            os.replace(path_to_tmp, path_to_cache)
+        return batch_sizes
+
     def __len__(self):
-        if not (self.length and self.last_length_epoch_calc == self.sampler.epoch): 
-            # Calculate length of batch sampler
-            self.last_length_epoch_calc = self.sampler.epoch
-            length = 0
-            n_samples_per_batch: List[int] = []
-            for batch in iter(self):
-                length += 1
-                n_samples_per_batch.append(len(batch))
-            self.length = length
-            self.n_samples_per_batch = n_samples_per_batch
+        self.get_batch_plan()
         rank: int = self.sampler.rank
         assert sum(self.n_samples_per_batch) == self.sampler.n_samples_per_gpu[rank], f"ERROR: sum(n_samples_per_batch) ({sum(self.n_samples_per_batch)}) != self.sampler.n_samples_per_gpu[rank] ({self.sampler.n_samples_per_gpu[rank]})"
         assert len(self.n_samples_per_batch) == self.length, f"ERROR: len(n_samples_per_batch) ({len(self.n_samples_per_batch)}) != self.length ({self.length})"
         return self.length
 
     def __iter__(self) -> Generator[List[int], None, None]:
-        batch: List[int] = [] # list of patient idx's in dataset included in this batch
-        max_length: int = 0
-        batch_counter: int = 0 # count number of batches we've yielded so far
-        for sampler_idx in self.sampler:
-            this_length: int = min(self.sample_lengths[sampler_idx], self.model_context_window) # min() b/c seq will get truncated to fit into context window anyway
-            linear = (len(batch) + 1) * max(max_length, this_length)
-            if linear <= self.max_tokens:
-                batch.append(sampler_idx)
-                max_length = max(max_length, this_length)
-                if len(batch) == self.max_examples:
-                    if batch_counter >= self.start_batch_idx:
-                        # Only yield an actual batch if we've reached the `start_batch_idx`
-                        yield batch
-                    batch = []
-                    max_length = 0
-                    batch_counter += 1
-            else:
-                rounded_n = (len(batch) // self.batch_mult) * self.batch_mult
-                rounded_n = max(1, rounded_n)
-                if batch_counter >= self.start_batch_idx:
-                    # Only yield an actual batch if we've reached the `start_batch_idx`
-                    yield batch[:rounded_n]
-                batch = batch[rounded_n:] + [sampler_idx]
-                max_length = max([min(self.sample_lengths[i], self.model_context_window) for i in batch])
-                batch_counter += 1
-            # if batch_counter >= self.sampler.n_batches_per_gpu:
-            #     # If we've yielded the max number of batches for this GPU, then stop
-            #     # This is needed to keep the batch counts consistent across GPUs
-            #     print(f"Breaking out of ranking {self.sampler.rank} at batch_counter={batch_counter} and n_batches_per_gpu={self.sampler.n_batches_per_gpu}")
-            #     break
-        if len(batch) > 0:
-            yield batch
-            batch_counter += 1
+        (indices, batch_offsets) = self.get_batch_plan()
+        n_batches: int = batch_offsets.shape[0] - 1
         if self.sampler.n_samples_per_batch is not None:
             # NOTE: Only do this check if we know aprior what the `self.sampler.n_samples_per_batch` will be (i.e. we've already run __len__ on this ApproxBatchSampler)
             # Otherwise, `self.sampler.n_batches_per_gpu` won't be accurate (will be the # of examples rather than the # of batches) b/c we haven't updated it 
             # with `self.sampler.n_samples_per_batch` in the __init__ of SortishSampler yet
-            assert batch_counter == self.sampler.n_batches_per_gpu, f"ERROR: batch_counter ({batch_counter}) != self.sampler.n_batches_per_gpu ({self.sampler.n_batches_per_gpu})"
+            assert n_batches == self.sampler.n_batches_per_gpu, f"ERROR: n_batches ({n_batches}) != self.sampler.n_batches_per_gpu ({self.sampler.n_batches_per_gpu})"
+        for batch_idx in range(self.start_batch_idx, n_batches):
+            # Only yield an actual batch if we've reached the `start_batch_idx`
+            yield indices[batch_offsets[batch_idx]:batch_offsets[batch_idx + 1]].tolist()
 
     def set_epoch(self, epoch: int):
         """Ensures different shuffling for each epoch"""
@@ -176,6 +281,179 @@ class ApproxBatchSampler(BatchSampler):
         self.sampler.set_epoch(epoch)
         self.start_batch_idx = 0 # Reset starting batch idx b/c new epoch
 
+class PackedBatchSampler(BatchSampler):
+    """
+    Packs examples into batches of <= `max_tokens` tokens (including padding) so as to minimize padding,
+    i.e. maximize the number of non-PAD tokens per batch. Unlike `ApproxBatchSampler`, padding doesn't depend on the order of buckets.
+
+    Every epoch:
+        1. Sort examples longest -> shortest (breaking ties randomly), then split into buckets of `bucket_size` consecutive examples
+        2. Within each bucket, pack examples into batches using first-fit-decreasing, where a batch's cost is `len(batch) * max(lengths in batch)`
+            NOTE: Since examples are visited longest -> shortest, a batch's capacity is fixed by its first example, so only the most
+            recently opened batch can ever have room left -- i.e. first-fit-decreasing is equivalent to `get_greedy_batch_sizes()` on each bucket
+        3. Shuffle the order of batches (if `is_random_shuffle_batches`)
+        4. Assign every `n_replicas`-th batch to each GPU, dropping the last `n_batches % n_replicas` batches so that every GPU gets the same # of batches
+
+	Parameters:
+	-----------
+	sample_lengths : array-like
+		List of lengths of sequences in the order of the dataset
+
+	model_context_window : int
+		Max size of seq that model can handle, so any seq greater than this will get truncated anyway
+
+	max_tokens : int
+		Maximum number of tokens per batch (including padding)
+
+	bucket_size : int
+		Number of examples per bucket. Bigger buckets => less padding, but less randomness in which examples are batched together
+    """
+    def __init__(self, 
+                 sample_lengths: List[int], 
+                 model_context_window: int, 
+                 max_tokens: int, 
+                 bucket_size: int = 99999999,
+                 max_examples: int = 99999999, 
+                 is_random_shuffle_batches: bool = True,
+                 seed: int = 0,
+                 n_replicas: int = 1,
+                 rank: Optional[int] = None):
+        assert max_tokens >= model_context_window, f"ERROR: max_tokens ({max_tokens}) must be >= model_context_window ({model_context_window})."
+        self.sample_lengths: np.ndarray = np.minimum(np.asarray(sample_lengths, dtype=np.int64), model_context_window) # min() b/c seq will get truncated to fit into context window anyway
+        self.model_context_window: int = model_context_window
+        self.max_tokens: int = max_tokens
+        self.bucket_size: int = bucket_size
+        self.max_examples: int = max_examples
+        self.is_random_shuffle_batches: bool = is_random_shuffle_batches
+        self.seed: int = seed
+        self.n_replicas: int = n_replicas
+        self.rank: int = rank if rank is not None else torch.distributed.get_rank() if torch.distributed.is_initialized() else 0
+        self.epoch: int = 0
+        self.start_batch_idx: int = 0 # batch idx to start yielding at; used for resuming samping from the last index saved in a checkpoint
+        self.batch_plan: Optional[List[np.ndarray]] = None # [idx] = batch idx for this GPU, [value] = idxs of examples in that batch; recomputed every epoch
+        self.last_batch_plan_epoch: Optional[int] = None # for tracking `self.batch_plan` caching
+        self.padding_efficiency: Optional[float] = None # fraction of tokens in this epoch's batches that are non-PAD
+        self.budget_efficiency: Optional[float] = None # fraction of this epoch's total token budget (i.e. `n_batches * max_tokens`) filled with non-PAD tokens
+
+    def get_batch_plan(self) -> List[np.ndarray]:
+        """Return this GPU's batches for the current epoch"""
+        if self.batch_plan is not None and self.last_batch_plan_epoch == self.epoch:
+            return self.batch_plan
+        rng: np.random.Generator = np.random.default_rng((self.seed, self.epoch))
+        n_samples: int = self.sample_lengths.shape[0]
+
+        # Sort longest -> shortest, breaking ties randomly
+        indices: np.ndarray = np.lexsort((rng.random(n_samples), -self.sample_lengths))
+        lengths: np.ndarray = self.sample_lengths[indices]
+
+        # Pack each bucket
+        batch_sizes: np.ndarray = np.concatenate([ 
+            get_greedy_batch_sizes(lengths[start:start + self.bucket_size], self.max_tokens, self.max_examples) 
+            for start in range(0, n_samples, self.bucket_size) 
+        ] + [ np.zeros(0, dtype=np.int64) ])
+        batch_offsets: np.ndarray = np.concatenate([[0], np.cumsum(batch_sizes)])
+        n_batches: int = batch_sizes.shape[0]
+        
+        # Padding efficiency = non-PAD tokens / total tokens; first example in each batch is its longest
+        n_tokens_total: int = int((batch_sizes * lengths[batch_offsets[:-1]]).sum())
+        self.padding_efficiency = float(lengths.sum() / n_tokens_total) if n_tokens_total > 0 else 1.0
+        self.budget_efficiency = float(lengths.sum() / (n_batches * self.max_tokens)) if n_batches > 0 else 1.0
+
+        # Shuffle batches, then split evenly across GPUs
+        batch_order: np.ndarray = rng.permutation(n_batches) if self.is_random_shuffle_batches else np.arange(n_batches)
+        n_batches_per_gpu: int = n_batches // self.n_replicas
+        batch_order = batch_order[:n_batches_per_gpu * self.n_replicas][self.rank::self.n_replicas]
+        self.batch_plan = [ indices[batch_offsets[b]:batch_offsets[b + 1]] for b in batch_order ]
+        self.last_batch_plan_epoch = self.epoch
+        return self.batch_plan
+
+    def __len__(self) -> int:
+        return len(self.get_batch_plan())
+
+    def __iter__(self) -> Generator[List[int], None, None]:
+        batch_plan: List[np.ndarray] = self.get_batch_plan()
+        for batch_idx in range(self.start_batch_idx, len(batch_plan)):
+            # Only yield an actual batch if we've reached the `start_batch_idx`
+            yield batch_plan[batch_idx].tolist()
+
+    def set_epoch(self, epoch: int):
+        """Ensures different shuffling for each epoch"""
+        # ! Be sure to add a call to this function to PyTorch Lightning hook on epoch_end()
+        self.epoch = epoch
+        self.start_batch_idx = 0 # Reset starting batch idx b/c new epoch
+
+class LengthBucketedBatchSampler(BatchSampler):
+    """
+    Batches of `batch_size` examples, where examples in the same batch have similar lengths, so less of each batch is padding.
+    Unlike `ApproxBatchSampler`, only needs approximate lengths (i.e. any value that sorts examples roughly by their # of tokens).
+
+    Every epoch:
+        1. Shuffle all examples (if `is_random_shuffle`), then split into buckets of `n_batches_per_bucket * batch_size` consecutive examples
+        2. Sort each bucket longest -> shortest, then split it into batches of `batch_size` examples
+        3. Shuffle the order of batches (if `is_random_shuffle`)
+        4. Assign every `n_replicas`-th batch to each GPU, dropping the last `n_batches % n_replicas` batches so that every GPU gets the same # of batches
+    If not `is_random_shuffle`, then the whole dataset is one bucket (i.e. batches are in order of decreasing length).
+    """
+    def __init__(self, 
+                 sample_lengths: List[int], 
+                 batch_size: int, 
+                 n_batches_per_bucket: int = 100,
+                 is_random_shuffle: bool = True,
+                 seed: int = 0,
+                 n_replicas: int = 1,
+                 rank: Optional[int] = None):
+        self.sample_lengths: np.ndarray = np.asarray(sample_lengths, dtype=np.int64)
+        self.batch_size: int = batch_size
+        self.n_batches_per_bucket: int = n_batches_per_bucket
+        self.is_random_shuffle: bool = is_random_shuffle
+        self.seed: int = seed
+        self.n_replicas: int = n_replicas
+        self.rank: int = rank if rank is not None else torch.distributed.get_rank() if torch.distributed.is_initialized() else 0
+        self.epoch: int = 0
+        self.start_batch_idx: int = 0 # batch idx to start yielding at; used for resuming samping from the last index saved in a checkpoint
+        self.batch_plan: Optional[List[np.ndarray]] = None # [idx] = batch idx for this GPU, [value] = idxs of examples in that batch; recomputed every epoch
+        self.last_batch_plan_epoch: Optional[int] = None # for tracking `self.batch_plan` caching
+
+    def get_batch_plan(self) -> List[np.ndarray]:
+        """Return this GPU's batches for the current epoch"""
+        if self.batch_plan is not None and self.last_batch_plan_epoch == self.epoch:
+            return self.batch_plan
+        rng: np.random.Generator = np.random.default_rng((self.seed, self.epoch))
+        n_samples: int = self.sample_lengths.shape[0]
+
+        # Sort each bucket longest -> shortest
+        if self.is_random_shuffle:
+            indices: np.ndarray = rng.permutation(n_samples)
+            bucket_idxs: np.ndarray = np.arange(n_samples) // (self.n_batches_per_bucket * self.batch_size)
+            indices = indices[np.lexsort((-self.sample_lengths[indices], bucket_idxs))]
+        else:
+            indices: np.ndarray = np.argsort(-self.sample_lengths, kind='stable')
+        # NOTE: Buckets are a multiple of `batch_size`, so batches never span two buckets (except for the last partial batch)
+        batches: List[np.ndarray] = [ indices[start:start + self.batch_size] for start in range(0, n_samples, self.batch_size) ]
+
+        # Shuffle batches, then split evenly across GPUs
+        batch_order: np.ndarray = rng.permutation(len(batches)) if self.is_random_shuffle else np.arange(len(batches))
+        n_batches_per_gpu: int = len(batches) // self.n_replicas
+        batch_order = batch_order[:n_batches_per_gpu * self.n_replicas][self.rank::self.n_replicas]
+        self.batch_plan = [ batches[b] for b in batch_order ]
+        self.last_batch_plan_epoch = self.epoch
+        return self.batch_plan
+
+    def __len__(self) -> int:
+        return len(self.get_batch_plan())
+
+    def __iter__(self) -> Generator[List[int], None, None]:
+        batch_plan: List[np.ndarray] = self.get_batch_plan()
+        for batch_idx in range(self.start_batch_idx, len(batch_plan)):
+            # Only yield an actual batch if we've reached the `start_batch_idx`
+            yield batch_plan[batch_idx].tolist()
+
+    def set_epoch(self, epoch: int):
+        """Ensures different shuffling for each epoch"""
+        # ! Be sure to add a call to this function to PyTorch Lightning hook on epoch_end()
+        self.epoch = epoch
+        self.start_batch_idx = 0 # Reset starting batch idx b/c new epoch
+
 if __name__ == '__main__':
     sequence_lengths = [ # NOTE: Sort descending, so we batch in reverse order (i.e. starting from bottom)
         4, 4,           # 0,1